@@ -0,0 +1,164 @@
+import pandas
+import typing
+import numpy
+
+from codon_tables import AMINO_ACIDS
+
+'''
+Physicochemical properties of the amino acids, in the one letter code used by the codon tables
+('.' is a stop codon).  Used to order (or cluster) amino acid rows of heatmaps and logos so that
+substitutions with similar effects end up next to each other.
+
+Every (REF_AA, AA) pair is also mapped through precomputed 21 x 21 transition tables of the IMGT property
+classes (polarity, charge, hydropathy, chemical class, hydrogen donor/acceptor), so the physicochemical change
+spectrum of a whole codon table is a lookup plus one weighted bincount per property.
+'''
+
+# functional group of every amino acid, in display order
+AA_CLASSES = {'hydrophobic': ['A', 'V', 'I', 'L', 'M'],
+              'aromatic': ['F', 'W', 'Y'],
+              'polar': ['S', 'T', 'N', 'Q', 'C'],
+              'positive': ['K', 'R', 'H'],
+              'negative': ['D', 'E'],
+              'special': ['G', 'P'],
+              'stop': ['.']}
+
+# Kyte & Doolittle (1982) hydropathy index
+KYTE_DOOLITTLE = {'I': 4.5, 'V': 4.2, 'L': 3.8, 'F': 2.8, 'C': 2.5, 'M': 1.9, 'A': 1.8, 'G': -0.4, 'T': -0.7, 'S': -0.8, 'W': -0.9,
+                  'Y': -1.3, 'P': -1.6, 'H': -3.2, 'E': -3.5, 'Q': -3.5, 'D': -3.5, 'N': -3.5, 'K': -3.9, 'R': -4.5}
+
+AA_ORDERS = ['alphabetical', 'property', 'hydrophobicity', 'cluster']
+
+# IMGT 'physicochemical' classes of the amino acids; stop codons are their own class in every property
+PROPERTY_CLASSES = {'polarity': {'polar': 'RNDQEHKSTY', 'nonpolar': 'ACGILMFPWV'},
+                    'charge': {'positive': 'RHK', 'negative': 'DE', 'uncharged': 'ANCQGILMFPSTWYV'},
+                    'hydropathy': {'hydrophobic': 'ACILMFWV', 'neutral': 'GHPSTY', 'hydrophilic': 'RNDQEK'},
+                    'chemical': {'aliphatic': 'AGILPV', 'aromatic': 'FWY', 'sulfur': 'CM', 'hydroxyl': 'ST', 'basic': 'RHK',
+                                 'acidic': 'DE', 'amide': 'NQ'},
+                    'hydrogen_donor': {'donor': 'RKW', 'acceptor': 'DE', 'donor_acceptor': 'HNQSTY', 'none': 'ACGILMFPV'}}
+
+
+def property_class_codes(prop: str) -> typing.Tuple[numpy.ndarray, list]:
+    '''
+    output: (int array over AMINO_ACIDS with the class index of every amino acid, list of class names with 'stop' last)
+    '''
+    classes = list(PROPERTY_CLASSES[prop]) + ['stop']
+    codes = numpy.full(len(AMINO_ACIDS), classes.index('stop'))
+    for index, members in enumerate(PROPERTY_CLASSES[prop].values()):
+        for aa in members:
+            codes[AMINO_ACIDS.index(aa)] = index
+    return codes, classes
+
+
+def property_transition_table(prop: str) -> typing.Tuple[numpy.ndarray, list]:
+    '''
+    output: (21 x 21 int array indexed by [REF_AA, AA] index of AMINO_ACIDS, list of transition labels it indexes);
+            label 0 is 'unchanged' (same class), the others are '<ref class>><alt class>'
+    '''
+    codes, classes = property_class_codes(prop)
+    labels = ['unchanged'] + ['{}>{}'.format(ref, alt) for ref in classes for alt in classes if ref != alt]
+    table = numpy.zeros((len(AMINO_ACIDS), len(AMINO_ACIDS)), dtype = numpy.int64)
+    for ref in range(len(AMINO_ACIDS)):
+        for alt in range(len(AMINO_ACIDS)):
+            if codes[ref] != codes[alt]:
+                table[ref, alt] = labels.index('{}>{}'.format(classes[codes[ref]], classes[codes[alt]]))
+    return table, labels
+
+
+def _property_events() -> dict:
+    ''' named changes of interest as 21 x 21 boolean tables over (REF_AA, AA); changes to a stop codon only count as stop_gain '''
+    charge, charge_classes = property_class_codes('charge')
+    ref = {prop: property_class_codes(prop)[0][:, None] for prop in PROPERTY_CLASSES}
+    alt = {prop: property_class_codes(prop)[0][None, :] for prop in PROPERTY_CLASSES}
+    hydropathy_classes = property_class_codes('hydropathy')[1]
+    stop = numpy.array([aa == '.' for aa in AMINO_ACIDS])
+    sense = ~stop[:, None] & ~stop[None, :]
+    positive, negative = charge_classes.index('positive'), charge_classes.index('negative')
+    hydrophobic, hydrophilic = hydropathy_classes.index('hydrophobic'), hydropathy_classes.index('hydrophilic')
+    return {'charge_reversal': sense & (((ref['charge'] == positive) & (alt['charge'] == negative)) | ((ref['charge'] == negative) & (alt['charge'] == positive))),
+            'charge_change': sense & (ref['charge'] != alt['charge']),
+            'hydrophobic_to_hydrophilic': sense & (ref['hydropathy'] == hydrophobic) & (alt['hydropathy'] == hydrophilic),
+            'hydrophilic_to_hydrophobic': sense & (ref['hydropathy'] == hydrophilic) & (alt['hydropathy'] == hydrophobic),
+            'polarity_change': sense & (ref['polarity'] != alt['polarity']),
+            'chemical_class_change': sense & (ref['chemical'] != alt['chemical']),
+            'hydrogen_donor_change': sense & (ref['hydrogen_donor'] != alt['hydrogen_donor']),
+            'stop_gain': ~stop[:, None] & stop[None, :]}
+
+
+PROPERTY_EVENTS = _property_events()
+
+
+def aa_order(method: str, profiles: numpy.ndarray = None) -> list:
+    '''
+    input: method, one of AA_ORDERS; profiles, (positions x AMINO_ACIDS) matrix, only used by 'cluster'
+    output: list of indices into codon_tables.AMINO_ACIDS in display order (stop last, except for 'cluster')
+
+    'cluster' orders amino acids by average-linkage hierarchical clustering (requires scipy) of the correlation
+    between their profiles across positions, so amino acids that are tolerated at the same positions are grouped.
+    '''
+    if method == 'alphabetical':
+        order = sorted(AMINO_ACIDS, key = lambda aa: (aa == '.', aa))
+    elif method == 'property':
+        order = [aa for members in AA_CLASSES.values() for aa in members]
+    elif method == 'hydrophobicity':
+        order = sorted(AMINO_ACIDS, key = lambda aa: (aa == '.', -KYTE_DOOLITTLE.get(aa, 0.0)))
+    elif method == 'cluster':
+        from scipy.cluster.hierarchy import linkage, leaves_list
+
+        profiles = numpy.asarray(profiles, dtype = numpy.float64)
+        # amino acids with a constant profile (e.g. never observed) are at distance 1 from every other one
+        centered = profiles.T - profiles.T.mean(axis = 1, keepdims = True)
+        norms = numpy.linalg.norm(centered, axis = 1)
+        flat = norms == 0
+        centered[flat, :] = 0.0
+        norms[flat] = 1.0
+        distance = 1.0 - (centered @ centered.T) / numpy.outer(norms, norms)
+        condensed = numpy.clip(distance[numpy.triu_indices(len(AMINO_ACIDS), k = 1)], 0.0, None)
+        return list(leaves_list(linkage(condensed, method = 'average')))
+    else:
+        raise ValueError('unknown amino acid order {}; choose from {}'.format(method, ', '.join(AA_ORDERS)))
+    return [AMINO_ACIDS.index(aa) for aa in order]
+
+
+def aa_indices(aa: pandas.Series) -> numpy.ndarray:
+    ''' output: index into AMINO_ACIDS of every amino acid symbol, -1 for anything else (works on the categorical schema) '''
+    aa = aa.astype('category') if not isinstance(aa.dtype, pandas.CategoricalDtype) else aa
+    lookup = numpy.array([AMINO_ACIDS.index(symbol) if symbol in AMINO_ACIDS else -1 for symbol in aa.cat.categories.astype(str)] + [-1])
+    return lookup[aa.cat.codes.to_numpy()] # code -1 (missing) picks the trailing -1
+
+
+def property_change_spectra(df: pandas.DataFrame) -> typing.Tuple[pandas.DataFrame, pandas.DataFrame]:
+    '''
+    input: codon table of mutated codons (as returned by filter())
+    output: (per_codon, per_sample)
+            per_codon - dataframe indexed by POSITION with the frequency (summed CNT / mean DENOM, as in the other
+                        per-codon plots) of every '<property>:<transition>' and every PROPERTY_EVENTS entry
+            per_sample - dataframe indexed by the same columns with the mean per-codon frequency across codons
+                         and the share of all mutant counts (count_fraction)
+    '''
+    ref = aa_indices(df['REF_AA'])
+    alt = aa_indices(df['AA'])
+    valid = (ref >= 0) & (alt >= 0)
+    positions, position_index = numpy.unique(df['POSITION'].to_numpy(), return_inverse = True)
+    counts = df['CNT'].to_numpy(dtype = numpy.float64)
+    depth = numpy.bincount(position_index, weights = df['DENOM'].to_numpy(dtype = numpy.float64), minlength = len(positions)) \
+            / numpy.bincount(position_index, minlength = len(positions))
+    ref, alt, position_index, counts = ref[valid], alt[valid], position_index[valid], counts[valid]
+
+    columns, blocks = [], []
+    for prop in PROPERTY_CLASSES:
+        table, labels = property_transition_table(prop)
+        label = table[ref, alt]
+        block = numpy.bincount(position_index * len(labels) + label, weights = counts, minlength = len(positions) * len(labels))
+        blocks.append(block.reshape(len(positions), len(labels)))
+        columns += ['{}:{}'.format(prop, name) for name in labels]
+    for event, table in PROPERTY_EVENTS.items():
+        blocks.append(numpy.bincount(position_index, weights = counts * table[ref, alt], minlength = len(positions))[:, None])
+        columns.append(event)
+    summed = numpy.hstack(blocks)
+
+    per_codon = pandas.DataFrame(summed / depth[:, None], index = pandas.Index(positions, name = 'POSITION'), columns = columns)
+    total = counts.sum()
+    per_sample = pandas.DataFrame({'mean_freq_per_codon': per_codon.mean(axis = 0),
+                                   'count_fraction': summed.sum(axis = 0) / total if total > 0 else numpy.nan})
+    return per_codon, per_sample
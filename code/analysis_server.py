@@ -0,0 +1,336 @@
+import argparse
+import typing
+import concurrent.futures
+import functools
+import http.server
+import json
+import os
+import threading
+import time
+import traceback
+import urllib.request
+import uuid
+
+'''
+Long-running analysis service for LIMS hooks and other callers that start many small runs.
+
+Every invocation of plot_mutational_frequency_and_qc_stats.py or logo_plot_standalone.py pays for importing
+pandas/matplotlib and for parsing its codon tables, reference and annotation files again.  This server keeps
+a bounded pool of worker processes alive instead; each worker imports the plotting modules and builds the glyph
+outlines of the logo renderer once at start-up, and keeps parsed inputs in lru caches keyed by path, size and
+mtime (filtered codon tables per filter setting, logo matrices, and - through coordinates.read_reference and
+coordinates.load_annotations - references and annotations), so a job only pays for its own computation and an
+edited input file is picked up automatically.
+
+Jobs are JSON objects POSTed to http://127.0.0.1:<port>/jobs:
+
+    {"type": "analyses", "samples": [{"sample": "wtDNA", "path": "wt.codon", "color": "#999999", "replicate_group": "wt"}, ...],
+     "analyses": ["coverage", "freq_logo"], "params": {"qual": 24, "counts": 100}, "outdir": "results"}
+        runs analyses registered in run_manifest.ANALYSES; params default to run_manifest.DEFAULT_PARAMS;
+        samples may carry a numeric "passage" for the timecourse analysis; SiNPle .variants paths are converted
+        to <outdir>/<sample>.codon with the reference and orfStart params, as run_manifest.py does
+
+    {"type": "logo", "input": "matrix.csv", "sampleName": "wtDNA", "annotConfig": null, "codonStartPos": null,
+     "codonEndPos": null, "aaSpacing": 65, "minAnnotLabel": 7, "outdir": "results"}
+        the logo plot of logo_plot_standalone.py
+
+The reply (202) holds the job id; GET /jobs/<id> returns its state (queued, running, done or failed) with the
+outputs, the compute time and the error of a failed job.  POST /jobs?wait=1 answers only when the job has
+finished.  At most --maxQueue jobs are accepted at a time (queued plus running); further jobs get 503 with a
+Retry-After header, so a burst of runs cannot exhaust memory.  GET /health reports the pool state.
+
+    python3 analysis_server.py --port 8765 --workers 2 --maxQueue 16
+    python3 analysis_server.py --port 8765 --submit job.json
+'''
+
+FINISHED_JOBS_KEPT = 1000 # states of finished jobs kept for GET /jobs/<id>
+
+
+# ---- worker side (runs in the pool processes) ----
+
+def warm_worker() -> None:
+    ''' pool initializer: imports the plotting stack and builds the logo glyph outlines once per worker '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    import run_manifest
+    import logo_plot_standalone
+    from codon_tables import AMINO_ACIDS
+    from logo_render import default_glyph_cache
+
+    cache = default_glyph_cache()
+    for character in AMINO_ACIDS + ['X']:
+        cache.get(character)
+
+
+def ping() -> int:
+    return os.getpid()
+
+
+@functools.lru_cache(maxsize = 64)
+def filtered_table(path: str, size: int, mtime_ns: int, thresholds: tuple):
+    ''' codon table loaded and filtered once per file content and filter setting '''
+    from codon_tables import load_codon_table, parse_codon_range
+    import variant_filters
+
+    thresholds = dict(thresholds)
+    df = load_codon_table(path, positions = parse_codon_range(thresholds['codonRange']))
+    return variant_filters.apply_filters(df, **thresholds)[0]
+
+
+@functools.lru_cache(maxsize = 64)
+def converted_table(variants: tuple, reference: typing.Optional[tuple], orf_start: int, outfile: str) -> str:
+    ''' SiNPle .variants file (file_key) converted to a codon table once per file content, reference and frame '''
+    import run_manifest
+
+    return run_manifest.codon_table_path(variants[0], reference[0] if reference is not None else None, orf_start, outfile)
+
+
+@functools.lru_cache(maxsize = 16)
+def logo_matrix(path: str, size: int, mtime_ns: int, start: typing.Optional[int], end: typing.Optional[int]):
+    import logo_plot_standalone
+
+    return logo_plot_standalone.format_data(data_input = path, positions = (start, end))
+
+
+def run_analyses_job(job: dict) -> typing.List[str]:
+    import matplotlib.pyplot as plt
+    import run_manifest
+    from coordinates import file_key
+
+    params = dict(run_manifest.DEFAULT_PARAMS)
+    params.update({key: value for key, value in job.get('params', {}).items() if key in run_manifest.DEFAULT_PARAMS})
+    analyses = job.get('analyses', run_manifest.DEFAULT_ANALYSES)
+    unknown = [name for name in analyses if name not in run_manifest.ANALYSES]
+    if unknown:
+        raise ValueError('unknown analyses {}, choose from: {}'.format(', '.join(unknown), ', '.join(run_manifest.ANALYSES)))
+    outdir = job['outdir']
+    os.makedirs(outdir, exist_ok = True)
+
+    samples = job['samples']
+    names = [sample['sample'] for sample in samples]
+    sample_paths = {sample['sample']: sample['path'] for sample in samples}
+    for name, path in sample_paths.items():
+        if path.endswith('.variants'):
+            outfile = os.path.abspath(os.path.join(outdir, '{}.codon'.format(name)))
+            if not os.path.exists(outfile):
+                converted_table.cache_clear() # an earlier conversion was removed
+            reference = file_key(params['reference']) if params['reference'] is not None else None
+            sample_paths[name] = converted_table(file_key(path), reference, params['orfStart'], outfile)
+    colors = {sample['sample']: sample.get('color', run_manifest.CB_PALETTE[index % len(run_manifest.CB_PALETTE)])
+              for index, sample in enumerate(samples)}
+    replicate_groups = {}
+    for sample in samples:
+        replicate_groups.setdefault(sample.get('replicate_group') or sample['sample'], []).append(sample['sample'])
+    timepoints = {sample['sample']: float(sample['passage']) for sample in samples if sample.get('passage') is not None}
+    thresholds = (('minQ', params['qual']), ('minAlt', params['counts']), ('codonRange', params['pos']), ('strandBiasP', params['strandBiasP']),
+                  ('maxSOR', params['maxSOR']), ('minFreq', params['minFreq']), ('depthWindow', params['depthWindow']))
+    # shallow copies, so an analysis adding or dropping columns cannot change the cached tables
+    df_hash = {name: filtered_table(*file_key(sample_paths[name]), thresholds).copy(deep = False) for name in names}
+
+    outputs = []
+    for name in analyses:
+        run_manifest.call_analysis(name, df_hash, sample_paths, colors, replicate_groups, params, outdir, timepoints)
+        plt.close('all')
+        outputs += [os.path.join(outdir, output) for output in run_manifest.ANALYSES[name]['outputs'](names, params)]
+    return outputs
+
+
+def run_logo_job(job: dict) -> typing.List[str]:
+    import matplotlib.pyplot as plt
+    import logo_plot_standalone
+    from coordinates import file_key
+
+    start, end = job.get('codonStartPos'), job.get('codonEndPos')
+    matrix = logo_matrix(*file_key(job['input']), start, end)
+    outdir = os.path.abspath(job.get('outdir', '.'))
+    os.makedirs(outdir, exist_ok = True)
+    annotations = os.path.abspath(job['annotConfig']) if job.get('annotConfig') else None
+    sample_name = job.get('sampleName', 'sample_1')
+    # generate_logo_plot writes into the working directory; a worker runs one job at a time
+    cwd = os.getcwd()
+    os.chdir(outdir)
+    try:
+        logo_plot_standalone.generate_logo_plot(matrix_input = matrix, sample_name = sample_name, annotations = annotations,
+                                                increment = job.get('aaSpacing', 65), min_label_len = job.get('minAnnotLabel', 7),
+                                                start_pos = start, end_pos = end)
+    finally:
+        os.chdir(cwd)
+        plt.close('all')
+    return [os.path.join(outdir, '{}_logoplot_of_diversity_of_amino_acids_present_per_codon_position.png'.format(sample_name))]
+
+
+JOB_TYPES = {'analyses': run_analyses_job, 'logo': run_logo_job}
+
+
+def run_job(job: dict) -> dict:
+    ''' output: dict with the outputs written and the compute time of the job '''
+    start = time.perf_counter()
+    outputs = JOB_TYPES[job['type']](job)
+    return {'outputs': outputs, 'seconds': round(time.perf_counter() - start, 3)}
+
+
+# ---- server side ----
+
+class JobQueue:
+    '''
+    input: number of worker processes; maximum number of accepted (queued plus running) jobs
+
+    submit() hands a job to the process pool and returns its id, or None when maxQueue jobs are already pending;
+    it raises (releasing the slot) when the pool cannot take jobs.
+    '''
+
+    def __init__(self, workers: int, max_queue: int):
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = warm_worker)
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max_queue)
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.finished = []
+        # start every worker now, so the import cost is paid before the first job arrives
+        for future in [self.executor.submit(ping) for _ in range(workers)]:
+            future.result()
+
+    def submit(self, job: dict) -> typing.Optional[str]:
+        if not self.slots.acquire(blocking = False):
+            return None
+        job_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            try:
+                future = self.executor.submit(run_job, job)
+            except Exception:
+                # e.g. BrokenProcessPool after a worker died; the job never runs, so its slot is free again
+                self.slots.release()
+                raise
+            self.jobs[job_id] = {'id': job_id, 'type': job['type'], 'state': 'queued', 'submitted': time.time(), 'future': future}
+        future.add_done_callback(functools.partial(self.done, job_id))
+        return job_id
+
+    def done(self, job_id: str, future: concurrent.futures.Future) -> None:
+        self.slots.release()
+        with self.lock:
+            record = self.jobs[job_id]
+            try:
+                record.update(future.result(), state = 'done')
+            except Exception as error:
+                record.update(state = 'failed', error = ''.join(traceback.format_exception_only(type(error), error)).strip())
+            record['finished'] = time.time()
+            self.finished.append(job_id)
+            while len(self.finished) > FINISHED_JOBS_KEPT:
+                self.jobs.pop(self.finished.pop(0), None)
+
+    def state(self, job_id: str) -> typing.Optional[dict]:
+        with self.lock:
+            record = self.jobs.get(job_id)
+            if record is None:
+                return None
+            if record['state'] == 'queued' and record['future'].running():
+                record['state'] = 'running'
+            return {key: value for key, value in record.items() if key != 'future'}
+
+    def wait(self, job_id: str) -> dict:
+        concurrent.futures.wait([self.jobs[job_id]['future']])
+        # the done callback may still be recording the result
+        while self.state(job_id)['state'] in ['queued', 'running']:
+            time.sleep(0.01)
+        return self.state(job_id)
+
+    def health(self) -> dict:
+        with self.lock:
+            pending = sum(record['state'] in ['queued', 'running'] for record in self.jobs.values())
+        return {'workers': self.workers, 'pending': pending, 'max_queue': self.max_queue}
+
+
+class AnalysisRequestHandler(http.server.BaseHTTPRequestHandler):
+    queue = None # JobQueue, set by serve()
+
+    def reply(self, status: int, body: dict, headers: typing.Optional[dict] = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path == '/health':
+            self.reply(200, self.queue.health())
+        elif self.path.startswith('/jobs/'):
+            state = self.queue.state(self.path[len('/jobs/'):])
+            self.reply(200, state) if state is not None else self.reply(404, {'error': 'unknown job'})
+        else:
+            self.reply(404, {'error': 'unknown path'})
+
+    def do_POST(self) -> None:
+        path, _, query = self.path.partition('?')
+        if path != '/jobs':
+            self.reply(404, {'error': 'unknown path'})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if job.get('type') not in JOB_TYPES:
+                raise ValueError('type must be one of {}'.format(', '.join(JOB_TYPES)))
+        except (ValueError, AttributeError) as error:
+            self.reply(400, {'error': str(error)})
+            return
+        try:
+            job_id = self.queue.submit(job)
+        except Exception as error:
+            self.reply(500, {'error': 'cannot submit job: {}'.format(''.join(traceback.format_exception_only(type(error), error)).strip())})
+            return
+        if job_id is None:
+            self.reply(503, {'error': 'queue full'}, headers = {'Retry-After': '5'})
+        elif 'wait=1' in query.split('&'):
+            self.reply(200, self.queue.wait(job_id))
+        else:
+            self.reply(202, {'id': job_id})
+
+    def log_message(self, format: str, *args) -> None:
+        pass # one line per request would drown the job log of a busy LIMS
+
+
+def serve(host: str, port: int, workers: int, max_queue: int) -> None:
+    AnalysisRequestHandler.queue = JobQueue(workers = workers, max_queue = max_queue)
+    server = http.server.ThreadingHTTPServer((host, port), AnalysisRequestHandler)
+    print('serving analysis jobs on http://{}:{} with {} workers'.format(host, port, workers), flush = True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        AnalysisRequestHandler.queue.executor.shutdown(cancel_futures = True)
+
+
+def submit_job(url: str, job: dict, wait: bool = True) -> dict:
+    '''
+    input: server url (e.g. http://127.0.0.1:8765), job as described above, whether to wait for it to finish
+    output: final job state when waiting, else {'id': job id}; raises urllib.error.HTTPError on 400/503
+    '''
+    request = urllib.request.Request(url.rstrip('/') + '/jobs' + ('?wait=1' if wait else ''), data = json.dumps(job).encode(),
+                                     headers = {'Content-Type': 'application/json'}, method = 'POST')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Serves plotting jobs from a pool of warm worker processes on a localhost HTTP endpoint',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default = '127.0.0.1', type = str, help = 'address to listen on; keep it local, jobs can read and write any path the server can')
+    parser.add_argument('--port', default = 8765, type = int, help = 'port to listen on (or of the server to --submit to)')
+    parser.add_argument('--workers', default = 2, type = int, help = 'number of worker processes')
+    parser.add_argument('--maxQueue', default = 16, type = int, help = 'maximum number of queued plus running jobs; further jobs are refused with 503')
+    parser.add_argument('--submit', default = None, type = str, help = 'instead of serving, submit this JSON job file to a running server and wait for it')
+    args = parser.parse_args()
+
+    if args.submit is not None:
+        with open(args.submit, 'r') as handle:
+            result = submit_job('http://{}:{}'.format(args.host, args.port), json.load(handle))
+        print(json.dumps(result, indent = 1))
+        if result['state'] != 'done':
+            raise SystemExit(1)
+    else:
+        serve(args.host, args.port, args.workers, args.maxQueue)
@@ -0,0 +1,406 @@
+import pandas
+import argparse
+import typing
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy
+
+'''
+Numerical equivalence and performance budget checks of the analysis code against frozen golden outputs.
+
+The fixtures in ref/golden are small inputs built on the real pCHIKV_AF15561 reference (ORF start 9821): a virVar
+codon table, the SiNPle .variants file of the same region and a logo input matrix.  Every check runs one analysis
+function on them and returns named tables (filtered table, per-codon nucleotide / amino acid change aggregates,
+amino acid frequency matrix, logo matrix, SiNPle conversion and annotation, property and substitution spectra).
+The plotting functions of the main script return the per-codon tables they plot (nucleotide and amino acid change
+frequencies, amino acid diversity, the count and frequency matrices of the logo plots), which are checked as well.
+Tables are compared with the golden csv in ref/golden/expected: same columns and rows, strings equal and numbers
+within --rtol/--atol.
+
+Every check also has a budget in ref/golden/budgets.json, wall time (an untraced run) and peak memory allocated
+by python (tracemalloc, a second run); a check fails when it exceeds either, so an "acceleration" that quietly
+changes numbers or a code path that regresses is caught before results go into a paper.
+
+    python3 check_golden_outputs.py                     # compare against the goldens, exit 1 on any failure
+    python3 check_golden_outputs.py --only filter,per_codon_summary
+    python3 check_golden_outputs.py --update            # re-freeze goldens and budgets after an intended change
+    python3 check_golden_outputs.py --baseline c1c50e4  # freeze the goldens of BASELINE_CHECKS from an older revision
+
+--update writes budgets of --budgetFactor times the measured time and memory (with a floor); review the diff of
+ref/golden before committing it.  The fixtures themselves are committed and only rebuilt with --makeFixtures, so
+the goldens do not depend on the random number streams of a numpy version.
+
+--baseline REV freezes the goldens of the checks that existed before the rewrites (filter, the standalone logo
+matrix and the plot script tables) by running the implementations of git revision REV, so the current code is
+checked against the original numbers rather than against itself.  The original plot functions only plot their
+tables; they are read from the local variables of the function when it returns.
+'''
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_DIR = os.path.join(os.path.dirname(CODE_DIR), 'ref', 'golden')
+REFERENCE = os.path.join(os.path.dirname(CODE_DIR), 'ref', 'pCHIKV_AF15561.fasta')
+ORF_START = 9821
+FIXTURE_CODONS = 40
+
+# budget floors, so tiny checks do not fail on scheduler noise
+MIN_SECONDS = 0.5
+MIN_PEAK_MB = 5.0
+
+
+def fixture_path(name: str) -> str:
+    return os.path.join(GOLDEN_DIR, name)
+
+
+def make_fixtures(seed: int = 0) -> None:
+    '''
+    writes fixture.codon, fixture.variants and fixture_logo.csv into ref/golden: FIXTURE_CODONS codons of the real
+    reference with random variant counts, strand splits and qualities (some below the default filter thresholds)
+    '''
+    from codon_tables import CODONS, CODON_TO_AA, CODON_TABLE_COLUMNS
+    from coordinates import CodingRegion, read_reference
+
+    rng = numpy.random.default_rng(seed)
+    region = CodingRegion.from_fasta(REFERENCE, orf_start = ORF_START)
+    rows = []
+    for position in range(1, FIXTURE_CODONS + 1):
+        ref_codon = CODONS[region.codon_ref_code[position]]
+        depth = int(rng.integers(2000, 30000))
+        fwd_depth = int(depth * rng.uniform(0.3, 0.7))
+        alts = rng.choice([codon for codon in CODONS if codon != ref_codon], size = 7, replace = False)
+        for codon in [ref_codon] + list(alts):
+            cnt = depth - int(depth * 0.2) if codon == ref_codon else int(rng.integers(5, 600))
+            fwd = int(rng.binomial(cnt, rng.choice([fwd_depth / depth, 0.05]) if codon != ref_codon else fwd_depth / depth))
+            fwd_qual, rev_qual = rng.uniform(18, 38, size = 2)
+            rows.append({'POSITION': position, 'REF_CODON': ref_codon, 'CODON': codon, 'REF_AA': CODON_TO_AA[ref_codon], 'AA': CODON_TO_AA[codon],
+                         'CNT': cnt, 'DENOM': depth, 'FREQ': cnt / depth, 'FWD_CNT': fwd, 'REV_CNT': cnt - fwd, 'FWD_DENOM': fwd_depth,
+                         'REV_DENOM': depth - fwd_depth, 'FWD_MEAN_MIN_QUAL': round(fwd_qual, 4), 'REV_MEAN_MIN_QUAL': round(rev_qual, 4),
+                         'FWD_STDDEV_MIN_QUAL': round(rng.uniform(2, 5), 4), 'REV_STDDEV_MIN_QUAL': round(rng.uniform(2, 5), 4)})
+    pandas.DataFrame(rows, columns = CODON_TABLE_COLUMNS).to_csv(fixture_path('fixture.codon'), sep = '\t', index = False)
+
+    sequence = read_reference(REFERENCE)
+    with open(fixture_path('fixture.variants'), 'w') as handle:
+        for pos in range(ORF_START - 1, ORF_START + 3 * FIXTURE_CODONS):
+            ref_base = sequence[pos - 1]
+            depth = int(rng.integers(2000, 30000))
+            fields = ['pCHIKV_AF15561', str(pos)]
+            alts = rng.choice([base for base in 'ACGT' if base != ref_base], size = int(rng.integers(0, 3)), replace = False)
+            alt_reads = [int(rng.integers(5, 400)) for _ in alts]
+            for base, reads in [(ref_base, depth - sum(alt_reads))] + list(zip(alts, alt_reads)):
+                fields += [base, str(reads), '{:.4f}'.format(rng.uniform(20, 38)), '{:.6g}'.format(rng.uniform(0, 1))]
+            handle.write('\t'.join(fields) + '\n')
+
+    logo_rows = [{'POSITION': position, 'AA': aa, 'MERGE_FRAC': round(float(rng.uniform(0, 0.2)), 6)}
+                 for position in range(1, FIXTURE_CODONS + 1) for aa in rng.choice(list('ACDEFGHIKLMNPQRSTVWY'), size = 5, replace = False)]
+    pandas.DataFrame(logo_rows).to_csv(fixture_path('fixture_logo.csv'), index = False)
+
+
+def fixture_table():
+    from codon_tables import load_codon_table
+    return load_codon_table(fixture_path('fixture.codon'))
+
+
+def filtered_fixture():
+    from plot_mutational_frequency_and_qc_stats import filter
+    return filter(fixture_table(), minQ = 24.0, minAlt = 100, codonRange = '3-38')
+
+
+# ---- checks: name -> function(workdir) returning a dict of table name -> dataframe ({} for plot checks) ----
+
+def check_filter(workdir: str) -> dict:
+    return {'filter': filtered_fixture()}
+
+
+def check_filter_strand(workdir: str) -> dict:
+    import variant_filters
+    filtered, report = variant_filters.apply_filters(fixture_table(), minQ = 24.0, minAlt = 100, codonRange = '0-0',
+                                                     strandBiasP = 0.01, maxSOR = 3.0, minFreq = 0.005, depthWindow = 5)
+    return {'filter_strand': filtered, 'filter_strand_report': report.reset_index()}
+
+
+def check_per_codon_summary(workdir: str) -> dict:
+    from codon_tables import per_codon_summary
+    return {'per_codon_summary': per_codon_summary(filtered_fixture()).reset_index()}
+
+
+def check_aa_frequency_matrix(workdir: str) -> dict:
+    from codon_tables import aa_frequency_matrix
+    return {'aa_frequency_matrix': aa_frequency_matrix(filtered_fixture()).reset_index()}
+
+
+def check_logo_matrix(workdir: str) -> dict:
+    from logo_plot_standalone import format_data
+    return {'logo_matrix': format_data(fixture_path('fixture_logo.csv')).reset_index()}
+
+
+def check_sinple_conversion(workdir: str) -> dict:
+    from sinple_to_codon import convert_sinple
+    outfile = os.path.join(workdir, 'fixture_sinple.codon')
+    convert_sinple(variants = fixture_path('fixture.variants'), reference = REFERENCE, orf_start = ORF_START, outfile = outfile)
+    return {'sinple_conversion': pandas.read_csv(outfile, sep = '\t')}
+
+
+def check_physicochemical(workdir: str) -> dict:
+    from aa_properties import property_change_spectra
+    per_codon, per_sample = property_change_spectra(filtered_fixture())
+    return {'physicochemical_per_codon': per_codon.reset_index(), 'physicochemical_per_sample': per_sample.rename_axis('change').reset_index()}
+
+
+def check_substitution_spectrum(workdir: str) -> dict:
+    from substitution_spectrum import spectrum_tables
+    spectrum, tstv_table = spectrum_tables(filtered_fixture(), 10)
+    return {'substitution_spectrum': spectrum, 'substitution_tstv': tstv_table}
+
+
+def per_codon_table(df: pandas.DataFrame) -> pandas.DataFrame:
+    ''' output: codon position indexed table of a plot function as a POSITION column, rows and columns sorted '''
+    df = df.sort_index()
+    return df[sorted(df.columns)].rename_axis('POSITION').reset_index()
+
+
+def plot_check(name: str, function_name: str, **kwargs) -> typing.Callable[[str], dict]:
+    ''' output: check running the df_hash based plotting function of the main script on the fixture, returning the table it plots '''
+    def check(workdir: str) -> dict:
+        import matplotlib.pyplot as plt
+        import plot_mutational_frequency_and_qc_stats as dms_plots
+        tables = getattr(dms_plots, function_name)(df_hash = {'fixture': filtered_fixture()}, outdir = workdir, **kwargs)
+        plt.close('all')
+        return {name: per_codon_table(tables['fixture'])}
+    return check
+
+
+def check_sinple_annotation(workdir: str) -> dict:
+    from coordinates import CodingRegion
+    from translations_and_merging import read_variants, merge_reference, annotate_variants
+    region = CodingRegion.from_fasta(REFERENCE, orf_start = ORF_START, region_start = ORF_START - 1, region_end = ORF_START + 3 * FIXTURE_CODONS)
+    variants, reps = read_variants(fixture_path('fixture.variants'))
+    return {'sinple_annotation': annotate_variants(merge_reference(variants, region), region, reps)}
+
+
+def check_logo_plot(workdir: str) -> dict:
+    import matplotlib.pyplot as plt
+    from logo_plot_standalone import format_data, generate_logo_plot
+    cwd = os.getcwd()
+    os.chdir(workdir) # generate_logo_plot writes into the working directory
+    try:
+        generate_logo_plot(matrix_input = format_data(fixture_path('fixture_logo.csv')), sample_name = 'fixture', annotations = None,
+                           increment = 20, min_label_len = 7)
+    finally:
+        os.chdir(cwd)
+        plt.close('all')
+    return {}
+
+
+CHECKS = {'filter': check_filter,
+          'filter_strand': check_filter_strand,
+          'per_codon_summary': check_per_codon_summary,
+          'aa_frequency_matrix': check_aa_frequency_matrix,
+          'logo_matrix': check_logo_matrix,
+          'sinple_conversion': check_sinple_conversion,
+          'physicochemical': check_physicochemical,
+          'substitution_spectrum': check_substitution_spectrum,
+          'sinple_annotation': check_sinple_annotation,
+          'plot_nt_mutations': plot_check('plot_nt_mutations', 'get_per_codon_ntNum_mutational_freq', colors = {'fixture': '#999999'}),
+          'plot_aa_type': plot_check('plot_aa_type', 'get_per_codon_aaTypeChange_mutational_freq', colors = {'fixture': '#999999'}),
+          'plot_aa_diversity': plot_check('plot_aa_diversity', 'get_aa_diversity', colors = {'fixture': '#999999'}),
+          'plot_information_logo': plot_check('plot_information_logo', 'get_per_codon_aa_mutational_information_logoplot', nonsynOnly = False),
+          'plot_freq_logo': plot_check('plot_freq_logo', 'get_per_codon_aa_mutational_freq_logoplot', nonsynOnly = False, includeStop = False, annot = False),
+          'plot_logo_standalone': check_logo_plot}
+
+
+# ---- goldens from an older revision: check name -> function(modules) returning the same tables as the check ----
+
+def baseline_module(revision: str, filename: str, workdir: str):
+    ''' output: module of code/<filename> as of git revision, imported under a separate name from workdir '''
+    import importlib.util
+    source = subprocess.run(['git', 'show', '{}:code/{}'.format(revision, filename)], cwd = CODE_DIR, check = True, capture_output = True, text = True).stdout
+    path = os.path.join(workdir, 'baseline_{}'.format(filename))
+    with open(path, 'w') as handle:
+        handle.write(source)
+    spec = importlib.util.spec_from_file_location('baseline_{}'.format(filename[:-3]), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def returned_locals(function: typing.Callable, **kwargs) -> dict:
+    ''' output: local variables of function when it returns, for implementations that only plot their tables '''
+    captured = {}
+    def profile(frame, event, arg):
+        if event == 'return' and frame.f_code is function.__code__:
+            captured.update(frame.f_locals)
+    sys.setprofile(profile)
+    try:
+        function(**kwargs)
+    finally:
+        sys.setprofile(None)
+    return captured
+
+
+def baseline_tables(revision: str, names: list, workdir: str) -> dict:
+    '''
+    output: table name -> table of the checks in names that have an implementation in revision, computed by it;
+            the fixture is read and filtered as the main script of revision did
+    '''
+    import matplotlib.pyplot as plt
+    from codon_tables import LOAD_COLUMNS
+
+    plots = baseline_module(revision, 'plot_mutational_frequency_and_qc_stats.py', workdir)
+    logos = baseline_module(revision, 'logo_plot_standalone.py', workdir)
+    def fixture(copies: int = 1) -> dict:
+        df = plots.filter(df = pandas.read_csv(fixture_path('fixture.codon'), sep = '\t'), minQ = 24.0, minAlt = 100, codonRange = '3-38')
+        return {'fixture' if copy == 0 else 'fixture_{}'.format(copy): df.copy() for copy in range(copies)}
+    colors = {'fixture': '#999999', 'fixture_1': '#E69F00', 'fixture_2': '#56B4E9'}
+    plots.colors = colors # the original nucleotide change plot reads the colors of its __main__
+
+    builders = {'filter': lambda: {'filter': fixture()['fixture'][LOAD_COLUMNS]},
+                'logo_matrix': lambda: {'logo_matrix': logos.format_data(fixture_path('fixture_logo.csv')).reset_index()},
+                'plot_nt_mutations': lambda: {'plot_nt_mutations': per_codon_table(returned_locals(plots.get_per_codon_ntNum_mutational_freq, df_hash = fixture(), outdir = workdir)['mut_freqs_df'])},
+                # the original sample overlay legend needs three samples
+                'plot_aa_type': lambda: {'plot_aa_type': per_codon_table(returned_locals(plots.get_per_codon_aaTypeChange_mutational_freq, df_hash = fixture(3), colors = colors, outdir = workdir)['combined_samples']['fixture'])},
+                'plot_aa_diversity': lambda: {'plot_aa_diversity': per_codon_table(returned_locals(plots.get_aa_diversity, df_hash = fixture(), colors = colors, outdir = workdir)['mut_freqs_df'])},
+                'plot_information_logo': lambda: {'plot_information_logo': per_codon_table(returned_locals(plots.get_per_codon_aa_mutational_information_logoplot, df_hash = fixture(), nonsynOnly = False, outdir = workdir)['mut_freqs_df'])},
+                'plot_freq_logo': lambda: {'plot_freq_logo': per_codon_table(returned_locals(plots.get_per_codon_aa_mutational_freq_logoplot, df_hash = fixture(), nonsynOnly = False, includeStop = False, annot = False, outdir = workdir)['mut_freqs_df'])}}
+    tables = {}
+    for name in names:
+        if name in builders:
+            tables.update(builders[name]())
+            plt.close('all')
+    return tables
+
+
+def freeze_baseline(revision: str, names: list) -> typing.List[str]:
+    ''' writes the goldens of the checks in names that exist in revision from its implementations; output: table names written '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+    workdir = tempfile.mkdtemp(prefix = 'golden_baseline_')
+    try:
+        tables = baseline_tables(revision, names, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+    for table_name, table in tables.items():
+        normalized(table).to_csv(os.path.join(GOLDEN_DIR, 'expected', '{}.csv'.format(table_name)), index = False)
+    return list(tables)
+
+
+def normalized(df: pandas.DataFrame) -> pandas.DataFrame:
+    ''' round trip through csv so observed tables have the dtypes of goldens read back from disk '''
+    return pandas.read_csv(io.StringIO(df.to_csv(index = False)))
+
+
+def compare_tables(expected: pandas.DataFrame, observed: pandas.DataFrame, rtol: float, atol: float) -> typing.List[str]:
+    ''' output: list of differences, empty when the tables agree within tolerance '''
+    if list(expected.columns) != list(observed.columns):
+        return ['columns differ: expected {}, got {}'.format(list(expected.columns), list(observed.columns))]
+    if len(expected) != len(observed):
+        return ['rows differ: expected {}, got {}'.format(len(expected), len(observed))]
+    problems = []
+    for column in expected.columns:
+        left, right = expected[column], observed[column]
+        if pandas.api.types.is_numeric_dtype(left) and pandas.api.types.is_numeric_dtype(right):
+            close = numpy.isclose(left.to_numpy(dtype = numpy.float64), right.to_numpy(dtype = numpy.float64), rtol = rtol, atol = atol, equal_nan = True)
+        else:
+            close = ((left.astype(str) == right.astype(str)) | (left.isna() & right.isna())).to_numpy() # the str dtype keeps nan
+        if not close.all():
+            row = int(numpy.flatnonzero(~close)[0])
+            problems.append('{}: {} rows differ, first at row {} (expected {}, got {})'.format(column, int((~close).sum()), row, left.iloc[row], right.iloc[row]))
+    return problems
+
+
+def measure(check: typing.Callable[[str], dict], workdir: str) -> typing.Tuple[dict, float, float]:
+    ''' output: (tables, seconds of an untraced run, peak MB allocated during a second, traced run) '''
+    start = time.perf_counter()
+    tables = check(workdir)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        check(workdir)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    return tables, seconds, peak_mb
+
+
+def run_checks(names: list, update: bool, rtol: float, atol: float, budget_factor: float) -> pandas.DataFrame:
+    '''
+    output: one row per check with its time, peak memory, budgets and status ('ok', 'updated' or the failures)
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+    expected_dir = os.path.join(GOLDEN_DIR, 'expected')
+    budget_file = os.path.join(GOLDEN_DIR, 'budgets.json')
+    budgets = json.load(open(budget_file)) if os.path.exists(budget_file) else {}
+    os.makedirs(expected_dir, exist_ok = True)
+    results = []
+    workdir = tempfile.mkdtemp(prefix = 'golden_')
+    try:
+        for name in names:
+            try:
+                tables, seconds, peak_mb = measure(CHECKS[name], workdir)
+            except Exception as error:
+                results.append({'check': name, 'seconds': numpy.nan, 'peak_mb': numpy.nan, 'status': 'error: {!r}'.format(error)})
+                continue
+            problems = []
+            if update:
+                for table_name, table in tables.items():
+                    normalized(table).to_csv(os.path.join(expected_dir, '{}.csv'.format(table_name)), index = False)
+                budgets[name] = {'seconds': round(max(MIN_SECONDS, seconds * budget_factor), 3), 'peak_mb': round(max(MIN_PEAK_MB, peak_mb * budget_factor), 1)}
+            else:
+                for table_name, table in tables.items():
+                    golden = os.path.join(expected_dir, '{}.csv'.format(table_name))
+                    if not os.path.exists(golden):
+                        problems.append('{}: no golden table, run with --update'.format(table_name))
+                        continue
+                    problems += ['{}: {}'.format(table_name, problem) for problem in compare_tables(pandas.read_csv(golden), normalized(table), rtol, atol)]
+                budget = budgets.get(name)
+                if budget is None:
+                    problems.append('no budget, run with --update')
+                else:
+                    if seconds > budget['seconds']:
+                        problems.append('time {:.2f}s over budget {:.2f}s'.format(seconds, budget['seconds']))
+                    if peak_mb > budget['peak_mb']:
+                        problems.append('peak memory {:.1f}MB over budget {:.1f}MB'.format(peak_mb, budget['peak_mb']))
+            results.append({'check': name, 'seconds': round(seconds, 3), 'peak_mb': round(peak_mb, 1),
+                            'budget_seconds': budgets.get(name, {}).get('seconds'), 'budget_peak_mb': budgets.get(name, {}).get('peak_mb'),
+                            'status': 'updated' if update else ('ok' if not problems else '; '.join(problems))})
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+    if update:
+        with open(budget_file, 'w') as handle:
+            json.dump(budgets, handle, indent = 1, sort_keys = True)
+    return pandas.DataFrame(results, columns = ['check', 'seconds', 'peak_mb', 'budget_seconds', 'budget_peak_mb', 'status'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Checks analysis outputs against frozen golden tables and time/memory budgets',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--only', default = None, type = str, help = 'comma-separated list of checks to run; choose from {}'.format(', '.join(CHECKS)))
+    parser.add_argument('--update', action = 'store_true', help = 'rewrite the golden tables and budgets from the current code instead of checking')
+    parser.add_argument('--makeFixtures', action = 'store_true', help = 'rebuild the fixture inputs in ref/golden (implies --update)')
+    parser.add_argument('--baseline', default = None, type = str, help = 'git revision whose implementations the goldens of the original analyses are frozen from (implies --update for the others)')
+    parser.add_argument('--rtol', default = 1e-6, type = float, help = 'relative tolerance of numeric columns')
+    parser.add_argument('--atol', default = 1e-9, type = float, help = 'absolute tolerance of numeric columns')
+    parser.add_argument('--budgetFactor', default = 3.0, type = float, help = '--update: budgets are this multiple of the measured time and memory')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.only.split(',')] if args.only is not None else list(CHECKS)
+    unknown = [name for name in names if name not in CHECKS]
+    if unknown:
+        raise SystemExit('unknown checks {}; choose from {}'.format(', '.join(unknown), ', '.join(CHECKS)))
+    if args.makeFixtures:
+        os.makedirs(GOLDEN_DIR, exist_ok = True)
+        make_fixtures()
+    results = run_checks(names, update = args.update or args.makeFixtures or args.baseline is not None, rtol = args.rtol, atol = args.atol, budget_factor = args.budgetFactor)
+    print(results.to_string(index = False))
+    if args.baseline is not None:
+        print('goldens frozen from {}: {}'.format(args.baseline, ', '.join(freeze_baseline(args.baseline, names))))
+    if not results['status'].isin(['ok', 'updated']).all():
+        raise SystemExit(1)
@@ -0,0 +1,160 @@
+import pandas
+import argparse
+import typing
+import json
+import os
+import numpy
+
+from codon_tables import load_codon_table
+
+'''
+Position-indexed columnar store for codon tables (requires pyarrow).
+
+Every table is sorted by POSITION and written as a parquet file with one row group per block of
+--codonsPerGroup consecutive codons; parquet keeps the min/max POSITION of every row group in the file
+footer.  Reading a codon window (an epitope, a domain, --pos) then only decodes the row groups whose
+min/max overlap the window instead of parsing and masking the whole table.  A store is a directory with one
+<sample>.parquet per sample and a store_index.json listing the samples and the position range of every
+row group.
+
+Codon tables are converted with load_codon_table(), so they keep the compact schema (categorical codon
+and amino acid columns); .csv inputs are any comma-separated table with a POSITION column, e.g. the
+input matrix of logo_plot_standalone.py.
+
+    python3 codon_store.py --data wtDNA_S16_cleaned.codon,mutDNA_S15_cleaned.codon --samplename wtDNA,mutDNA --outdir codon_store
+
+The .parquet files can be given anywhere a codon table path is accepted (--data, manifest paths,
+logo_plot_standalone.py --input); from python use query_store() or read_position_range().
+'''
+
+STORE_INDEX = 'store_index.json'
+
+
+def write_sorted_table(df: pandas.DataFrame, outfile: str, codons_per_group: int = 50) -> typing.List[typing.List[int]]:
+    '''
+    input: table with a POSITION column, path of the parquet file to write, codons per row group
+    output: list of [min position, max position, rows] of every row group written
+    '''
+    import pyarrow
+    import pyarrow.parquet
+
+    df = df.sort_values('POSITION', kind = 'stable').reset_index(drop = True)
+    positions = df['POSITION'].to_numpy()
+    groups = []
+    if len(positions):
+        block = (positions - positions[0]) // codons_per_group
+        splits = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(block)) + 1, [len(positions)]])
+    else:
+        splits = numpy.array([0, 0])
+    table = pyarrow.Table.from_pandas(df, preserve_index = False)
+    tmp_outfile = outfile + '.tmp'
+    with pyarrow.parquet.ParquetWriter(tmp_outfile, table.schema, compression = 'zstd', write_statistics = True) as writer:
+        # every write_table call is flushed as its own row group
+        for first, last in zip(splits[:-1], splits[1:]):
+            writer.write_table(table.slice(first, last - first))
+            if last > first:
+                groups.append([int(positions[first]), int(positions[last - 1]), int(last - first)])
+    os.replace(tmp_outfile, outfile)
+    return groups
+
+
+def row_groups_in_range(parquet_file, start: typing.Optional[int], end: typing.Optional[int]) -> typing.List[int]:
+    '''
+    input: pyarrow.parquet.ParquetFile; inclusive codon range, either end may be None
+    output: indices of the row groups whose POSITION min/max statistics overlap the range
+    '''
+    metadata = parquet_file.metadata
+    position_column = parquet_file.schema_arrow.get_field_index('POSITION')
+    selected = []
+    for group in range(metadata.num_row_groups):
+        statistics = metadata.row_group(group).column(position_column).statistics
+        if statistics is None or not statistics.has_min_max:
+            selected.append(group) # no statistics, cannot be skipped
+            continue
+        if (start is None or statistics.max >= start) and (end is None or statistics.min <= end):
+            selected.append(group)
+    return selected
+
+
+def read_position_range(path: str, positions: typing.Optional[typing.Tuple[typing.Optional[int], typing.Optional[int]]] = None,
+                        columns: typing.Optional[list] = None) -> pandas.DataFrame:
+    '''
+    input: path to a parquet table written by write_sorted_table(); optional inclusive (start, end) codon range,
+           either end may be None; optional columns to read (columns not in the file are ignored)
+    output: dataframe of the rows in the range, read from the overlapping row groups only
+    '''
+    import pyarrow.parquet
+
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    start, end = positions if positions is not None else (None, None)
+    names = parquet_file.schema_arrow.names
+    usecols = [column for column in columns if column in names] if columns is not None else None
+    if usecols is not None and 'POSITION' not in usecols and positions is not None:
+        read_columns = ['POSITION'] + usecols
+    else:
+        read_columns = usecols
+    df = parquet_file.read_row_groups(row_groups_in_range(parquet_file, start, end), columns = read_columns).to_pandas()
+    keep = numpy.ones(len(df), dtype = bool)
+    if start is not None:
+        keep &= (df['POSITION'] >= start).to_numpy()
+    if end is not None:
+        keep &= (df['POSITION'] <= end).to_numpy()
+    df = df.loc[keep].reset_index(drop = True)
+    return df[usecols] if usecols is not None else df
+
+
+def write_store(tables: dict, store_dir: str, codons_per_group: int = 50) -> dict:
+    '''
+    input: dict of sample -> path of a codon table (.csv files are read as comma-separated generic tables),
+           store directory (created if needed; existing samples are replaced), codons per row group
+    output: the updated store index (sample -> file name and row group ranges), also written to store_index.json
+    '''
+    os.makedirs(store_dir, exist_ok = True)
+    index = load_store_index(store_dir) if os.path.exists(os.path.join(store_dir, STORE_INDEX)) else {}
+    for sample, path in tables.items():
+        df = pandas.read_csv(path) if path.endswith('.csv') else load_codon_table(path)
+        filename = '{}.parquet'.format(sample)
+        groups = write_sorted_table(df, os.path.join(store_dir, filename), codons_per_group = codons_per_group)
+        index[sample] = {'file': filename, 'source': os.path.abspath(path), 'rows': int(len(df)), 'row_groups': groups}
+        print('{}: {} rows in {} row groups'.format(sample, len(df), len(groups)))
+    with open(os.path.join(store_dir, STORE_INDEX), 'w') as handle:
+        json.dump(index, handle, indent = 1)
+    return index
+
+
+def load_store_index(store_dir: str) -> dict:
+    with open(os.path.join(store_dir, STORE_INDEX), 'r') as handle:
+        return json.load(handle)
+
+
+def query_store(store_dir: str, positions: typing.Optional[typing.Tuple[typing.Optional[int], typing.Optional[int]]] = None,
+                samples: typing.Optional[list] = None, columns: typing.Optional[list] = None) -> dict:
+    '''
+    input: store directory; optional inclusive (start, end) codon range; optional list of samples (default all,
+           in store order); optional columns (default codon_tables.LOAD_COLUMNS for codon tables)
+    output: dict of sample -> codon table restricted to the range, in the compact schema, ready for the
+            df_hash based plotting functions
+    '''
+    index = load_store_index(store_dir)
+    samples = list(index) if samples is None else samples
+    missing = [sample for sample in samples if sample not in index]
+    if missing:
+        raise KeyError('samples not in store {}: {}'.format(store_dir, ', '.join(missing)))
+    return {sample: load_codon_table(os.path.join(store_dir, index[sample]['file']), columns = columns, positions = positions)
+            for sample in samples}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Converts codon tables into a position-indexed parquet store for fast codon range queries',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data', required = True, type = str, help = 'comma-separated list of codon tables (tab-separated) or .csv tables with a POSITION column')
+    parser.add_argument('--samplename', required = True, type = str, help = 'comma-separated list of sample names, same order as --data')
+    parser.add_argument('--outdir', required = True, type = str, help = 'store directory to write <sample>.parquet files and {} into'.format(STORE_INDEX))
+    parser.add_argument('--codonsPerGroup', default = 50, type = int, help = 'number of consecutive codon positions per row group; smaller groups make narrow queries read less')
+    args = parser.parse_args()
+
+    paths = [path.strip() for path in args.data.split(',')]
+    names = [name.strip() for name in args.samplename.split(',')]
+    if len(paths) != len(names):
+        raise SystemExit('--data and --samplename must list the same number of entries')
+    write_store(dict(zip(names, paths)), args.outdir, codons_per_group = args.codonsPerGroup)
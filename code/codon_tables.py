@@ -0,0 +1,240 @@
+import pandas
+import typing
+import itertools
+import numpy
+
+'''
+Shared helpers for virVar-style codon tables (one row per codon variant with at least the columns
+POSITION, REF_CODON, CODON, REF_AA, AA, CNT and DENOM).
+
+Codons are encoded as integers 0-63 in TCAG order (TTT=0, TTC=1, ..., GGG=63), which is also the
+order of the standard genetic code string below, so translation of an encoded codon is a single
+array lookup.  Stop codons translate to '.', matching the virVar AA column.
+'''
+
+NUCLEOTIDES = 'TCAG'
+CODONS = [''.join(codon) for codon in itertools.product(NUCLEOTIDES, repeat = 3)]
+GENETIC_CODE = 'FFLLSSSSYY..CC.WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+CODON_TO_AA = dict(zip(CODONS, GENETIC_CODE))
+AMINO_ACIDS = sorted(set(GENETIC_CODE)) # 20 amino acids plus '.' for stop
+CODON_AA = numpy.array(list(GENETIC_CODE)) # encoded codon -> amino acid symbol
+CODON_AA_INDEX = numpy.array([AMINO_ACIDS.index(aa) for aa in GENETIC_CODE]) # encoded codon -> index into AMINO_ACIDS
+
+# column order of codon tables as written by virVar; sinple_to_codon.py writes the same schema
+CODON_TABLE_COLUMNS = ['POSITION', 'REF_CODON', 'CODON', 'REF_AA', 'AA', 'CNT', 'DENOM', 'FREQ',
+                       'FWD_CNT', 'REV_CNT', 'FWD_DENOM', 'REV_DENOM',
+                       'FWD_MEAN_MIN_QUAL', 'REV_MEAN_MIN_QUAL', 'FWD_STDDEV_MIN_QUAL', 'REV_STDDEV_MIN_QUAL']
+
+# columns kept when loading a codon table; everything else (FREQ, caller specific extras) is dropped
+LOAD_COLUMNS = [column for column in CODON_TABLE_COLUMNS if column != 'FREQ']
+
+# compact in-memory schema: codon and amino acid strings are categoricals (REF_CODON/CODON and REF_AA/AA
+# share one category set each so they can be compared), counts are uint32 (float32 when a caller leaves
+# them empty, e.g. strand counts from SiNPle) and qualities float32
+COUNT_COLUMNS = ['CNT', 'DENOM', 'FWD_CNT', 'REV_CNT', 'FWD_DENOM', 'REV_DENOM']
+QUALITY_COLUMNS = ['FWD_MEAN_MIN_QUAL', 'REV_MEAN_MIN_QUAL', 'FWD_STDDEV_MIN_QUAL', 'REV_STDDEV_MIN_QUAL', 'FREQ']
+PAIRED_STRING_COLUMNS = [('REF_CODON', 'CODON'), ('REF_AA', 'AA')]
+
+AA_TYPES = ['synonymous', 'nonsynonymous', 'stop']
+
+
+def apply_schema(df: pandas.DataFrame) -> pandas.DataFrame:
+    '''
+    input: codon table as read by pandas
+    output: the same table (modified in place) with the compact dtypes described above
+    '''
+    if 'POSITION' in df.columns:
+        df['POSITION'] = df['POSITION'].astype(numpy.int32)
+    for column in COUNT_COLUMNS:
+        if column in df.columns:
+            values = pandas.to_numeric(df[column], errors = 'coerce')
+            if values.notna().all() and (values >= 0).all() and (values <= numpy.iinfo(numpy.uint32).max).all():
+                df[column] = values.astype(numpy.uint32)
+            else:
+                df[column] = values.astype(numpy.float32)
+    for column in QUALITY_COLUMNS:
+        if column in df.columns:
+            df[column] = pandas.to_numeric(df[column], errors = 'coerce').astype(numpy.float32)
+    for ref_column, alt_column in PAIRED_STRING_COLUMNS:
+        present = [column for column in (ref_column, alt_column) if column in df.columns]
+        if not present:
+            continue
+        categories = sorted(set().union(*[set(df[column].astype(str).unique()) for column in present]))
+        dtype = pandas.CategoricalDtype(categories)
+        for column in present:
+            df[column] = df[column].astype(str).astype(dtype)
+    return df
+
+
+def parse_codon_range(codonRange: str) -> typing.Optional[typing.Tuple[int, int]]:
+    '''
+    input: inclusive codon range as given on the command line, e.g. '9-397'
+    output: (start, end), or None for '0-0' which means all available positions
+    '''
+    start, end = [int(region.strip()) for region in codonRange.split('-')]
+    return None if (start, end) == (0, 0) else (start, end)
+
+
+def load_codon_table(path: str, columns: typing.Optional[list] = None,
+                     positions: typing.Optional[typing.Tuple[typing.Optional[int], typing.Optional[int]]] = None) -> pandas.DataFrame:
+    '''
+    input: path to a tab-separated codon table, or to a .parquet table written by codon_store.py; optional list of
+           columns to keep (default LOAD_COLUMNS); optional inclusive (start, end) codon range, either end may be None
+    output: codon table with only the requested columns and positions, in the compact schema of apply_schema()
+            (for .parquet tables only the row groups overlapping the range are read)
+    '''
+    columns = columns if columns is not None else LOAD_COLUMNS
+    if path.endswith('.parquet'):
+        from codon_store import read_position_range
+        return apply_schema(read_position_range(path, positions = positions, columns = columns))
+
+    header = pandas.read_csv(path, sep = '\t', nrows = 0).columns
+    usecols = [column for column in columns if column in header]
+    string_dtypes = {column: str for pair in PAIRED_STRING_COLUMNS for column in pair if column in usecols}
+    df = pandas.read_csv(path, sep = '\t', usecols = usecols, dtype = string_dtypes)
+    if positions is not None:
+        start, end = positions
+        keep = numpy.ones(len(df), dtype = bool)
+        if start is not None:
+            keep &= (df['POSITION'] >= start).to_numpy()
+        if end is not None:
+            keep &= (df['POSITION'] <= end).to_numpy()
+        df = df.loc[keep].reset_index(drop = True)
+    return apply_schema(df)
+
+
+def nt_mutation_counts(df: pandas.DataFrame) -> numpy.ndarray:
+    '''
+    output: int8 array with the number of bases that differ between REF_CODON and CODON of each row
+    '''
+    ref = df['REF_CODON'].astype(str).to_numpy().astype('S3').view(numpy.uint8).reshape(-1, 3)
+    alt = df['CODON'].astype(str).to_numpy().astype('S3').view(numpy.uint8).reshape(-1, 3)
+    return (ref != alt).sum(axis = 1).astype(numpy.int8)
+
+
+def aa_change_types(df: pandas.DataFrame) -> pandas.Series:
+    '''
+    output: categorical series (index aligned with df) of 'stop' where AA is '.', 'synonymous' where
+            REF_AA equals AA, otherwise 'nonsynonymous'
+    '''
+    ref_aa = df['REF_AA'].astype(str).to_numpy()
+    aa = df['AA'].astype(str).to_numpy()
+    codes = numpy.where(aa == '.', 2, numpy.where(ref_aa == aa, 0, 1))
+    return pandas.Series(pandas.Categorical.from_codes(codes, categories = AA_TYPES), index = df.index)
+
+
+def encode_codons(codons: pandas.Series) -> numpy.ndarray:
+    '''
+    input: series of codon strings (DNA or RNA, any case)
+    output: int array of codon codes 0-63; -1 for anything that is not a 3-letter A/C/G/T(U) codon
+    '''
+    codes = pandas.Series(numpy.arange(len(CODONS)), index = CODONS)
+    normalized = pandas.Series(codons, copy = False).astype(str).str.upper().str.replace('U', 'T')
+    return normalized.map(codes).fillna(-1).to_numpy(dtype = numpy.int64)
+
+
+def stack_codon_counts(df_hash: dict, samples: typing.Optional[list] = None, positions: typing.Optional[numpy.ndarray] = None) -> dict:
+    '''
+    Stacks the codon tables of several samples into dense arrays on a shared position axis.
+
+    input: df_hash of sample name -> codon table; optional subset/order of samples; optional positions
+           to use as the position axis (default is the sorted union of positions across the samples)
+    output: dict with
+            samples   - list of sample names (axis 0)
+            positions - sorted int array of codon positions (axis 1)
+            counts    - float array (samples x positions x 64) of CNT summed per codon variant
+            depth     - float array (samples x positions) of mean DENOM per position, nan where a sample
+                        has no rows at that position
+    '''
+    if samples is None:
+        samples = list(df_hash)
+    if positions is None:
+        positions = numpy.unique(numpy.concatenate([df_hash[sample]['POSITION'].to_numpy() for sample in samples]))
+    positions = numpy.asarray(positions, dtype = numpy.int64)
+
+    counts = numpy.zeros((len(samples), len(positions), len(CODONS)), dtype = numpy.float64)
+    depth = numpy.full((len(samples), len(positions)), numpy.nan)
+    for idx, sample in enumerate(samples):
+        df = df_hash[sample]
+        pos = df['POSITION'].to_numpy(dtype = numpy.int64)
+        pos_idx = numpy.searchsorted(positions, pos)
+        keep = (pos_idx < len(positions))
+        keep[keep] = positions[pos_idx[keep]] == pos[keep]
+        codon_idx = encode_codons(df['CODON'])
+        valid = keep & (codon_idx >= 0)
+
+        flat = pos_idx[valid] * len(CODONS) + codon_idx[valid]
+        counts[idx] = numpy.bincount(flat, weights = df['CNT'].to_numpy(dtype = numpy.float64)[valid],
+                                     minlength = len(positions) * len(CODONS)).reshape(len(positions), len(CODONS))
+
+        # mean DENOM across the rows of each position, as in the per-codon plots
+        rows = numpy.bincount(pos_idx[keep], minlength = len(positions))
+        denom_sum = numpy.bincount(pos_idx[keep], weights = df['DENOM'].to_numpy(dtype = numpy.float64)[keep], minlength = len(positions))
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            depth[idx] = numpy.where(rows > 0, denom_sum / rows, numpy.nan)
+
+    return {'samples': list(samples), 'positions': positions, 'counts': counts, 'depth': depth}
+
+
+def codon_frequencies(stacked: dict) -> numpy.ndarray:
+    '''
+    output: float array (samples x positions x 64) of codon variant frequencies (CNT / mean DENOM);
+            0 where a sample has no data at a position
+    '''
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        freqs = stacked['counts'] / stacked['depth'][:, :, None]
+    return numpy.nan_to_num(freqs, nan = 0.0, posinf = 0.0)
+
+
+def per_codon_summary(df: pandas.DataFrame) -> pandas.DataFrame:
+    '''
+    Per-codon aggregates of one (filtered) codon table in a single grouped pass, with the same
+    definitions as the per-codon plots: frequencies are summed CNT divided by the mean DENOM of the
+    rows at that position.
+
+    output: dataframe indexed by POSITION (sorted) with total_read_depth, nt_change_{1,2,3}_counts/_freq,
+            all_nt_muts_counts/_freq, aa_type_change_{synonymous,nonsynonymous,stop}_counts/_freq and
+            aa_diversity (number of distinct AA values)
+    '''
+    positions, pos_idx = numpy.unique(df['POSITION'].to_numpy(dtype = numpy.int64), return_inverse = True)
+    n_pos = len(positions)
+    cnt = df['CNT'].to_numpy(dtype = numpy.float64)
+    depth = numpy.bincount(pos_idx, weights = df['DENOM'].to_numpy(dtype = numpy.float64), minlength = n_pos) / numpy.bincount(pos_idx, minlength = n_pos)
+
+    summary = {'total_read_depth': depth}
+    nt_mutations = nt_mutation_counts(df)
+    for ntChanges in range(1, 4):
+        mask = nt_mutations == ntChanges
+        summary['nt_change_{}_counts'.format(ntChanges)] = numpy.bincount(pos_idx[mask], weights = cnt[mask], minlength = n_pos)
+        summary['nt_change_{}_freq'.format(ntChanges)] = summary['nt_change_{}_counts'.format(ntChanges)] / depth
+    summary['all_nt_muts_counts'] = summary['nt_change_1_counts'] + summary['nt_change_2_counts'] + summary['nt_change_3_counts']
+    summary['all_nt_muts_freq'] = summary['all_nt_muts_counts'] / depth
+
+    aa_type_codes = aa_change_types(df).cat.codes.to_numpy()
+    for code, aaTypes in enumerate(AA_TYPES):
+        mask = aa_type_codes == code
+        summary['aa_type_change_{}_counts'.format(aaTypes)] = numpy.bincount(pos_idx[mask], weights = cnt[mask], minlength = n_pos)
+        summary['aa_type_change_{}_freq'.format(aaTypes)] = summary['aa_type_change_{}_counts'.format(aaTypes)] / depth
+
+    aa_codes = pandas.Categorical(df['AA'].astype(str)).codes.astype(numpy.int64)
+    n_aa = int(aa_codes.max()) + 1 if len(aa_codes) else 1
+    distinct = numpy.unique(pos_idx * n_aa + aa_codes)
+    summary['aa_diversity'] = numpy.bincount(distinct // n_aa, minlength = n_pos)
+
+    return pandas.DataFrame(summary, index = pandas.Index(positions, name = 'POSITION'))
+
+
+def aa_frequency_matrix(df: pandas.DataFrame, positions: typing.Optional[numpy.ndarray] = None) -> pandas.DataFrame:
+    '''
+    output: dataframe (positions x AMINO_ACIDS) of summed CNT per amino acid divided by the mean DENOM
+            of the position, i.e. the matrix behind the frequency logo plots; positions without rows are 0
+    '''
+    if positions is None:
+        positions = numpy.unique(df['POSITION'].to_numpy(dtype = numpy.int64))
+    positions = numpy.asarray(positions, dtype = numpy.int64)
+    stacked = stack_codon_counts({'sample': df}, positions = positions)
+    aa_counts = numpy.zeros((len(positions), len(AMINO_ACIDS)))
+    numpy.add.at(aa_counts.T, CODON_AA_INDEX, stacked['counts'][0].T)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        freqs = numpy.nan_to_num(aa_counts / stacked['depth'][0][:, None], nan = 0.0, posinf = 0.0)
+    return pandas.DataFrame(freqs, index = pandas.Index(positions, name = 'POSITION'), columns = AMINO_ACIDS)
@@ -0,0 +1,263 @@
+import pandas
+import argparse
+import typing
+import os
+import warnings
+import numpy
+
+from codon_tables import CODONS, AMINO_ACIDS, CODON_AA_INDEX, GENETIC_CODE, encode_codons, stack_codon_counts
+from qc_anomalies import MAD_SCALE
+from library_audit import expected_variants
+
+'''
+Codon usage of the mutant library: which synonymous codons it over- or under-represents.
+
+The filtered tables of all samples are stacked into one count-weighted (samples x positions x 64 codons) array with
+codon_tables.stack_codon_counts (one bincount per sample); the reference codon of every position is zeroed, so only
+mutant codons count.  Counts per amino acid family come from one matrix product with the (64 codons x amino acids)
+membership matrix, and every metric below is a reduction of those arrays:
+
+    RSCU            relative synonymous codon usage, the count of a codon over the mean count of the codons of its
+                    amino acid (1 = no preference; per sample over all positions)
+    ENC             effective number of codons (Wright 1990) from the homozygosity F of every amino acid family,
+                    per sample and per position; 61 without bias, 31 for an unbiased NNK/NNS library (32 codons,
+                    one a stop), lower when the mutagenesis favours some codons
+    synonymous      at every position, the mutant codons synonymous to the reference codon that the library design
+                    (--designScheme, as in library_audit.py) contains: how many there are, how many were seen, their
+                    effective number (1 / sum of squared shares), its evenness ((effective - 1) / (designed - 1),
+                    0 = one codon takes every count, 1 = all used equally) and the share of synonymous counts on
+                    codons outside the design
+
+A position is flagged low_enc when its ENC is --codonBiasZ robust z-scores (median/MAD over the positions of the
+sample) below the sample's typical ENC, and synonymous_bias when the evenness of its synonymous codons is below
+--synonymousBias (between 0 and 1).  Evenness is rescaled so that it reaches 0 for any number of designed codons;
+the plain effective / designed ratio cannot go below 1 / designed, 0.5 for the two synonymous codons NNK leaves many
+positions.
+'''
+
+STOP_INDEX = AMINO_ACIDS.index('.')
+# (64 codons x amino acids) membership; stop codons do not belong to any family
+AA_MEMBERSHIP = (CODON_AA_INDEX[:, None] == numpy.arange(len(AMINO_ACIDS))[None, :]).astype(numpy.float64)
+AA_MEMBERSHIP[:, STOP_INDEX] = 0.0
+DEGENERACY = AA_MEMBERSHIP.sum(axis = 0).astype(int) # codons per amino acid, 0 for stop
+ENC_CLASSES = {2: 9, 3: 1, 4: 5, 6: 3} # degeneracy class -> number of amino acids in it (standard code)
+
+
+def reference_codon_codes(df_hash: dict, positions: numpy.ndarray) -> numpy.ndarray:
+    '''
+    output: int array with the codon code of the reference codon at every position (-1 where unknown)
+    '''
+    refs = pandas.concat([value[['POSITION', 'REF_CODON']] for value in df_hash.values()]).drop_duplicates('POSITION')
+    codes = numpy.full(len(positions), -1, dtype = numpy.int64)
+    index = numpy.searchsorted(positions, refs['POSITION'].to_numpy(dtype = numpy.int64))
+    inside = index < len(positions)
+    codes[index[inside]] = encode_codons(refs['REF_CODON'].astype(str))[inside]
+    return codes
+
+
+def mutant_codon_counts(df_hash: dict) -> dict:
+    '''
+    output: stack_codon_counts() of all samples with the reference codon of every position zeroed, plus ref_codes
+            (the reference codon code per position)
+    '''
+    stacked = stack_codon_counts(df_hash)
+    ref_codes = reference_codon_codes(df_hash, stacked['positions'])
+    known = ref_codes >= 0
+    stacked['counts'][:, numpy.flatnonzero(known), ref_codes[known]] = 0.0
+    stacked['ref_codes'] = ref_codes
+    return stacked
+
+
+def effective_number_of_codons(counts: numpy.ndarray) -> numpy.ndarray:
+    '''
+    input: (... x 64) codon counts
+    output: (...) Wright's ENC; amino acids with fewer than 2 counts are left out of their class average, a missing
+            3-fold class (isoleucine) is the mean of the 2- and 4-fold classes, nan when another class is empty
+    '''
+    n = counts @ AA_MEMBERSHIP
+    squares = (counts ** 2) @ AA_MEMBERSHIP
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        homozygosity = numpy.where(n >= 2, (squares / numpy.where(n > 0, n, 1.0) - 1.0) / (n - 1.0), numpy.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category = RuntimeWarning) # empty classes stay nan
+        mean_f = {degeneracy: numpy.nanmean(homozygosity[..., DEGENERACY == degeneracy], axis = -1) for degeneracy in ENC_CLASSES}
+    mean_f[3] = numpy.where(numpy.isnan(mean_f[3]), (mean_f[2] + mean_f[4]) / 2.0, mean_f[3])
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        enc = 2.0 + sum(size / mean_f[degeneracy] for degeneracy, size in ENC_CLASSES.items())
+    return numpy.minimum(enc, 61.0)
+
+
+def rscu(counts: numpy.ndarray) -> numpy.ndarray:
+    '''
+    input: (... x 64) codon counts
+    output: (... x 64) relative synonymous codon usage, nan for stop codons and amino acids without counts
+    '''
+    family = counts @ AA_MEMBERSHIP
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        usage = counts * DEGENERACY[CODON_AA_INDEX] / family[..., CODON_AA_INDEX]
+    usage[..., CODON_AA_INDEX == STOP_INDEX] = numpy.nan
+    return usage
+
+
+def designed_codons(positions: numpy.ndarray, ref_codes: numpy.ndarray, scheme: str, custom: typing.Optional[str] = None) -> numpy.ndarray:
+    '''
+    output: (positions x 64) bool array of the codons the library design contains at every position (every codon for
+            amino acid level designs such as 19aa), from library_audit.expected_variants
+    '''
+    ref_codons = pandas.Series([CODONS[code] if code >= 0 else 'NNN' for code in ref_codes], index = positions)
+    keys, level = expected_variants(ref_codons, scheme, custom)
+    if level == 'aa':
+        return numpy.ones((len(positions), len(CODONS)), dtype = bool)
+    designed = numpy.zeros((len(positions), len(CODONS)), dtype = bool)
+    designed[numpy.searchsorted(positions, keys // len(CODONS)), keys % len(CODONS)] = True
+    return designed
+
+
+def synonymous_usage(counts: numpy.ndarray, ref_codes: numpy.ndarray, designed: numpy.ndarray) -> dict:
+    '''
+    input: (samples x positions x 64) mutant codon counts; reference codon code per position; (positions x 64) designed codons
+    output: dict of (samples x positions) arrays n_available (designed synonymous codons, same for every sample),
+            n_observed, effective_number, evenness, top_share and off_design_share, and top_codon (codon code of the
+            most used designed synonymous codon, -1 if none)
+    '''
+    ref_aa = numpy.where(ref_codes >= 0, CODON_AA_INDEX[numpy.clip(ref_codes, 0, None)], -1)
+    synonymous = (CODON_AA_INDEX[None, :] == ref_aa[:, None]) & (numpy.arange(len(CODONS))[None, :] != ref_codes[:, None]) & (ref_aa[:, None] != STOP_INDEX)
+    all_syn_total = (counts * synonymous[None, :, :]).sum(axis = 2)
+    synonymous &= designed
+    syn_counts = counts * synonymous[None, :, :]
+    total = syn_counts.sum(axis = 2)
+    n_available = numpy.broadcast_to(synonymous.sum(axis = 1), total.shape)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        off_design = numpy.where(all_syn_total > 0, 1.0 - total / all_syn_total, numpy.nan)
+        effective = numpy.where(total > 0, total ** 2 / (syn_counts ** 2).sum(axis = 2), numpy.nan)
+        # 0 when one codon takes every count, 1 when all designed codons are used equally, whatever their number
+        evenness = numpy.where(n_available >= 2, (effective - 1.0) / (n_available - 1.0), numpy.nan)
+        top_share = numpy.where(total > 0, syn_counts.max(axis = 2) / total, numpy.nan)
+    return {'n_available': n_available, 'n_observed': (syn_counts > 0).sum(axis = 2), 'effective_number': effective, 'evenness': evenness,
+            'top_share': top_share, 'off_design_share': off_design, 'top_codon': numpy.where(total > 0, syn_counts.argmax(axis = 2), -1)}
+
+
+def codon_usage_tables(df_hash: dict, bias_z: float, synonymous_bias: float, scheme: str = 'NNK',
+                       custom: typing.Optional[str] = None) -> typing.Tuple[dict, pandas.DataFrame, pandas.DataFrame]:
+    '''
+    output: (mutant_codon_counts() arrays, per sample and codon table of counts, share of the amino acid and RSCU,
+             per sample and position table of ENC, its robust z, synonymous usage and flags)
+    '''
+    stacked = mutant_codon_counts(df_hash)
+    counts, positions, samples = stacked['counts'], stacked['positions'], stacked['samples']
+    codon_aa = numpy.array(list(GENETIC_CODE))
+
+    totals = counts.sum(axis = 1)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        aa_share = totals / (totals @ AA_MEMBERSHIP)[:, CODON_AA_INDEX]
+    per_codon = pandas.DataFrame({'sample': numpy.repeat(samples, len(CODONS)), 'CODON': numpy.tile(CODONS, len(samples)),
+                                  'AA': numpy.tile(codon_aa, len(samples)), 'count': totals.ravel(), 'aa_share': aa_share.ravel(),
+                                  'rscu': rscu(totals).ravel()})
+    sample_enc = effective_number_of_codons(totals)
+    per_codon['sample_enc'] = numpy.repeat(sample_enc, len(CODONS))
+
+    enc = effective_number_of_codons(counts)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category = RuntimeWarning)
+        median = numpy.nanmedian(enc, axis = 1, keepdims = True)
+        mad = MAD_SCALE * numpy.nanmedian(numpy.abs(enc - median), axis = 1, keepdims = True)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        enc_z = (enc - median) / mad
+    synonymous = synonymous_usage(counts, stacked['ref_codes'], designed_codons(positions, stacked['ref_codes'], scheme, custom))
+    has_data = ~numpy.isnan(stacked['depth'])
+    flags = numpy.where(enc_z <= -bias_z, 'low_enc', '')
+    syn_flag = synonymous['evenness'] < synonymous_bias
+    flags = numpy.where(syn_flag & (flags != ''), 'low_enc,synonymous_bias', numpy.where(syn_flag, 'synonymous_bias', flags))
+
+    ref_codes = stacked['ref_codes']
+    ref_codon = numpy.where(ref_codes >= 0, numpy.array(CODONS)[numpy.clip(ref_codes, 0, None)], '')
+    rows, columns = numpy.nonzero(has_data)
+    per_position = pandas.DataFrame({'sample': numpy.array(samples, dtype = object)[rows], 'POSITION': positions[columns],
+                                     'REF_CODON': ref_codon[columns], 'REF_AA': numpy.where(ref_codes >= 0, codon_aa[numpy.clip(ref_codes, 0, None)], '')[columns],
+                                     'mutant_counts': counts.sum(axis = 2)[rows, columns], 'enc': enc[rows, columns], 'enc_z': enc_z[rows, columns],
+                                     'syn_codons_available': synonymous['n_available'][rows, columns], 'syn_codons_observed': synonymous['n_observed'][rows, columns],
+                                     'syn_effective_number': synonymous['effective_number'][rows, columns], 'syn_evenness': synonymous['evenness'][rows, columns],
+                                     'top_syn_codon': numpy.where(synonymous['top_codon'] >= 0, numpy.array(CODONS)[numpy.clip(synonymous['top_codon'], 0, None)], '')[rows, columns],
+                                     'top_syn_share': synonymous['top_share'][rows, columns], 'syn_off_design_share': synonymous['off_design_share'][rows, columns], 'flags': flags[rows, columns]})
+    return stacked, per_codon, per_position
+
+
+def plot_codon_usage(stacked: dict, per_codon: pandas.DataFrame, per_position: pandas.DataFrame, colors: dict, outdir: str) -> None:
+    '''
+    output: codon_usage_rscu.png, sample x codon RSCU heatmap with codons grouped by amino acid;
+            codon_usage_enc_per_codon.png, ENC along the positions of every sample with flagged positions marked
+    '''
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as mcolors
+
+    samples = stacked['samples']
+    order = [codon for aa in AMINO_ACIDS if aa != '.' for codon in CODONS if GENETIC_CODE[CODONS.index(codon)] == aa]
+    values = per_codon.pivot(index = 'sample', columns = 'CODON', values = 'rscu').loc[samples, order].to_numpy(dtype = float)
+    fig, ax = plt.subplots(1, 1, figsize = (18, 0.3 * len(samples) + 2.5))
+    cmap = plt.get_cmap('RdBu_r').copy()
+    cmap.set_bad('lightgrey')
+    image = ax.imshow(numpy.ma.masked_invalid(values), aspect = 'auto', interpolation = 'nearest', cmap = cmap,
+                      norm = mcolors.TwoSlopeNorm(vmin = 0.0, vcenter = 1.0, vmax = max(2.0, float(numpy.nanmax(values)) if numpy.isfinite(values).any() else 2.0)))
+    ax.set_xticks(range(len(order)))
+    ax.set_xticklabels(['{} {}'.format(GENETIC_CODE[CODONS.index(codon)], codon) for codon in order], rotation = 90, fontsize = 6, family = 'monospace')
+    ax.set_yticks(range(len(samples)))
+    ax.set_yticklabels(samples, fontsize = 8)
+    ax.set_title('Relative synonymous codon usage of mutant codons (1 = no preference)', fontweight = 'bold')
+    fig.colorbar(image, ax = ax, fraction = 0.02, pad = 0.01)
+    fig.tight_layout()
+    fig.savefig(os.path.join(outdir, 'codon_usage_rscu.png'), dpi = 600, format = 'png')
+    plt.close(fig)
+
+    fig, ax = plt.subplots(1, 1, figsize = (15, 5))
+    for sample in samples:
+        rows = per_position.loc[per_position['sample'] == sample]
+        ax.plot(rows['POSITION'], rows['enc'], color = colors.get(sample, 'black'), linewidth = 0.8, label = sample)
+        flagged = rows.loc[rows['flags'] != '']
+        ax.scatter(flagged['POSITION'], flagged['enc'], color = colors.get(sample, 'black'), marker = 'v', s = 12)
+    ax.set_ylim(0, 62)
+    ax.set_xlabel('Codon Position', fontweight = 'bold', color = 'darkblue', fontsize = 10)
+    ax.set_ylabel('Effective number of codons', fontweight = 'bold', color = 'darkblue', fontsize = 10)
+    ax.set_title('Effective number of mutant codons per position (flagged positions marked)', fontweight = 'bold')
+    ax.legend(fontsize = 7, frameon = False, loc = 'lower right')
+    fig.tight_layout()
+    fig.savefig(os.path.join(outdir, 'codon_usage_enc_per_codon.png'), dpi = 600, format = 'png')
+    plt.close(fig)
+
+
+def get_codon_usage(df_hash: dict, colors: dict, params: dict, outdir: str) -> None:
+    '''
+    input: df_hash of sample -> filtered codon table; params with codonBiasZ, synonymousBias, designScheme and designCustom
+    output: None; writes codon_usage_matrix_<sample>.tsv (positions x 64 mutant codon counts), codon_usage_all_samples.tsv
+            (counts, amino acid share and RSCU per codon, ENC per sample), codon_usage_per_position.tsv (ENC and
+            synonymous usage per position with flags) and the RSCU and ENC plots
+    '''
+    stacked, per_codon, per_position = codon_usage_tables(df_hash, params['codonBiasZ'], params['synonymousBias'], params['designScheme'], params['designCustom'])
+    for index, sample in enumerate(stacked['samples']):
+        has_data = ~numpy.isnan(stacked['depth'][index])
+        matrix = pandas.DataFrame(stacked['counts'][index, has_data], index = pandas.Index(stacked['positions'][has_data], name = 'POSITION'), columns = CODONS)
+        matrix.to_csv(os.path.join(outdir, 'codon_usage_matrix_{}.tsv'.format(sample)), sep = '\t')
+    per_codon.to_csv(os.path.join(outdir, 'codon_usage_all_samples.tsv'), sep = '\t', index = False)
+    per_position.to_csv(os.path.join(outdir, 'codon_usage_per_position.tsv'), sep = '\t', index = False)
+    plot_codon_usage(stacked, per_codon, per_position, colors, outdir)
+    for sample, rows in per_position.groupby('sample', sort = False):
+        print('{}: ENC {:.1f}, {} positions flagged for codon bias'.format(sample, per_codon.loc[per_codon['sample'] == sample, 'sample_enc'].iloc[0],
+                                                                        int((rows['flags'] != '').sum())))
+
+
+if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('Agg')
+    from variant_filters import add_sample_arguments, load_filtered_samples
+
+    parser = argparse.ArgumentParser(description = 'Codon usage (RSCU, effective number of codons, synonymous codon bias) of mutant libraries',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    add_sample_arguments(parser)
+    parser.add_argument('--codonBiasZ', default = 3.0, type = float, help = 'flag positions whose ENC is this many robust z-scores below the sample median')
+    parser.add_argument('--synonymousBias', default = 0.5, type = float, help = 'flag positions whose synonymous codons are used less evenly than this, (effective - 1) / (available - 1) between 0 (one codon) and 1 (even)')
+    parser.add_argument('--designScheme', default = 'NNK', type = str, help = 'degenerate codon in IUPAC code (NNK, NNS, NNN, ...), 19aa, or custom; synonymous evenness is measured over its codons')
+    parser.add_argument('--designCustom', default = None, type = str, help = 'codons of the custom scheme, comma-separated or csv/tsv with CODON and optional POSITION columns')
+    args = parser.parse_args()
+
+    df_hash, _, colors = load_filtered_samples(args)
+    get_codon_usage(df_hash, colors, {'codonBiasZ': args.codonBiasZ, 'synonymousBias': args.synonymousBias,
+                                      'designScheme': args.designScheme, 'designCustom': args.designCustom}, args.outdir)
@@ -0,0 +1,263 @@
+import pandas
+import argparse
+import typing
+import glob
+import os
+import warnings
+import numpy
+
+from codon_tables import load_codon_table, parse_codon_range, per_codon_summary
+import variant_filters
+
+'''
+Differential comparison of two runs, or of two samples, on the per-codon aggregates of codon_tables.per_codon_summary.
+
+Each side is a codon table or a run_manifest.py output directory (its filtered/<sample>.filtered.tsv tables, and
+filtered/<gene>/<sample>.filtered.tsv in whole-genome mode), or a run hash prefix of a run store (--store).  Tables
+that are not already filtered are filtered with --qual/--counts/--pos.  Two directories are compared sample by
+sample on the samples they share (or the pairs given with --pairs); two tables are compared with each other.
+
+The aggregates of a pair are aligned on the union of their positions into two (positions x metrics) arrays, nan
+where a side has no rows, and every statistic (deltas, Pearson and Spearman correlation, largest changes) is an array
+operation over them, so a comparison takes about as long as reading the tables.  With --minCorrelation and/or
+--maxDelta the script exits with status 1 when a pair moved more than allowed on --metric, which makes it usable as a
+regression check at the end of every pipeline run.
+'''
+
+METRICS = ['all_nt_muts_freq', 'nt_change_1_freq', 'nt_change_2_freq', 'nt_change_3_freq', 'aa_type_change_synonymous_freq',
+           'aa_type_change_nonsynonymous_freq', 'aa_type_change_stop_freq', 'aa_diversity', 'total_read_depth']
+
+
+def load_side(spec: str, qual: float, counts: int, pos: str, store: typing.Optional[str] = None) -> dict:
+    '''
+    input: codon table, run_manifest.py output directory or (with store) run hash prefix; filter thresholds for
+           tables that are not filtered yet
+    output: dict of sample -> per_codon_summary dataframe
+    '''
+    if not os.path.exists(spec) and store is not None:
+        import provenance
+
+        conn = provenance.open_store(store)
+        spec = provenance.run_directory(store, provenance.resolve_run(conn, spec))
+    if os.path.isdir(spec):
+        paths = {}
+        for path in sorted(glob.glob(os.path.join(spec, 'filtered', '*.filtered.tsv')) + glob.glob(os.path.join(spec, 'filtered', '*', '*.filtered.tsv'))):
+            gene = os.path.relpath(os.path.dirname(path), os.path.join(spec, 'filtered'))
+            sample = os.path.basename(path)[:-len('.filtered.tsv')]
+            paths[sample if gene == '.' else '{}/{}'.format(gene, sample)] = path
+        if not paths:
+            raise FileNotFoundError('{} has no filtered tables (filtered/<sample>.filtered.tsv), is it a run_manifest.py output directory?'.format(spec))
+    elif os.path.isfile(spec):
+        name = os.path.basename(spec)
+        paths = {name[:-len('.filtered.tsv')] if name.endswith('.filtered.tsv') else os.path.splitext(name)[0]: spec}
+    else:
+        raise FileNotFoundError('{} is neither a codon table nor a run directory{}'.format(spec, '' if store is None else ' nor a run in ' + store))
+
+    summaries = {}
+    for sample, path in paths.items():
+        if path.endswith('.filtered.tsv'):
+            df = load_codon_table(path)
+        else:
+            df, _ = variant_filters.apply_filters(load_codon_table(path, positions = parse_codon_range(pos)), minQ = qual, minAlt = counts, codonRange = pos)
+        summaries[sample] = per_codon_summary(df)
+    return summaries
+
+
+def pair_samples(side_a: dict, side_b: dict, pairs: typing.Optional[str] = None) -> typing.List[typing.Tuple[str, str]]:
+    '''
+    output: list of (sample of a, sample of b) to compare: the given comma-separated a:b pairs (a alone for the same
+            name on both sides), the only table of each side, or else the samples both sides share
+    '''
+    if pairs is not None:
+        matched = []
+        for pair in pairs.split(','):
+            name_a, _, name_b = pair.strip().partition(':')
+            matched.append((name_a, name_b or name_a))
+    elif len(side_a) == 1 and len(side_b) == 1:
+        matched = [(next(iter(side_a)), next(iter(side_b)))]
+    else:
+        matched = [(sample, sample) for sample in side_a if sample in side_b]
+    missing = [name for name_a, name_b in matched for name, side in [(name_a, side_a), (name_b, side_b)] if name not in side]
+    if missing:
+        raise KeyError('samples not found: {}'.format(', '.join(missing)))
+    if not matched:
+        raise ValueError('the two sides do not share any sample; give the pairs to compare with --pairs')
+    return matched
+
+
+def align_summaries(summary_a: pandas.DataFrame, summary_b: pandas.DataFrame, metrics: list) -> typing.Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    '''
+    output: (union of positions, (positions x metrics) array of a, same of b); nan where a side has no rows
+    '''
+    positions = numpy.union1d(summary_a.index.to_numpy(), summary_b.index.to_numpy())
+    aligned = []
+    for summary in (summary_a, summary_b):
+        values = numpy.full((len(positions), len(metrics)), numpy.nan)
+        values[numpy.searchsorted(positions, summary.index.to_numpy())] = summary[metrics].to_numpy(dtype = numpy.float64)
+        aligned.append(values)
+    return positions, aligned[0], aligned[1]
+
+
+def correlation(a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    '''
+    output: Pearson correlation of every column of a with the same column of b over the rows where both are set
+    '''
+    shared = ~numpy.isnan(a) & ~numpy.isnan(b)
+    n = shared.sum(axis = 0)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean_a = numpy.where(shared, a, 0.0).sum(axis = 0) / n
+        mean_b = numpy.where(shared, b, 0.0).sum(axis = 0) / n
+        dev_a = numpy.where(shared, a - mean_a, 0.0)
+        dev_b = numpy.where(shared, b - mean_b, 0.0)
+        return (dev_a * dev_b).sum(axis = 0) / numpy.sqrt((dev_a ** 2).sum(axis = 0) * (dev_b ** 2).sum(axis = 0))
+
+
+def comparison_stats(a: numpy.ndarray, b: numpy.ndarray, metrics: list) -> pandas.DataFrame:
+    '''
+    output: dataframe indexed by metric with the number of positions on each side and shared, Pearson and Spearman
+            correlation, mean and median absolute delta (b - a) and the largest absolute delta with its position index
+    '''
+    shared = ~numpy.isnan(a) & ~numpy.isnan(b)
+    delta = b - a
+    abs_delta = numpy.where(shared, numpy.abs(delta), -1.0)
+    # ranks over the shared positions only; nan elsewhere so they drop out of the correlation again
+    ranks = [pandas.DataFrame(numpy.where(shared, side, numpy.nan)).rank().to_numpy() for side in (a, b)]
+    with warnings.catch_warnings(), numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        warnings.simplefilter('ignore', category = RuntimeWarning) # metrics without shared positions stay nan
+        stats = pandas.DataFrame({'n_positions_a': (~numpy.isnan(a)).sum(axis = 0), 'n_positions_b': (~numpy.isnan(b)).sum(axis = 0),
+                                  'n_shared': shared.sum(axis = 0), 'pearson_r': correlation(a, b), 'spearman_r': correlation(*ranks),
+                                  'mean_delta': numpy.where(shared, delta, 0.0).sum(axis = 0) / shared.sum(axis = 0),
+                                  'median_abs_delta': numpy.nanmedian(numpy.where(shared, numpy.abs(delta), numpy.nan), axis = 0),
+                                  'max_abs_delta': numpy.where(shared.any(axis = 0), abs_delta.max(axis = 0), numpy.nan),
+                                  'max_abs_delta_index': abs_delta.argmax(axis = 0)}, index = pandas.Index(metrics, name = 'metric'))
+    return stats
+
+
+def top_changes(positions: numpy.ndarray, a: numpy.ndarray, b: numpy.ndarray, metrics: list, metric: str, top: int) -> pandas.DataFrame:
+    '''
+    output: the top positions by absolute delta of metric (positions only on one side count with the other side
+            as 0), with the value on each side and the delta of every metric
+    '''
+    column = metrics.index(metric)
+    delta = numpy.nan_to_num(b[:, column]) - numpy.nan_to_num(a[:, column])
+    order = numpy.argsort(-numpy.abs(delta), kind = 'stable')[:top]
+    table = pandas.DataFrame({'POSITION': positions[order], 'status': numpy.where(numpy.isnan(a[order, column]), 'only_b',
+                                                                                    numpy.where(numpy.isnan(b[order, column]), 'only_a', 'shared'))})
+    for index, name in enumerate(metrics):
+        table['{}_a'.format(name)] = a[order, index]
+        table['{}_b'.format(name)] = b[order, index]
+        table['{}_delta'.format(name)] = b[order, index] - a[order, index]
+    return table
+
+
+def plot_delta_tracks(tracks: dict, metric: str, labels: typing.Tuple[str, str], outdir: str) -> None:
+    '''
+    output: compare_delta_tracks.png, for every compared pair the metric along the codons on both sides and the delta track
+    '''
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(2 * len(tracks), 1, figsize = (14, 3 * len(tracks)), squeeze = False,
+                             gridspec_kw = {'height_ratios': [2, 1] * len(tracks)})
+    for index, (pair, (positions, values_a, values_b)) in enumerate(tracks.items()):
+        ax, delta_ax = axes[2 * index, 0], axes[2 * index + 1, 0]
+        ax.step(positions, values_a, where = 'mid', color = '#0072B2', linewidth = 0.8, label = labels[0])
+        ax.step(positions, values_b, where = 'mid', color = '#D55E00', linewidth = 0.8, label = labels[1])
+        ax.set_title(pair, fontweight = 'bold', fontsize = 9)
+        ax.set_ylabel(metric, fontsize = 7)
+        ax.legend(fontsize = 7, frameon = False, loc = 'upper right')
+        delta = numpy.nan_to_num(values_b) - numpy.nan_to_num(values_a)
+        delta_ax.fill_between(positions, 0, delta, where = delta >= 0, step = 'mid', color = '#D55E00', linewidth = 0)
+        delta_ax.fill_between(positions, 0, delta, where = delta < 0, step = 'mid', color = '#0072B2', linewidth = 0)
+        delta_ax.axhline(0, color = 'black', linewidth = 0.5)
+        delta_ax.set_ylabel('delta (b - a)', fontsize = 7)
+    axes[-1, 0].set_xlabel('Codon Position', fontweight = 'bold', color = 'darkblue', fontsize = 10)
+    fig.tight_layout()
+    fig.savefig(os.path.join(outdir, 'compare_delta_tracks.png'), dpi = 600, format = 'png')
+    plt.close(fig)
+
+
+def compare(side_a: dict, side_b: dict, pairs: list, metric: str, top: int, outdir: str, labels: typing.Tuple[str, str] = ('a', 'b'),
+            plot: bool = True) -> pandas.DataFrame:
+    '''
+    input: per-codon summaries of both sides (load_side()), sample pairs (pair_samples()), metric to rank and plot,
+           number of top changes per pair
+    output: summary statistics of every pair and metric; writes compare_summary.tsv, compare_per_codon.tsv,
+            compare_top_changes.tsv and (with plot) compare_delta_tracks.png into outdir
+    '''
+    summaries, per_codon, changes, tracks = [], [], [], {}
+    column = METRICS.index(metric)
+    for name_a, name_b in pairs:
+        pair = name_a if name_a == name_b else '{}:{}'.format(name_a, name_b)
+        positions, a, b = align_summaries(side_a[name_a], side_b[name_b], METRICS)
+        stats = comparison_stats(a, b, METRICS)
+        stats['max_abs_delta_position'] = positions[stats.pop('max_abs_delta_index').to_numpy()] if len(positions) else numpy.nan
+        stats.insert(0, 'pair', pair)
+        summaries.append(stats.reset_index())
+
+        table = pandas.DataFrame({'pair': pair, 'POSITION': positions})
+        for index, name in enumerate(METRICS):
+            table['{}_a'.format(name)] = a[:, index]
+            table['{}_b'.format(name)] = b[:, index]
+            table['{}_delta'.format(name)] = b[:, index] - a[:, index]
+        per_codon.append(table)
+        changes.append(top_changes(positions, a, b, METRICS, metric, top).assign(pair = pair))
+        tracks[pair] = (positions, a[:, column], b[:, column])
+
+    summary = pandas.concat(summaries, ignore_index = True)
+    summary.to_csv(os.path.join(outdir, 'compare_summary.tsv'), sep = '\t', index = False)
+    pandas.concat(per_codon, ignore_index = True).to_csv(os.path.join(outdir, 'compare_per_codon.tsv'), sep = '\t', index = False)
+    changes = pandas.concat(changes, ignore_index = True)
+    changes[['pair'] + [column for column in changes.columns if column != 'pair']].to_csv(os.path.join(outdir, 'compare_top_changes.tsv'), sep = '\t', index = False)
+    if plot:
+        plot_delta_tracks(tracks, metric, labels, outdir)
+    return summary
+
+
+def regressions(summary: pandas.DataFrame, metric: str, min_correlation: typing.Optional[float], max_delta: typing.Optional[float]) -> typing.List[str]:
+    '''
+    output: one message per pair whose metric correlates less than min_correlation or moved more than max_delta
+            at any shared position
+    '''
+    failed = []
+    for _, row in summary.loc[summary['metric'] == metric].iterrows():
+        if min_correlation is not None and not row['pearson_r'] >= min_correlation:
+            failed.append('{}: {} correlation {:.4f} below {}'.format(row['pair'], metric, row['pearson_r'], min_correlation))
+        if max_delta is not None and row['max_abs_delta'] > max_delta:
+            failed.append('{}: {} changed by {:.4g} at codon {} (allowed {})'.format(row['pair'], metric, row['max_abs_delta'],
+                                                                                 int(row['max_abs_delta_position']), max_delta))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Compares the per-codon aggregates of two runs or two samples and reports the differences',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--a', required = True, type = str, help = 'baseline: codon table, run_manifest.py output directory or run hash prefix of --store')
+    parser.add_argument('--b', required = True, type = str, help = 'compared: codon table, run_manifest.py output directory or run hash prefix of --store')
+    parser.add_argument('--pairs', default = None, type = str, help = 'comma-separated sample pairs a:b to compare (default: the samples both sides share)')
+    parser.add_argument('--store', default = None, type = str, help = 'run store of run_manifest.py --store to resolve run hashes in')
+    parser.add_argument('--metric', default = 'all_nt_muts_freq', choices = METRICS, help = 'per-codon aggregate to rank, plot and check')
+    parser.add_argument('--top', default = 25, type = int, help = 'number of largest changes to list per pair')
+    parser.add_argument('--minCorrelation', default = None, type = float, help = 'exit with 1 if the Pearson correlation of --metric of any pair is below this')
+    parser.add_argument('--maxDelta', default = None, type = float, help = 'exit with 1 if --metric of any shared codon changed by more than this')
+    parser.add_argument('--noPlot', action = 'store_true', help = 'write the tables only')
+    parser.add_argument('--qual', default = 24.0, type = float, help = 'minimum average quality of reads to keep, for tables that are not filtered yet')
+    parser.add_argument('--counts', default = 100, type = int, help = 'minimum number of counts for a codon variant to keep, for tables that are not filtered yet')
+    parser.add_argument('--pos', default = '0-0', type = str, help = 'integer range of codon positions to use, e.g. 9-397 (default: all positions)')
+    parser.add_argument('--outdir', default = os.getcwd(), help = 'Path to output directory')
+    args = parser.parse_args()
+
+    if not args.noPlot:
+        import matplotlib
+        matplotlib.use('Agg')
+    side_a = load_side(args.a, args.qual, args.counts, args.pos, args.store)
+    side_b = load_side(args.b, args.qual, args.counts, args.pos, args.store)
+    os.makedirs(args.outdir, exist_ok = True)
+    summary = compare(side_a, side_b, pair_samples(side_a, side_b, args.pairs), args.metric, args.top, args.outdir,
+                      labels = (args.a, args.b), plot = not args.noPlot)
+    print(summary.loc[summary['metric'] == args.metric, ['pair', 'n_shared', 'pearson_r', 'spearman_r', 'mean_delta', 'max_abs_delta', 'max_abs_delta_position']].to_string(index = False))
+
+    failed = regressions(summary, args.metric, args.minCorrelation, args.maxDelta)
+    for message in failed:
+        print('REGRESSION {}'.format(message))
+    if failed:
+        raise SystemExit(1)
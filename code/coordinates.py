@@ -0,0 +1,348 @@
+import pandas
+import typing
+import functools
+import os
+import re
+import numpy
+
+from codon_tables import NUCLEOTIDES, CODONS, CODON_TO_AA
+
+'''
+Coordinate system shared by the SiNPle, codon table and logo scripts.
+
+A CodingRegion is built once from the reference sequence, the 1-based genome position of the first
+base of codon 1 (the ORF start) and the genome window of interest.  Everything a variant needs
+(reference base, codon number, codon phase, reference codon) is precomputed into integer arrays
+indexed directly by the 1-based genome position, so per-variant lookups are plain array indexing
+instead of string-keyed dictionary lookups.
+
+Annotation tables (region_name,start,end,color as in ref/annotations_config.csv) are loaded into sorted
+interval arrays and codon positions are assigned to regions with numpy.searchsorted, once per table, after which
+per-region statistics are bincount reductions over the region index (domain_summary).
+
+Gene tables (GFF3, or a TSV with gene,start,end and optional strand,phase columns; 1-based genome positions,
+inclusive) describe several ORFs of one genome.  Genes may overlap and may be in different frames; each gene
+is read in its own frame starting at start + phase.  Codon table rows or SiNPle sites are routed to genes
+through the same sorted interval arrays.
+'''
+
+BASE_CODE = {base: code for code, base in enumerate(NUCLEOTIDES)} # T=0, C=1, A=2, G=3; anything else is 4
+PHASE_WEIGHT = numpy.array([16, 4, 1]) # codon code = 16 * first base + 4 * second base + third base
+STOP_CODES = numpy.array([code for code, codon in enumerate(CODONS) if CODON_TO_AA[codon] == '.'])
+
+
+def read_reference(fasta: str) -> str:
+    '''
+    input: path to a single-record fasta
+    output: upper case sequence with line breaks removed (parsed once per file content, see file_key())
+    '''
+    return _read_reference(*file_key(fasta))
+
+
+def file_key(path: str) -> typing.Tuple[str, int, int]:
+    ''' output: (absolute path, size, mtime) so cached parses are reused until the file changes '''
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+@functools.lru_cache(maxsize = 8)
+def _read_reference(fasta: str, size: int, mtime_ns: int) -> str:
+    with open(fasta, 'r') as seq:
+        return ''.join(line.strip() for line in seq if not line.startswith('>')).upper()
+
+
+class CodingRegion:
+    '''
+    input: reference sequence; orf_start, 1-based genome position of the first base of codon 1;
+           optional region_start/region_end, 1-based inclusive genome window (default whole sequence)
+
+    Arrays indexed by 1-based genome position (index 0 and positions outside the window are unused):
+        base_code   - uint8 reference base code (BASE_CODE), 4 for non A/C/G/T
+        codon_index - int32 codon number (1-based), 0 outside the window or upstream of the ORF
+        codon_phase - int8 position within the codon (0, 1, 2), -1 where codon_index is 0
+        ref_codon   - int16 code (0-63, see codon_tables.CODONS) of the reference codon containing the
+                      position, -1 where the codon is incomplete or contains a non A/C/G/T base
+    Arrays indexed by codon number (index 0 unused):
+        codon_start      - int64 genome position of the first base of each codon
+        codon_ref_code   - int16 reference codon code
+    '''
+
+    def __init__(self, sequence: str, orf_start: int, region_start: typing.Optional[int] = None, region_end: typing.Optional[int] = None):
+        self.sequence = sequence.upper()
+        self.orf_start = orf_start
+        self.region_start = region_start if region_start is not None else 1
+        self.region_end = region_end if region_end is not None else len(self.sequence)
+        if not (1 <= self.region_start <= self.region_end <= len(self.sequence)):
+            raise ValueError('region {}-{} is outside of the reference (1-{})'.format(self.region_start, self.region_end, len(self.sequence)))
+
+        genome_pos = numpy.arange(len(self.sequence) + 1)
+        lookup = numpy.full(256, 4, dtype = numpy.uint8)
+        for base, code in BASE_CODE.items():
+            lookup[ord(base)] = code
+        self.base_code = numpy.concatenate([[4], lookup[numpy.frombuffer(self.sequence.encode('ascii'), dtype = numpy.uint8)]]).astype(numpy.uint8)
+
+        in_region = (genome_pos >= max(self.region_start, orf_start)) & (genome_pos <= self.region_end)
+        offset = genome_pos - orf_start
+        self.codon_index = numpy.where(in_region, offset // 3 + 1, 0).astype(numpy.int32)
+        self.codon_phase = numpy.where(in_region, offset % 3, -1).astype(numpy.int8)
+
+        n_codons = int(self.codon_index.max())
+        self.codon_start = orf_start + 3 * (numpy.arange(n_codons + 1) - 1)
+        self.codon_start[0] = 0
+        # reference codon codes from the three base codes of each codon; codons running past the end are incomplete
+        first = self.codon_start[1:]
+        complete = first + 2 <= len(self.sequence)
+        codes = numpy.full(n_codons, -1, dtype = numpy.int16)
+        bases = numpy.stack([self.base_code[numpy.clip(first + shift, 0, len(self.sequence))] for shift in range(3)])
+        valid = complete & (bases < 4).all(axis = 0)
+        codes[valid] = (bases[:, valid] * PHASE_WEIGHT[:, None]).sum(axis = 0)
+        self.codon_ref_code = numpy.concatenate([[-1], codes]).astype(numpy.int16)
+        self.ref_codon = numpy.where(self.codon_index > 0, self.codon_ref_code[self.codon_index], -1).astype(numpy.int16)
+
+    @classmethod
+    def from_fasta(cls, fasta: str, orf_start: int, region_start: typing.Optional[int] = None, region_end: typing.Optional[int] = None) -> 'CodingRegion':
+        return cls(read_reference(fasta), orf_start, region_start, region_end)
+
+    @property
+    def positions(self) -> numpy.ndarray:
+        ''' 1-based genome positions of the window '''
+        return numpy.arange(self.region_start, self.region_end + 1)
+
+    @property
+    def n_codons(self) -> int:
+        return len(self.codon_start) - 1
+
+    @property
+    def orf_codons(self) -> int:
+        ''' number of codons before the first in-frame stop codon of the reference (n_codons without one) '''
+        stops = numpy.flatnonzero(numpy.isin(self.codon_ref_code[1:], STOP_CODES))
+        return int(stops[0]) if len(stops) else self.n_codons
+
+    def ref_codon_str(self, codon_number: int) -> str:
+        code = self.codon_ref_code[codon_number]
+        return CODONS[code] if code >= 0 else self.sequence[self.codon_start[codon_number] - 1:self.codon_start[codon_number] + 2]
+
+    def mutant_codon_code(self, pos: numpy.ndarray, base: numpy.ndarray) -> numpy.ndarray:
+        '''
+        input: genome positions and alternative bases (characters or BASE_CODE codes), same length
+        output: int array of codes of the reference codon with the base substituted; -1 when the
+                position is not in a complete codon or the base is not A/C/G/T
+        '''
+        pos = numpy.asarray(pos, dtype = numpy.int64)
+        base = numpy.asarray(base)
+        if base.dtype.kind in ('U', 'S', 'O'):
+            base = numpy.array([BASE_CODE.get(str(b).upper(), 4) for b in base])
+        phase = self.codon_phase[pos]
+        ref = self.ref_codon[pos].astype(numpy.int64)
+        valid = (phase >= 0) & (ref >= 0) & (base < 4)
+        weight = PHASE_WEIGHT[numpy.clip(phase, 0, 2)]
+        ref_base = (ref // weight) % 4
+        return numpy.where(valid, ref + (base - ref_base) * weight, -1)
+
+    def mutant_codon(self, pos: int, base: str) -> typing.Optional[str]:
+        ''' single-variant convenience wrapper of mutant_codon_code returning the codon string '''
+        code = self.mutant_codon_code([pos], [base])[0]
+        return CODONS[code] if code >= 0 else None
+
+    def mutant_aa(self, pos: int, base: str) -> typing.Optional[str]:
+        codon = self.mutant_codon(pos, base)
+        return CODON_TO_AA[codon] if codon is not None else None
+
+
+def load_annotations(annotations: str, gene: typing.Optional[str] = None) -> pandas.DataFrame:
+    '''
+    input: path to csv with region_name,start,end,color (codon positions, inclusive) and optionally gene, the gene of
+           the gene table whose codon numbering start/end use; gene, keep only the rows of that gene
+    output: dataframe sorted by start with integer start/end (a copy of the table parsed once per file content)
+    '''
+    annot_data = _load_annotations(*file_key(annotations)).copy()
+    if gene is None:
+        return annot_data
+    if 'gene' not in annot_data.columns:
+        raise ValueError('{} has no gene column; annotations of a gene table need the gene of every region'.format(annotations))
+    return annot_data.loc[annot_data['gene'].astype(str) == gene].reset_index(drop = True)
+
+
+@functools.lru_cache(maxsize = 32)
+def _load_annotations(annotations: str, size: int, mtime_ns: int) -> pandas.DataFrame:
+    annot_data = pandas.read_csv(annotations)
+    annot_data['start'] = annot_data['start'].astype(int)
+    annot_data['end'] = annot_data['end'].astype(int)
+    return annot_data.sort_values('start').reset_index(drop = True)
+
+
+def assign_regions(positions: numpy.ndarray, annot_data: pandas.DataFrame) -> numpy.ndarray:
+    '''
+    input: codon positions; annotation table from load_annotations (non-overlapping intervals)
+    output: int array with the row index of the annotation containing each position, -1 if none
+    '''
+    positions = numpy.asarray(positions)
+    starts = annot_data['start'].to_numpy()
+    ends = annot_data['end'].to_numpy()
+    if len(starts) == 0:
+        return numpy.full(positions.shape, -1)
+    idx = numpy.searchsorted(starts, positions, side = 'right') - 1
+    inside = (idx >= 0) & (positions <= ends[numpy.clip(idx, 0, None)])
+    return numpy.where(inside, idx, -1)
+
+
+def domain_summary(summary: pandas.DataFrame, annot_data: pandas.DataFrame) -> pandas.DataFrame:
+    '''
+    input: per-codon aggregates of one sample (codon_tables.per_codon_summary, indexed by POSITION); annotation table
+           from load_annotations (non-overlapping intervals)
+    output: dataframe with one row per annotated region (in annotation order, then 'unannotated' when codons fall
+            outside every region) with region_name, start, end, n_codons_observed, fraction_observed, mean_depth,
+            mutation_freq (mean per-codon frequency of all mutations), pooled_mutation_freq (summed mutant counts over
+            summed depth), synonymous/nonsynonymous/stop_freq (mean per codon), nonsyn_syn_ratio (summed
+            nonsynonymous over synonymous counts) and mean_aa_diversity
+    '''
+    region = assign_regions(summary.index.to_numpy(), annot_data)
+    n_regions = len(annot_data)
+    # codons outside every region go to one extra group after the annotated ones
+    group = numpy.where(region >= 0, region, n_regions)
+    n_groups = n_regions + 1
+
+    def total(column: str) -> numpy.ndarray:
+        return numpy.bincount(group, weights = summary[column].to_numpy(dtype = numpy.float64), minlength = n_groups)
+
+    observed = numpy.bincount(group, minlength = n_groups).astype(numpy.float64)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        rolled = pandas.DataFrame({
+            'region_name': list(annot_data['region_name'].astype(str)) + ['unannotated'],
+            'start': list(annot_data['start']) + [numpy.nan],
+            'end': list(annot_data['end']) + [numpy.nan],
+            'n_codons_observed': observed.astype(numpy.int64),
+            'fraction_observed': observed / numpy.append((annot_data['end'] - annot_data['start'] + 1).to_numpy(dtype = numpy.float64), numpy.nan),
+            'mean_depth': total('total_read_depth') / observed,
+            'mutation_freq': total('all_nt_muts_freq') / observed,
+            'pooled_mutation_freq': total('all_nt_muts_counts') / total('total_read_depth'),
+            'synonymous_freq': total('aa_type_change_synonymous_freq') / observed,
+            'nonsynonymous_freq': total('aa_type_change_nonsynonymous_freq') / observed,
+            'stop_freq': total('aa_type_change_stop_freq') / observed,
+            'nonsyn_syn_ratio': total('aa_type_change_nonsynonymous_counts') / total('aa_type_change_synonymous_counts'),
+            'mean_aa_diversity': total('aa_diversity') / observed})
+    # the unannotated group is only reported when it holds codons
+    return rolled.iloc[:n_regions + int(observed[n_regions] > 0)].reset_index(drop = True)
+
+
+def annotations_in_window(window_start: int, window_end: int, annot_data: pandas.DataFrame) -> pandas.DataFrame:
+    '''
+    output: annotation rows overlapping codons window_start..window_end, with start/end clipped to the window
+    '''
+    overlapping = annot_data.loc[(annot_data['end'] >= window_start) & (annot_data['start'] <= window_end)].copy()
+    overlapping['start'] = overlapping['start'].clip(lower = window_start)
+    overlapping['end'] = overlapping['end'].clip(upper = window_end)
+    return overlapping
+
+
+GENE_COLUMNS = ['gene', 'start', 'end', 'strand', 'orf_start']
+
+
+def load_genes(genes: str) -> pandas.DataFrame:
+    '''
+    input: path to a GFF3 (.gff/.gff3; CDS features, or gene features when there are no CDS) or a TSV with
+           gene,start,end and optional strand and phase columns
+    output: dataframe with GENE_COLUMNS sorted by start (a copy of the table parsed once per file content);
+            orf_start is the genome position of the first base of codon 1 of the gene
+    '''
+    return _load_genes(*file_key(genes)).copy()
+
+
+@functools.lru_cache(maxsize = 8)
+def _load_genes(genes: str, size: int, mtime_ns: int) -> pandas.DataFrame:
+    if genes.endswith(('.gff', '.gff3')):
+        with open(genes, 'r') as handle:
+            # the ##FASTA section of a GFF3 ends the features
+            lines = []
+            for line in handle:
+                if line.startswith('##FASTA'):
+                    break
+                if not line.startswith('#') and line.strip() != '':
+                    lines.append(line.rstrip('\n').split('\t'))
+        features = pandas.DataFrame([line for line in lines if len(line) == 9],
+                                    columns = ['seqid', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase', 'attributes'])
+        feature_type = 'CDS' if (features['type'] == 'CDS').any() else 'gene'
+        features = features.loc[features['type'] == feature_type].reset_index(drop = True)
+        attributes = [dict(field.split('=', 1) for field in text.split(';') if '=' in field) for text in features['attributes']]
+        features['gene'] = [attr.get('Name', attr.get('gene', attr.get('ID', '{}_{}'.format(feature_type, idx + 1)))) for idx, attr in enumerate(attributes)]
+        features['phase'] = pandas.to_numeric(features['phase'], errors = 'coerce').fillna(0)
+    else:
+        features = pandas.read_csv(genes, sep = '\t', comment = '#')
+        features.columns = [column.strip().lower() for column in features.columns]
+        for required in ['gene', 'start', 'end']:
+            if required not in features.columns:
+                raise ValueError('gene table {} is missing required column "{}"'.format(genes, required))
+        if 'strand' not in features.columns:
+            features['strand'] = '+'
+        if 'phase' not in features.columns:
+            features['phase'] = 0
+    if features.empty:
+        raise ValueError('gene table {} does not list any genes'.format(genes))
+    if (features['strand'].astype(str).str.strip() == '-').any():
+        raise ValueError('gene table {} has minus strand genes, only plus strand ORFs are supported'.format(genes))
+
+    features['gene'] = features['gene'].astype(str).str.strip()
+    # split features (e.g. the two CDS parts of a frameshifted ORF) keep their name with a running suffix
+    repeat = features.groupby('gene').cumcount()
+    features['gene'] = numpy.where(repeat > 0, features['gene'] + '_' + (repeat + 1).astype(str), features['gene'])
+    features['start'] = features['start'].astype(int)
+    features['end'] = features['end'].astype(int)
+    features['strand'] = '+'
+    features['orf_start'] = features['start'] + features['phase'].astype(int)
+    return features[GENE_COLUMNS].sort_values(['start', 'end'], kind = 'stable').reset_index(drop = True)
+
+
+def gene_directories(genes: pandas.DataFrame) -> dict:
+    '''
+    input: gene table from load_genes
+    output: dict of gene -> its name made safe for file, directory and stage names; raises ValueError when two
+            genes map to the same name (e.g. nsP1/2 and nsP1_2), since one would overwrite the tables of the other
+    '''
+    directories = {gene: re.sub(r'[^\w.-]', '_', gene) for gene in genes['gene']}
+    owners = {}
+    for gene, directory in directories.items():
+        if directory in owners:
+            raise ValueError('genes "{}" and "{}" both map to the directory name "{}"; rename one of them in the gene table'.format(owners[directory], gene, directory))
+        owners[directory] = gene
+    return directories
+
+
+def genes_at(position: int, genes: pandas.DataFrame) -> numpy.ndarray:
+    '''
+    output: row indices of the genes (table from load_genes) that contain the genome position
+    '''
+    last = numpy.searchsorted(genes['start'].to_numpy(), position, side = 'right')
+    return numpy.flatnonzero(genes['end'].to_numpy()[:last] >= position)
+
+
+def gene_codon_offsets(genes: pandas.DataFrame, orf_start: int) -> typing.Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    '''
+    input: gene table from load_genes; genome position of the first base of codon 1 of a codon table
+    output: (codon number of the table at which each gene's codon 1 sits minus one, number of complete codons
+            of each gene, whether each gene is in the frame of the table); the offset is negative for genes that
+            start upstream of orf_start, whose codons before codon 1 of the table are simply not covered
+    '''
+    shift = genes['orf_start'].to_numpy() - orf_start
+    n_codons = (genes['end'].to_numpy() - genes['orf_start'].to_numpy() + 1) // 3
+    in_frame = shift % 3 == 0
+    return numpy.where(in_frame, shift // 3, 0), n_codons, in_frame
+
+
+def route_codon_positions(positions: numpy.ndarray, genes: pandas.DataFrame, orf_start: int) -> dict:
+    '''
+    input: codon numbers of the rows of a codon table whose codon 1 starts at genome position orf_start;
+           gene table from load_genes
+    output: dict of gene -> (row indices into positions, codon numbers of those rows within the gene); a row
+            belongs to every (overlapping) gene containing its codon
+    '''
+    offsets, n_codons, in_frame = gene_codon_offsets(genes, orf_start)
+    out_of_frame = genes.loc[~in_frame, 'gene'].tolist()
+    if out_of_frame:
+        raise ValueError('genes {} are not in the reading frame of codon tables starting at {}; convert SiNPle calls per gene instead'.format(
+            ', '.join(out_of_frame), orf_start))
+    positions = numpy.asarray(positions, dtype = numpy.int64)
+    order = numpy.argsort(positions, kind = 'stable')
+    ordered = positions[order]
+    low = numpy.searchsorted(ordered, offsets + 1, side = 'left')
+    high = numpy.searchsorted(ordered, offsets + n_codons, side = 'right')
+    return {gene: (order[lo:hi], ordered[lo:hi] - offset) for gene, offset, lo, hi in zip(genes['gene'], offsets, low, high)}
@@ -0,0 +1,331 @@
+import argparse
+import base64
+import json
+import os
+import numpy
+
+from codon_tables import AMINO_ACIDS, load_codon_table, per_codon_summary, aa_frequency_matrix
+from logo_render import SKYLIGN_PROTEIN
+
+'''
+Self-contained interactive HTML report of filtered codon tables.
+
+Instead of one 600 dpi PNG per sample and plot, the per-codon aggregates of every sample (read depth,
+frequency of 1/2/3 nucleotide changes, of synonymous/nonsynonymous/stop changes and the position x amino
+acid frequency matrix behind the logo plots) are computed once with codon_tables.per_codon_summary() and
+embedded in a single HTML file as base64 encoded little-endian float32 arrays.  Line plots, stacked bars and
+logos are drawn client-side on canvases, with zoom (mouse wheel or drag on any track, double click to reset)
+and a per-sample toggle.
+
+Tracks longer than the overview size are also embedded as min/max envelopes over equal-width position buckets,
+which the browser draws while zoomed out so extreme values stay visible without drawing every codon.
+'''
+
+# track key in per_codon_summary -> label shown in the report
+TRACKS = {'total_read_depth': 'read depth',
+          'all_nt_muts_freq': 'mutational frequency (all changes)',
+          'nt_change_1_freq': 'frequency of 1 nt changes',
+          'nt_change_2_freq': 'frequency of 2 nt changes',
+          'nt_change_3_freq': 'frequency of 3 nt changes',
+          'aa_type_change_synonymous_freq': 'frequency of synonymous changes',
+          'aa_type_change_nonsynonymous_freq': 'frequency of nonsynonymous changes',
+          'aa_type_change_stop_freq': 'frequency of stop changes',
+          'aa_diversity': 'amino acid diversity'}
+
+
+def encode_array(values: numpy.ndarray, dtype: str = '<f4') -> str:
+    ''' base64 of the raw little-endian bytes of values, decoded in the browser into a typed array '''
+    return base64.b64encode(numpy.ascontiguousarray(values, dtype = dtype).tobytes()).decode('ascii')
+
+
+def minmax_downsample(x: numpy.ndarray, y: numpy.ndarray, n_buckets: int) -> dict:
+    '''
+    input: sorted positions, values (nan allowed) and the number of equal-width position buckets
+    output: dict with x (bucket centers), min and max (nan for empty buckets) of y in every bucket
+    '''
+    x = numpy.asarray(x, dtype = numpy.float64)
+    y = numpy.asarray(y, dtype = numpy.float64)
+    edges = numpy.linspace(x[0], x[-1] + 1, n_buckets + 1)
+    bucket = numpy.clip(numpy.searchsorted(edges, x, side = 'right') - 1, 0, n_buckets - 1)
+    finite = numpy.isfinite(y)
+    bucket_min = numpy.full(n_buckets, numpy.inf)
+    bucket_max = numpy.full(n_buckets, -numpy.inf)
+    numpy.minimum.at(bucket_min, bucket[finite], y[finite])
+    numpy.maximum.at(bucket_max, bucket[finite], y[finite])
+    empty = ~numpy.isfinite(bucket_min)
+    bucket_min[empty] = numpy.nan
+    bucket_max[empty] = numpy.nan
+    return {'x': (edges[:-1] + edges[1:]) / 2, 'min': bucket_min, 'max': bucket_max}
+
+
+def build_report_data(df_hash: dict, colors: dict, nonsynOnly: bool = False, overview_points: int = 1000) -> dict:
+    '''
+    input: df_hash of sample -> filtered codon table, colors of sample -> color
+    output: json-serializable dict with the shared codon positions and, per sample, every track in TRACKS
+            (plus its min/max overview when longer than overview_points) and the amino acid frequency matrix,
+            arrays base64 encoded
+    '''
+    positions = numpy.unique(numpy.concatenate([value['POSITION'].to_numpy(dtype = numpy.int64) for value in df_hash.values()]))
+    downsample = len(positions) > overview_points
+    data = {'positions': encode_array(positions, '<i4'), 'n_positions': int(len(positions)),
+            'amino_acids': ['X' if aa == '.' else aa for aa in AMINO_ACIDS],
+            'aa_colors': [SKYLIGN_PROTEIN[aa] for aa in AMINO_ACIDS],
+            'tracks': [{'key': key, 'label': label} for key, label in TRACKS.items()],
+            'nonsynOnly': nonsynOnly, 'samples': []}
+
+    for key, value in df_hash.items():
+        summary = per_codon_summary(value).reindex(positions)
+        logo_table = value.loc[value['REF_AA'] != value['AA']] if nonsynOnly else value
+        aa_freqs = aa_frequency_matrix(logo_table, positions = positions).to_numpy()
+        sample = {'name': key, 'color': colors.get(key, 'black'), 'tracks': {}, 'overview': {},
+                  'aa_freq': encode_array(aa_freqs)}
+        for track in TRACKS:
+            sample['tracks'][track] = encode_array(summary[track].to_numpy(dtype = numpy.float64))
+            if downsample:
+                envelope = minmax_downsample(positions, summary[track].to_numpy(dtype = numpy.float64), overview_points)
+                sample['overview'][track] = {part: encode_array(envelope[part]) for part in ['x', 'min', 'max']}
+        data['samples'].append(sample)
+    return data
+
+
+def render_report(data: dict, title: str) -> str:
+    ''' output: complete html document with data inlined '''
+    return REPORT_TEMPLATE.replace('__TITLE__', title).replace('__DATA__', json.dumps(data, separators = (',', ':')))
+
+
+def get_html_report(df_hash: dict, colors: dict, nonsynOnly: bool, outdir: str, title: str = 'CHIKV DMS report') -> None:
+    '''
+    input: df_hash of sample -> filtered codon table, colors of sample -> color
+    output: None; writes dms_report.html into outdir
+    '''
+    html = render_report(build_report_data(df_hash, colors, nonsynOnly = nonsynOnly), title)
+    with open(os.path.join(outdir, 'dms_report.html'), 'w') as handle:
+        handle.write(html)
+
+
+REPORT_TEMPLATE = r'''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>__TITLE__</title>
+<style>
+body{font-family:sans-serif;margin:12px;color:#222}
+h1{font-size:18px;margin:4px 0 8px}
+#controls{position:sticky;top:0;background:#fff;padding:6px 0;border-bottom:1px solid #ddd;z-index:2}
+#controls label{margin-right:12px;font-size:13px}
+.panel{margin:10px 0}
+.panel h2{font-size:14px;margin:2px 0}
+canvas{display:block;width:100%;border:1px solid #eee}
+#tip{position:fixed;pointer-events:none;background:rgba(255,255,255,.95);border:1px solid #999;font-size:12px;padding:3px 6px;display:none;z-index:3}
+</style></head>
+<body>
+<h1>__TITLE__</h1>
+<div id="controls">
+  <span id="toggles"></span>
+  <label>logo sample <select id="logoSample"></select></label>
+  <label>codons <input id="lo" type="number" style="width:70px"> - <input id="hi" type="number" style="width:70px"></label>
+  <button id="reset">reset zoom</button>
+  <span style="font-size:12px;color:#666">wheel: zoom, drag: pan, double click: reset</span>
+</div>
+<div class="panel"><h2>Mean frequency per codon by mutation type (visible samples)</h2><canvas id="bars" height="220"></canvas></div>
+<div id="tracks"></div>
+<div class="panel"><h2 id="logoTitle">Amino acid frequency logo</h2><canvas id="logo" height="220"></canvas></div>
+<div id="tip"></div>
+<script>
+const DATA = __DATA__;
+function decode(b64, type) {
+  const bin = atob(b64), buf = new Uint8Array(bin.length);
+  for (let i = 0; i < bin.length; i++) buf[i] = bin.charCodeAt(i);
+  return new type(buf.buffer);
+}
+const pos = decode(DATA.positions, Int32Array);
+const N = DATA.n_positions, NAA = DATA.amino_acids.length;
+const samples = DATA.samples.map(s => ({
+  name: s.name, color: s.color, visible: true,
+  tracks: Object.fromEntries(Object.entries(s.tracks).map(([k, v]) => [k, decode(v, Float32Array)])),
+  overview: Object.fromEntries(Object.entries(s.overview).map(([k, v]) => [k, {x: decode(v.x, Float32Array), min: decode(v.min, Float32Array), max: decode(v.max, Float32Array)}])),
+  aa: decode(s.aa_freq, Float32Array)
+}));
+const full = [pos[0], pos[N - 1]];
+let view = full.slice();
+const M = {l: 70, r: 10, t: 8, b: 22};
+
+function lowerBound(arr, v) { let a = 0, b = arr.length; while (a < b) { const m = (a + b) >> 1; if (arr[m] < v) a = m + 1; else b = m; } return a; }
+function setup(canvas) {
+  const dpr = window.devicePixelRatio || 1, w = canvas.clientWidth, h = canvas.height / (canvas._dpr || 1);
+  canvas._dpr = dpr; canvas.width = w * dpr; canvas.height = h * dpr; canvas.style.height = h + 'px';
+  const ctx = canvas.getContext('2d'); ctx.setTransform(dpr, 0, 0, dpr, 0, 0);
+  ctx.clearRect(0, 0, w, h); return [ctx, w, h];
+}
+function fmt(v) { return (v === 0 || (Math.abs(v) >= 0.01 && Math.abs(v) < 1e5)) ? (+v.toPrecision(3)).toString() : v.toExponential(2); }
+function xScale(w) { const span = Math.max(view[1] - view[0] + 1, 1); return p => M.l + (p - view[0] + 0.5) / span * (w - M.l - M.r); }
+function axes(ctx, w, h, ymax) {
+  ctx.strokeStyle = '#999'; ctx.fillStyle = '#444'; ctx.font = '11px sans-serif'; ctx.lineWidth = 1;
+  ctx.beginPath(); ctx.moveTo(M.l, M.t); ctx.lineTo(M.l, h - M.b); ctx.lineTo(w - M.r, h - M.b); ctx.stroke();
+  ctx.textAlign = 'right'; ctx.textBaseline = 'middle';
+  for (let i = 0; i <= 2; i++) ctx.fillText(fmt(ymax * i / 2), M.l - 4, h - M.b - (h - M.t - M.b) * i / 2);
+  ctx.textAlign = 'center'; ctx.textBaseline = 'top';
+  const x = xScale(w), step = Math.max(1, Math.pow(10, Math.floor(Math.log10((view[1] - view[0] + 1) / 5))));
+  for (let p = Math.ceil(view[0] / step) * step; p <= view[1]; p += step) ctx.fillText(p, x(p), h - M.b + 4);
+}
+
+function drawTrack(canvas, key) {
+  const [ctx, w, h] = setup(canvas);
+  const lo = lowerBound(pos, view[0]), hi = lowerBound(pos, view[1] + 1);
+  const useOverview = (hi - lo) > 2 * (w - M.l - M.r);
+  let ymax = 0;
+  for (const s of samples) if (s.visible) for (let i = lo; i < hi; i++) { const v = s.tracks[key][i]; if (v > ymax) ymax = v; }
+  ymax = ymax || 1;
+  axes(ctx, w, h, ymax);
+  const x = xScale(w), y = v => h - M.b - v / ymax * (h - M.t - M.b);
+  for (const s of samples) {
+    if (!s.visible) continue;
+    ctx.strokeStyle = s.color; ctx.fillStyle = s.color; ctx.lineWidth = 1;
+    if (useOverview && s.overview[key]) {
+      // min/max envelope: one vertical segment per bucket
+      const o = s.overview[key]; ctx.globalAlpha = 0.8; ctx.beginPath();
+      for (let i = 0; i < o.x.length; i++) {
+        if (o.x[i] < view[0] || o.x[i] > view[1] || isNaN(o.min[i])) continue;
+        const px = x(o.x[i]); ctx.moveTo(px, y(o.min[i])); ctx.lineTo(px, y(o.max[i]) - 0.5);
+      }
+      ctx.stroke(); ctx.globalAlpha = 1;
+    } else {
+      ctx.beginPath(); let pen = false;
+      for (let i = lo; i < hi; i++) {
+        const v = s.tracks[key][i];
+        if (isNaN(v)) { pen = false; continue; }
+        if (pen) ctx.lineTo(x(pos[i]), y(v)); else { ctx.moveTo(x(pos[i]), y(v)); pen = true; }
+      }
+      ctx.stroke();
+    }
+  }
+}
+
+function drawBars() {
+  const canvas = document.getElementById('bars'), [ctx, w, h] = setup(canvas);
+  const groups = [['aa_type_change_synonymous_freq', 'aa_type_change_nonsynonymous_freq', 'aa_type_change_stop_freq'],
+                  ['nt_change_1_freq', 'nt_change_2_freq', 'nt_change_3_freq']];
+  const shades = ['#56B4E9', '#E69F00', '#D55E00'], labels = [['syn', 'nonsyn', 'stop'], ['1 nt', '2 nt', '3 nt']];
+  const vis = samples.filter(s => s.visible);
+  const lo = lowerBound(pos, view[0]), hi = lowerBound(pos, view[1] + 1);
+  // means over the zoomed window, nan positions ignored
+  const mean = (s, k) => { let t = 0, n = 0; for (let i = lo; i < hi; i++) { const v = s.tracks[k][i]; if (!isNaN(v)) { t += v; n++; } } return n ? t / n : 0; };
+  const totals = [];
+  for (const s of vis) for (const g of groups) { let t = 0; for (const k of g) t += mean(s, k); totals.push(t); }
+  const ymax = Math.max(...totals, 1e-12), bw = (w - M.l - M.r) / Math.max(vis.length * 3, 1);
+  ctx.fillStyle = '#444'; ctx.font = '11px sans-serif'; ctx.textAlign = 'right'; ctx.textBaseline = 'middle';
+  for (let i = 0; i <= 2; i++) ctx.fillText(fmt(ymax * i / 2), M.l - 4, h - M.b - (h - M.t - M.b) * i / 2);
+  vis.forEach((s, si) => groups.forEach((g, gi) => {
+    const x0 = M.l + (si * 3 + gi) * bw + bw * 0.1; let base = h - M.b;
+    g.forEach((k, ki) => {
+      const bh = mean(s, k) / ymax * (h - M.t - M.b);
+      ctx.fillStyle = shades[ki]; ctx.fillRect(x0, base - bh, bw * 0.8, bh); base -= bh;
+    });
+    ctx.fillStyle = '#444'; ctx.textAlign = 'center'; ctx.textBaseline = 'top';
+    ctx.fillText(s.name + (gi ? ' nt' : ' aa'), x0 + bw * 0.4, h - M.b + 4);
+  }));
+  ctx.textAlign = 'left'; ctx.textBaseline = 'top';
+  shades.forEach((c, i) => { ctx.fillStyle = c; ctx.fillRect(w - 150, M.t + i * 14, 10, 10); ctx.fillStyle = '#444'; ctx.fillText(labels[0][i] + ' / ' + labels[1][i], w - 136, M.t + i * 14); });
+}
+
+function drawLogo() {
+  const canvas = document.getElementById('logo'), [ctx, w, h] = setup(canvas);
+  const s = samples[+document.getElementById('logoSample').value];
+  const lo = lowerBound(pos, view[0]), hi = lowerBound(pos, view[1] + 1);
+  document.getElementById('logoTitle').textContent = 'Amino acid frequency logo of ' + s.name + (DATA.nonsynOnly ? ' (nonsynonymous only)' : '');
+  if (view[1] - view[0] + 1 > 200) {
+    ctx.fillStyle = '#666'; ctx.font = '13px sans-serif'; ctx.textAlign = 'center';
+    ctx.fillText('zoom in to 200 codons or fewer to draw the logo', w / 2, h / 2); return;
+  }
+  let ymax = 0;
+  for (let i = lo; i < hi; i++) { let t = 0; for (let a = 0; a < NAA; a++) t += s.aa[i * NAA + a]; if (t > ymax) ymax = t; }
+  ymax = ymax || 1;
+  axes(ctx, w, h, ymax);
+  const x = xScale(w), cw = (w - M.l - M.r) / (view[1] - view[0] + 1), scaleY = (h - M.t - M.b) / ymax;
+  ctx.font = 'bold 100px monospace'; ctx.textAlign = 'left'; ctx.textBaseline = 'alphabetic';
+  const metrics = DATA.amino_acids.map(a => { const m = ctx.measureText(a); return [m.width, m.actualBoundingBoxAscent + m.actualBoundingBoxDescent, m.actualBoundingBoxDescent]; });
+  for (let i = lo; i < hi; i++) {
+    const order = [...Array(NAA).keys()].filter(a => s.aa[i * NAA + a] > 0).sort((a, b) => s.aa[i * NAA + a] - s.aa[i * NAA + b]);
+    let base = h - M.b;
+    for (const a of order) {
+      const gh = s.aa[i * NAA + a] * scaleY; if (gh < 0.5) { base -= gh; continue; }
+      const [mw, mh, md] = metrics[a];
+      ctx.save(); ctx.translate(x(pos[i]) - cw * 0.45, base); ctx.scale(cw * 0.9 / mw, gh / mh);
+      ctx.fillStyle = DATA.aa_colors[a]; ctx.fillText(DATA.amino_acids[a], 0, -md); ctx.restore();
+      base -= gh;
+    }
+  }
+}
+
+const trackCanvases = [];
+function drawAll() {
+  document.getElementById('lo').value = view[0]; document.getElementById('hi').value = view[1];
+  for (const [c, key] of trackCanvases) drawTrack(c, key);
+  drawBars(); drawLogo();
+}
+function zoomTo(a, b) {
+  const span = Math.max(Math.round(b - a), 5);
+  a = Math.max(full[0], Math.min(Math.round(a), full[1] - span)); view = [a, Math.min(full[1], a + span)]; drawAll();
+}
+function attach(canvas) {
+  const toPos = ev => { const r = canvas.getBoundingClientRect(); return view[0] + (ev.clientX - r.left - M.l) / (r.width - M.l - M.r) * (view[1] - view[0] + 1); };
+  canvas.addEventListener('wheel', ev => {
+    ev.preventDefault(); const p = toPos(ev), f = ev.deltaY > 0 ? 1.25 : 0.8;
+    zoomTo(p - (p - view[0]) * f, p + (view[1] - p) * f);
+  }, {passive: false});
+  let drag = null;
+  canvas.addEventListener('mousedown', ev => { drag = [ev.clientX, view.slice()]; });
+  window.addEventListener('mouseup', () => { drag = null; });
+  canvas.addEventListener('mousemove', ev => {
+    const tip = document.getElementById('tip');
+    if (drag) {
+      const r = canvas.getBoundingClientRect(), d = (ev.clientX - drag[0]) / (r.width - M.l - M.r) * (drag[1][1] - drag[1][0] + 1);
+      zoomTo(drag[1][0] - d, drag[1][1] - d); return;
+    }
+    if (!canvas._key) return;
+    const p = Math.round(toPos(ev)), i = lowerBound(pos, p);
+    if (i >= N || pos[i] !== p) { tip.style.display = 'none'; return; }
+    tip.innerHTML = 'codon ' + p + samples.filter(s => s.visible).map(s => '<br><span style="color:' + s.color + '">&#9632;</span> ' + s.name + ': ' + fmt(s.tracks[canvas._key][i])).join('');
+    tip.style.left = (ev.clientX + 12) + 'px'; tip.style.top = (ev.clientY + 12) + 'px'; tip.style.display = 'block';
+  });
+  canvas.addEventListener('mouseleave', () => { document.getElementById('tip').style.display = 'none'; });
+  canvas.addEventListener('dblclick', () => { view = full.slice(); drawAll(); });
+}
+
+DATA.tracks.forEach(t => {
+  const div = document.createElement('div'); div.className = 'panel';
+  div.innerHTML = '<h2>' + t.label + '</h2><canvas height="140"></canvas>';
+  document.getElementById('tracks').appendChild(div);
+  const c = div.querySelector('canvas'); c._key = t.key; trackCanvases.push([c, t.key]); attach(c);
+});
+attach(document.getElementById('logo'));
+samples.forEach((s, i) => {
+  const l = document.createElement('label');
+  l.innerHTML = '<input type="checkbox" checked> <span style="color:' + s.color + '">&#9632;</span> ' + s.name;
+  l.querySelector('input').addEventListener('change', ev => { s.visible = ev.target.checked; drawAll(); });
+  document.getElementById('toggles').appendChild(l);
+  const o = document.createElement('option'); o.value = i; o.textContent = s.name; document.getElementById('logoSample').appendChild(o);
+});
+document.getElementById('logoSample').addEventListener('change', drawLogo);
+document.getElementById('reset').addEventListener('click', () => { view = full.slice(); drawAll(); });
+for (const id of ['lo', 'hi']) document.getElementById(id).addEventListener('change', () => zoomTo(+document.getElementById('lo').value, +document.getElementById('hi').value));
+window.addEventListener('resize', drawAll);
+drawAll();
+</script>
+</body></html>
+'''
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Writes a self-contained interactive HTML report of filtered codon tables',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data', required = True, type = str, help = 'comma-separated list of filtered codon tables (e.g. from run_manifest.py <outdir>/filtered)')
+    parser.add_argument('--samplename', required = True, type = str, help = 'comma-separated list of sample names, same order as --data')
+    parser.add_argument('--colors', default = None, type = str, help = 'comma-separated list of colors, same order as --data')
+    parser.add_argument('--nonSynOnly', action = 'store_true', help = 'If setting this flag, the logo only shows nonsynonymous mutations')
+    parser.add_argument('--title', default = 'CHIKV DMS report', type = str, help = 'title of the report')
+    parser.add_argument('--outdir', default = os.getcwd(), help = 'Path to output directory')
+    args = parser.parse_args()
+
+    paths = args.data.split(',')
+    names = args.samplename.split(',')
+    colors = args.colors.split(',') if args.colors is not None else ['black'] * len(names)
+    df_hash = {name: load_codon_table(path) for name, path in zip(names, paths)}
+    get_html_report(df_hash, dict(zip(names, colors)), args.nonSynOnly, args.outdir, title = args.title)
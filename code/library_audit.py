@@ -0,0 +1,265 @@
+import pandas
+import argparse
+import typing
+import itertools
+import os
+import numpy
+
+from codon_tables import CODONS, CODON_AA_INDEX, AMINO_ACIDS, encode_codons, load_codon_table, parse_codon_range
+
+'''
+Audit of a mutant library against its design.
+
+The expected variant set of every position is enumerated from its reference codon and a design scheme:
+    - a degenerate codon in IUPAC code such as NNK, NNS, NNN or NDT, audited at the codon level;
+    - 19aa, every non-reference amino acid (stop excluded), audited at the amino acid level (any codon counts);
+    - a custom list of codons (comma-separated, or a file with a CODON column and optionally a POSITION
+      column for position specific designs), audited at the codon level.
+The reference codon (or amino acid) itself is never expected.  With a reference fasta the positions are the codons
+of --pos, by default those of the ORF: from orfStart to the first in-frame stop codon (or the end of the gene in
+whole-genome mode).
+
+Expected and observed variants are both encoded as integer keys (POSITION * 64 + codon, or POSITION * 21 +
+amino acid); missing and unexpected variants are the two numpy.isin masks between the sorted key arrays:
+    missing           - expected but not in the filtered codon table
+    under-represented - expected and observed, with a frequency below the --underQuantile quantile of the
+                        frequencies of all observed expected variants of the sample
+    unexpected        - observed but not part of the design
+'''
+
+IUPAC = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+         'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+
+AUDIT_STATUS = ['observed', 'under-represented', 'missing', 'unexpected']
+
+
+def expand_degenerate(pattern: str) -> numpy.ndarray:
+    '''
+    input: degenerate codon in IUPAC code, e.g. NNK
+    output: sorted codon codes (0-63) of every codon it stands for
+    '''
+    pattern = pattern.strip().upper()
+    if len(pattern) != 3 or any(base not in IUPAC for base in pattern):
+        raise ValueError('{} is not a degenerate codon in IUPAC code'.format(pattern))
+    codons = [''.join(bases) for bases in itertools.product(*[IUPAC[base] for base in pattern])]
+    return numpy.sort(encode_codons(pandas.Series(codons)))
+
+
+def read_custom_design(custom: str) -> pandas.DataFrame:
+    '''
+    input: comma-separated codons, or path to a csv/tsv with a CODON column and optionally a POSITION column
+    output: dataframe with CODON (code 0-63) and POSITION (0 = every position)
+    '''
+    if os.path.exists(custom):
+        design = pandas.read_csv(custom, sep = None, engine = 'python')
+    else:
+        design = pandas.DataFrame({'CODON': [codon.strip() for codon in custom.split(',') if codon.strip() != '']})
+    codes = encode_codons(design['CODON'].astype(str).str.upper())
+    if (codes < 0).any():
+        raise ValueError('invalid codons in custom design: {}'.format(', '.join(design['CODON'][codes < 0].astype(str))))
+    positions = design['POSITION'].to_numpy(dtype = numpy.int64) if 'POSITION' in design.columns else numpy.zeros(len(design), dtype = numpy.int64)
+    return pandas.DataFrame({'POSITION': positions, 'CODON': codes})
+
+
+def expected_variants(ref_codons: pandas.Series, scheme: str, custom: typing.Optional[str] = None) -> typing.Tuple[numpy.ndarray, str]:
+    '''
+    input: ref_codons, reference codon string indexed by codon position; scheme, degenerate codon, 19aa or custom;
+           custom, design for the custom scheme (see read_custom_design)
+    output: (sorted unique expected keys, level) with level 'codon' (keys POSITION * 64 + codon) or
+            'aa' (keys POSITION * 21 + index into AMINO_ACIDS)
+    '''
+    positions = ref_codons.index.to_numpy(dtype = numpy.int64)
+    ref_codes = encode_codons(ref_codons.astype(str).str.upper())
+    if scheme.lower() == '19aa':
+        stop = AMINO_ACIDS.index('.')
+        ref_aa = numpy.where(ref_codes >= 0, CODON_AA_INDEX[numpy.clip(ref_codes, 0, None)], -1)
+        aa = numpy.arange(len(AMINO_ACIDS))
+        designed = (aa[None, :] != ref_aa[:, None]) & (aa[None, :] != stop)
+        pos_idx, aa_idx = numpy.nonzero(designed)
+        return numpy.unique(positions[pos_idx] * len(AMINO_ACIDS) + aa_idx), 'aa'
+
+    if scheme.lower() == 'custom':
+        if custom is None:
+            raise ValueError('the custom design scheme needs a list or file of codons')
+        design = read_custom_design(custom)
+        everywhere = design.loc[design['POSITION'] == 0, 'CODON'].to_numpy()
+        keys = (positions[:, None] * 64 + everywhere[None, :]).ravel()
+        specific = design.loc[design['POSITION'] != 0]
+        specific = specific.loc[specific['POSITION'].isin(positions)]
+        keys = numpy.concatenate([keys, specific['POSITION'].to_numpy() * 64 + specific['CODON'].to_numpy()])
+    else:
+        codons = expand_degenerate(scheme)
+        keys = (positions[:, None] * 64 + codons[None, :]).ravel()
+    # the reference codon is not a variant
+    known = ref_codes >= 0
+    keys = numpy.setdiff1d(keys, positions[known] * 64 + ref_codes[known])
+    return numpy.unique(keys), 'codon'
+
+
+def observed_variants(df: pandas.DataFrame, level: str) -> pandas.DataFrame:
+    '''
+    input: filtered codon table; level, 'codon' or 'aa'
+    output: dataframe with KEY, POSITION, VARIANT (codon or amino acid), CNT and FREQ (summed CNT / mean DENOM of
+            the position) of every observed non-reference variant
+    '''
+    codes = encode_codons(df['CODON'].astype(str))
+    ref_codes = encode_codons(df['REF_CODON'].astype(str))
+    positions = df['POSITION'].to_numpy(dtype = numpy.int64)
+    valid = codes >= 0
+    if level == 'aa':
+        variant = numpy.where(valid, CODON_AA_INDEX[numpy.clip(codes, 0, None)], -1)
+        ref_variant = numpy.where(ref_codes >= 0, CODON_AA_INDEX[numpy.clip(ref_codes, 0, None)], -2)
+        width = len(AMINO_ACIDS)
+    else:
+        variant, ref_variant, width = codes, ref_codes, 64
+    keep = valid & (variant != ref_variant)
+    keys = positions[keep] * width + variant[keep]
+    unique_keys, inverse = numpy.unique(keys, return_inverse = True)
+    counts = numpy.bincount(inverse, weights = df['CNT'].to_numpy(dtype = numpy.float64)[keep], minlength = len(unique_keys))
+
+    position_values, position_idx = numpy.unique(positions, return_inverse = True)
+    depth = numpy.bincount(position_idx, weights = df['DENOM'].to_numpy(dtype = numpy.float64)) / numpy.bincount(position_idx)
+    key_depth = depth[numpy.searchsorted(position_values, unique_keys // width)]
+    labels = numpy.array(AMINO_ACIDS if level == 'aa' else CODONS)
+    return pandas.DataFrame({'KEY': unique_keys, 'POSITION': unique_keys // width, 'VARIANT': labels[unique_keys % width],
+                             'CNT': counts, 'FREQ': counts / key_depth})
+
+
+def audit_library(df: pandas.DataFrame, ref_codons: pandas.Series, scheme: str, custom: typing.Optional[str] = None,
+                  underQuantile: float = 0.05) -> typing.Tuple[pandas.DataFrame, pandas.DataFrame]:
+    '''
+    input: filtered codon table; ref_codons, reference codon per position (positions of the audit);
+           design scheme (see expected_variants); underQuantile, frequency quantile below which observed designed
+           variants are under-represented
+    output: (variant table with one row per expected or unexpected variant and its AUDIT_STATUS,
+             per-position summary table)
+    '''
+    expected, level = expected_variants(ref_codons, scheme, custom)
+    width = len(AMINO_ACIDS) if level == 'aa' else 64
+    df = df.loc[df['POSITION'].isin(ref_codons.index)]
+    observed = observed_variants(df, level)
+
+    is_expected = numpy.isin(observed['KEY'].to_numpy(), expected, assume_unique = True)
+    is_observed = numpy.isin(expected, observed['KEY'].to_numpy(), assume_unique = True)
+    designed_freqs = observed['FREQ'].to_numpy()[is_expected]
+    threshold = numpy.quantile(designed_freqs, underQuantile) if len(designed_freqs) else 0.0
+
+    status = numpy.where(is_expected, numpy.where(observed['FREQ'].to_numpy() < threshold, 'under-represented', 'observed'), 'unexpected')
+    labels = numpy.array(AMINO_ACIDS if level == 'aa' else CODONS)
+    missing = expected[~is_observed]
+    variants = pandas.concat([observed.assign(STATUS = status),
+                              pandas.DataFrame({'KEY': missing, 'POSITION': missing // width, 'VARIANT': labels[missing % width],
+                                                'CNT': 0.0, 'FREQ': 0.0, 'STATUS': 'missing'})], ignore_index = True)
+    variants = variants.sort_values('KEY', kind = 'stable').drop(columns = 'KEY').reset_index(drop = True)
+    variants.insert(1, 'REF_CODON', ref_codons.reindex(variants['POSITION']).to_numpy())
+    variants['STATUS'] = pandas.Categorical(variants['STATUS'], categories = AUDIT_STATUS)
+
+    # per-position counts of every status, including positions where nothing was expected or observed
+    summary = pandas.crosstab(variants['POSITION'], variants['STATUS'], dropna = False).reindex(index = ref_codons.index, columns = AUDIT_STATUS, fill_value = 0)
+    summary.columns = ['n_{}'.format(status.replace('-', '_')) for status in AUDIT_STATUS]
+    summary.insert(0, 'n_expected', numpy.bincount(numpy.searchsorted(ref_codons.index.to_numpy(), expected // width), minlength = len(ref_codons)))
+    summary.insert(0, 'REF_CODON', ref_codons.to_numpy())
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        summary['completeness'] = (summary['n_observed'] + summary['n_under_represented']) / summary['n_expected']
+    summary['unexpected_freq'] = variants.loc[variants['STATUS'] == 'unexpected'].groupby('POSITION')['FREQ'].sum().reindex(ref_codons.index, fill_value = 0.0)
+    summary.index.name = 'POSITION'
+    return variants, summary.reset_index()
+
+
+def reference_codons(sample_paths: typing.Optional[dict], pos: str, reference: typing.Optional[str], orfStart: int,
+                     orfEnd: typing.Optional[int] = None) -> pandas.Series:
+    '''
+    output: reference codon per codon position of the audit, from the reference fasta when given (every codon of
+            the --pos range, by default every codon of the ORF: up to the first in-frame stop codon, and up to the
+            genome position orfEnd when given) else from the reference codons listed in the unfiltered codon tables
+    '''
+    positions = parse_codon_range(pos)
+    if reference is not None:
+        from coordinates import CodingRegion
+
+        region = CodingRegion.from_fasta(reference, orf_start = orfStart)
+        orf_codons = region.orf_codons if orfEnd is None else min(region.orf_codons, (orfEnd - orfStart + 1) // 3)
+        first, last = positions if positions is not None else (1, orf_codons)
+        codons = numpy.arange(first, min(last, region.n_codons) + 1)
+        return pandas.Series([region.ref_codon_str(codon) for codon in codons], index = pandas.Index(codons, name = 'POSITION'))
+    tables = [load_codon_table(path, columns = ['POSITION', 'REF_CODON'], positions = positions) for path in sample_paths.values()
+              if not path.endswith('.variants')]
+    refs = pandas.concat(tables).astype({'REF_CODON': str}).drop_duplicates('POSITION').set_index('POSITION')['REF_CODON']
+    return refs.sort_index()
+
+
+def plot_library_completeness(summaries: dict, colors: dict, scheme: str, outdir: str) -> None:
+    '''
+    per-codon completeness (fraction of designed variants observed) of every sample, and the overall fraction
+    of designed variants observed, under-represented and missing
+    '''
+    import matplotlib.pyplot as plt
+
+    fig, axs = plt.subplots(1, 2, figsize = (14, 4), gridspec_kw = {'width_ratios': [4, 1]})
+    for sample, summary in summaries.items():
+        axs[0].plot(summary['POSITION'], summary['completeness'], color = colors.get(sample, 'black'), linewidth = 1, label = sample)
+    axs[0].set_ylim(-0.02, 1.02)
+    axs[0].set_xlabel('codon position')
+    axs[0].set_ylabel('fraction of designed variants observed')
+    axs[0].set_title('Library completeness per codon ({} design)'.format(scheme), fontweight = 'bold')
+    axs[0].legend(loc = 'lower right', fontsize = 8)
+
+    samples = list(summaries)
+    bottom = numpy.zeros(len(samples))
+    for column, label, color in [('n_observed', 'observed', '#009E73'), ('n_under_represented', 'under-represented', '#E69F00'), ('n_missing', 'missing', '#D55E00')]:
+        values = numpy.array([summaries[sample][column].sum() / max(summaries[sample]['n_expected'].sum(), 1) for sample in samples])
+        axs[1].bar(samples, values, bottom = bottom, color = color, label = label)
+        bottom += values
+    axs[1].set_ylabel('fraction of designed variants')
+    axs[1].tick_params(axis = 'x', rotation = 90)
+    axs[1].legend(fontsize = 8)
+    fig.tight_layout()
+    fig.savefig(os.path.join(outdir, 'library_completeness_per_codon.png'), dpi = 600, format = 'png')
+    plt.close(fig)
+
+
+def get_library_audit(df_hash: dict, sample_paths: dict, colors: dict, params: dict, outdir: str) -> None:
+    '''
+    input: df_hash of sample -> filtered codon table; params with designScheme, designCustom, underQuantile, pos,
+           reference and orfStart (and genes and gene in whole-genome mode, whose end bounds the design)
+    output: None; writes library_audit_variants_<sample>.tsv, library_audit_positions_<sample>.tsv and
+            library_completeness_per_codon.png
+    '''
+    orf_end = None
+    if params.get('gene') is not None:
+        from coordinates import load_genes
+
+        genes = load_genes(params['genes'])
+        orf_end = int(genes.loc[genes['gene'] == params['gene'], 'end'].iloc[0])
+    refs = reference_codons(sample_paths, params['pos'], params['reference'], params['orfStart'], orf_end)
+    summaries = {}
+    for key, value in df_hash.items():
+        variants, summary = audit_library(value, refs, params['designScheme'], params['designCustom'], params['underQuantile'])
+        variants.to_csv(os.path.join(outdir, 'library_audit_variants_{}.tsv'.format(key)), sep = '\t', index = False)
+        summary.to_csv(os.path.join(outdir, 'library_audit_positions_{}.tsv'.format(key)), sep = '\t', index = False)
+        summaries[key] = summary
+        print('{}: {} of {} designed variants observed, {} under-represented, {} unexpected'.format(
+            key, int(summary['n_observed'].sum() + summary['n_under_represented'].sum()), int(summary['n_expected'].sum()),
+            int(summary['n_under_represented'].sum()), int(summary['n_unexpected'].sum())))
+    plot_library_completeness(summaries, colors, params['designScheme'], outdir)
+
+
+if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('Agg')
+    from variant_filters import add_sample_arguments, load_filtered_samples
+
+    parser = argparse.ArgumentParser(description = 'Audits observed codon variants against the designed mutant library',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    add_sample_arguments(parser)
+    parser.add_argument('--designScheme', default = 'NNK', type = str, help = 'degenerate codon in IUPAC code (NNK, NNS, NNN, ...), 19aa, or custom')
+    parser.add_argument('--designCustom', default = None, type = str, help = 'custom scheme: comma-separated codons, or csv/tsv with a CODON column and optional POSITION column')
+    parser.add_argument('--underQuantile', default = 0.05, type = float, help = 'designed variants below this quantile of observed designed variant frequencies are reported as under-represented')
+    parser.add_argument('--reference', default = None, type = str, help = 'reference fasta; when given the design covers every codon of --pos (by default every codon up to the first in-frame stop), otherwise the positions listed in the codon tables')
+    parser.add_argument('--orfStart', default = 9821, type = int, help = '1-based genome position of the first base of codon 1 in --reference')
+    args = parser.parse_args()
+
+    df_hash, sample_paths, colors = load_filtered_samples(args)
+    params = {'designScheme': args.designScheme, 'designCustom': args.designCustom, 'underQuantile': args.underQuantile,
+              'pos': args.pos, 'reference': args.reference, 'orfStart': args.orfStart}
+    get_library_audit(df_hash, sample_paths, colors, params, args.outdir)
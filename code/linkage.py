@@ -0,0 +1,322 @@
+import pandas
+import argparse
+import typing
+import os
+import numpy
+
+from codon_tables import CODONS, CODON_AA, encode_codons
+
+'''
+Linkage of codon mutations across codons of the same read (or amplicon / phased haplotype).
+
+codon tables only describe each codon on its own; validating a library design (e.g. one programmed mutation
+per molecule) needs to know which mutations occur together on the same molecule.  The input is a read-level
+table, one line per read:
+
+    read_id    start    end    variants
+    r1         1        150    12:GCT,40:TAA
+    r2         9        158
+
+start/end are the first and last codon position covered by the read and variants lists every codon that
+differs from the reference as POSITION:CODON (empty if none).  simulate_reads() writes such a file with known
+linked pairs for trying the analysis out.
+
+Variants are keyed as POSITION * 64 + codon code (codon_tables.CODONS order).  The file is read in chunks; for
+every chunk the pairs of variants on the same read are generated with array operations and merged into sparse
+(key, count) arrays, so memory grows with the number of distinct variant pairs actually observed and never
+with positions squared.  Read spans and the spans of the reads carrying each variant are kept the same way,
+which gives, for every observed pair, the number of reads covering both positions and how many of those
+carry each variant, from which D, D' and r^2 are computed.
+'''
+
+PAIR_COLUMNS = ['POSITION_A', 'CODON_A', 'AA_A', 'POSITION_B', 'CODON_B', 'AA_B', 'n_covering_both', 'n_a', 'n_b', 'n_ab',
+                'freq_a', 'freq_b', 'freq_ab', 'D', 'D_prime', 'r2']
+
+
+class SparseCounter:
+    '''
+    counts of int64 keys accumulated in chunks; pending chunks are merged (sorted unique keys with summed
+    counts) once they hold more than compact_every entries, bounding memory by the number of distinct keys
+    '''
+
+    def __init__(self, compact_every: int = 5000000):
+        self.keys = numpy.zeros(0, dtype = numpy.int64)
+        self.counts = numpy.zeros(0, dtype = numpy.int64)
+        self.pending = []
+        self.pending_size = 0
+        self.compact_every = compact_every
+
+    def add(self, keys: numpy.ndarray, counts: typing.Optional[numpy.ndarray] = None) -> None:
+        keys = numpy.asarray(keys, dtype = numpy.int64)
+        counts = numpy.ones(len(keys), dtype = numpy.int64) if counts is None else numpy.asarray(counts, dtype = numpy.int64)
+        self.pending.append((keys, counts))
+        self.pending_size += len(keys)
+        if self.pending_size > self.compact_every:
+            self.compact()
+
+    def compact(self) -> None:
+        if not self.pending:
+            return
+        keys = numpy.concatenate([self.keys] + [keys for keys, _ in self.pending])
+        counts = numpy.concatenate([self.counts] + [counts for _, counts in self.pending])
+        self.keys, inverse = numpy.unique(keys, return_inverse = True)
+        self.counts = numpy.bincount(inverse, weights = counts, minlength = len(self.keys)).astype(numpy.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def items(self) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+        self.compact()
+        return self.keys, self.counts
+
+
+class LinkageCounter:
+    '''
+    streaming accumulator of variant, pair and read span counts; max_position bounds the codon positions so
+    variant, span and pair keys fit into int64
+    '''
+
+    def __init__(self, max_position: int = 100000):
+        self.n_keys = (max_position + 1) * 64
+        self.n_spans = max_position + 1
+        self.pairs = SparseCounter()        # key_a * n_keys + key_b, key_a < key_b
+        self.spans = SparseCounter()        # start * n_spans + end of every read
+        self.carrier_spans = SparseCounter() # variant key * n_spans^2 + span key of every variant observation
+        self.mutations_per_read = numpy.zeros(0, dtype = numpy.int64)
+        self.n_reads = 0
+
+    def update(self, starts: numpy.ndarray, ends: numpy.ndarray, read_index: numpy.ndarray, positions: numpy.ndarray, codons: numpy.ndarray) -> None:
+        '''
+        input: starts/ends, codon span of every read of the chunk; read_index, positions and codons (0-63) of
+               every variant observation, read_index pointing into starts/ends
+        '''
+        starts = numpy.asarray(starts, dtype = numpy.int64)
+        ends = numpy.asarray(ends, dtype = numpy.int64)
+        if ((starts < 0) | (ends >= self.n_spans)).any() or (numpy.asarray(positions) >= self.n_spans).any():
+            raise ValueError('codon positions above max_position ({})'.format(self.n_spans - 1))
+        span_keys = starts * self.n_spans + ends
+        self.spans.add(span_keys)
+        self.n_reads += len(starts)
+
+        keys = numpy.asarray(positions, dtype = numpy.int64) * 64 + numpy.asarray(codons, dtype = numpy.int64)
+        read_index = numpy.asarray(read_index, dtype = numpy.int64)
+        # one observation per (read, variant)
+        order = numpy.lexsort((keys, read_index))
+        read_index, keys = read_index[order], keys[order]
+        unique = numpy.ones(len(keys), dtype = bool)
+        unique[1:] = (read_index[1:] != read_index[:-1]) | (keys[1:] != keys[:-1])
+        read_index, keys = read_index[unique], keys[unique]
+
+        self.carrier_spans.add(keys * (self.n_spans * self.n_spans) + span_keys[read_index])
+        per_read = numpy.bincount(read_index, minlength = len(starts))
+        self.mutations_per_read = _add_padded(self.mutations_per_read, numpy.bincount(per_read))
+
+        # all pairs of variants within reads carrying k variants, for every k at once
+        offsets = numpy.concatenate([[0], numpy.cumsum(per_read)])
+        for k in numpy.unique(per_read[per_read >= 2]):
+            reads = numpy.flatnonzero(per_read == k)
+            block = keys[offsets[reads][:, None] + numpy.arange(k)[None, :]]
+            first, second = numpy.triu_indices(k, k = 1)
+            self.pairs.add(block[:, first].ravel() * self.n_keys + block[:, second].ravel())
+
+    def add_reads(self, reads: typing.Iterable[typing.Tuple[int, int, list]]) -> None:
+        '''
+        input: iterable of (start, end, [(position, codon string), ...]) for one chunk of reads
+        '''
+        starts, ends, read_index, positions, codons = [], [], [], [], []
+        for idx, (start, end, variants) in enumerate(reads):
+            starts.append(start)
+            ends.append(end)
+            for position, codon in variants:
+                read_index.append(idx)
+                positions.append(position)
+                codons.append(codon)
+        codes = encode_codons(pandas.Series(codons, dtype = object)) if codons else numpy.zeros(0, dtype = numpy.int64)
+        valid = codes >= 0 # codons with N or other non A/C/G/T bases are skipped
+        self.update(numpy.array(starts, dtype = numpy.int64), numpy.array(ends, dtype = numpy.int64),
+                    numpy.array(read_index, dtype = numpy.int64)[valid], numpy.array(positions, dtype = numpy.int64)[valid], codes[valid])
+
+    def statistics(self, min_pair_count: int = 2, chunk_size: int = 200000) -> pandas.DataFrame:
+        '''
+        output: dataframe with PAIR_COLUMNS for every variant pair seen together on at least min_pair_count reads;
+                frequencies are among the reads covering both positions
+        '''
+        pair_keys, n_ab = self.pairs.items()
+        keep = n_ab >= min_pair_count
+        pair_keys, n_ab = pair_keys[keep], n_ab[keep]
+        key_a, key_b = pair_keys // self.n_keys, pair_keys % self.n_keys
+        pos_a, pos_b = key_a // 64, key_b // 64
+
+        span_keys, span_counts = self.spans.items()
+        span_start, span_end = span_keys // self.n_spans, span_keys % self.n_spans
+        carrier_keys, carrier_counts = self.carrier_spans.items()
+        carrier_variant = carrier_keys // (self.n_spans * self.n_spans)
+        carrier_span = carrier_keys % (self.n_spans * self.n_spans)
+        carrier_start, carrier_end = carrier_span // self.n_spans, carrier_span % self.n_spans
+
+        # reads covering both positions, from the distinct read spans; pairs are processed in blocks to bound memory
+        n_both = numpy.zeros(len(pair_keys), dtype = numpy.int64)
+        step = max(1, chunk_size // max(len(span_keys), 1))
+        for first in range(0, len(pair_keys), step):
+            rows = slice(first, first + step)
+            covering = (span_start[None, :] <= pos_a[rows, None]) & (span_end[None, :] >= pos_b[rows, None])
+            n_both[rows] = covering.astype(numpy.int64) @ span_counts
+        # reads carrying a variant that also cover the other position of the pair
+        n_a = _carriers_covering(key_a, pos_b, carrier_variant, carrier_start, carrier_end, carrier_counts)
+        n_b = _carriers_covering(key_b, pos_a, carrier_variant, carrier_start, carrier_end, carrier_counts)
+
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            freq_a, freq_b, freq_ab = n_a / n_both, n_b / n_both, n_ab / n_both
+            D = freq_ab - freq_a * freq_b
+            d_max = numpy.where(D > 0, numpy.minimum(freq_a * (1 - freq_b), (1 - freq_a) * freq_b),
+                                numpy.minimum(freq_a * freq_b, (1 - freq_a) * (1 - freq_b)))
+            D_prime = numpy.where(d_max > 0, D / d_max, numpy.nan)
+            r2 = D * D / (freq_a * (1 - freq_a) * freq_b * (1 - freq_b))
+
+        codon_names = numpy.array(CODONS)
+        return pandas.DataFrame({'POSITION_A': pos_a, 'CODON_A': codon_names[key_a % 64], 'AA_A': CODON_AA[key_a % 64],
+                                 'POSITION_B': pos_b, 'CODON_B': codon_names[key_b % 64], 'AA_B': CODON_AA[key_b % 64],
+                                 'n_covering_both': n_both, 'n_a': n_a, 'n_b': n_b, 'n_ab': n_ab,
+                                 'freq_a': freq_a, 'freq_b': freq_b, 'freq_ab': freq_ab, 'D': D, 'D_prime': D_prime, 'r2': r2},
+                                columns = PAIR_COLUMNS)
+
+
+def _add_padded(total: numpy.ndarray, values: numpy.ndarray) -> numpy.ndarray:
+    size = max(len(total), len(values))
+    return numpy.pad(total, (0, size - len(total))) + numpy.pad(values, (0, size - len(values)))
+
+
+def _carriers_covering(keys: numpy.ndarray, other_pos: numpy.ndarray, carrier_variant: numpy.ndarray,
+                       carrier_start: numpy.ndarray, carrier_end: numpy.ndarray, carrier_counts: numpy.ndarray) -> numpy.ndarray:
+    '''
+    for every (variant key, other position) query: number of reads carrying the variant whose span covers other_pos
+    carrier arrays are sorted by variant, so each variant's spans are one contiguous segment
+    '''
+    first = numpy.searchsorted(carrier_variant, keys, side = 'left')
+    last = numpy.searchsorted(carrier_variant, keys, side = 'right')
+    lengths = last - first
+    query = numpy.repeat(numpy.arange(len(keys)), lengths)
+    entry = numpy.repeat(first - numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]]), lengths) + numpy.arange(lengths.sum())
+    covers = (carrier_start[entry] <= other_pos[query]) & (carrier_end[entry] >= other_pos[query])
+    return numpy.bincount(query[covers], weights = carrier_counts[entry][covers], minlength = len(keys)).astype(numpy.int64)
+
+
+def parse_read_line(line: str) -> typing.Optional[typing.Tuple[int, int, list]]:
+    '''
+    input: one line of a read-level variant table
+    output: (start, end, [(position, codon), ...]) or None for the header and blank lines
+    '''
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) < 3 or not fields[1].strip().isdigit():
+        return None
+    variants = []
+    if len(fields) > 3 and fields[3].strip() not in ('', '-'):
+        for variant in fields[3].split(','):
+            position, codon = variant.split(':')
+            variants.append((int(position), codon.strip().upper()))
+    return int(fields[1]), int(fields[2]), variants
+
+
+def count_linkage(reads: str, chunk_size: int = 100000, max_position: int = 100000) -> LinkageCounter:
+    '''
+    input: path to a read-level variant table; reads per chunk
+    output: LinkageCounter holding the counts of the whole file, read once in chunks
+    '''
+    counter = LinkageCounter(max_position = max_position)
+    chunk = []
+    with open(reads, 'r') as handle:
+        for line in handle:
+            parsed = parse_read_line(line)
+            if parsed is None:
+                continue
+            chunk.append(parsed)
+            if len(chunk) >= chunk_size:
+                counter.add_reads(chunk)
+                chunk = []
+    if chunk:
+        counter.add_reads(chunk)
+    return counter
+
+
+def simulate_reads(outfile: str, reference_codons: typing.List[str], n_reads: int = 10000, amplicons: typing.Optional[typing.List[typing.Tuple[int, int]]] = None,
+                   mutation_rate: float = 0.002, linked_pairs: typing.Optional[list] = None, seed: int = 0) -> None:
+    '''
+    writes a toy read-level variant table
+    input: reference_codons, reference codon string of codons 1..n; amplicons, (start, end) codon spans reads are
+           drawn from (default one amplicon over all codons); mutation_rate, per codon probability of a random
+           non-reference codon; linked_pairs, list of ((position, codon), (position, codon), probability): with the
+           given probability a read covering both positions carries both codons
+    '''
+    rng = numpy.random.default_rng(seed)
+    n_codons = len(reference_codons)
+    amplicons = amplicons if amplicons is not None else [(1, n_codons)]
+    linked_pairs = linked_pairs if linked_pairs is not None else []
+    with open(outfile, 'w') as out:
+        out.write('read_id\tstart\tend\tvariants\n')
+        for read in range(n_reads):
+            start, end = amplicons[rng.integers(len(amplicons))]
+            variants = {}
+            mutated = start + numpy.flatnonzero(rng.random(end - start + 1) < mutation_rate)
+            for position in mutated:
+                choices = [codon for codon in CODONS if codon != reference_codons[position - 1]]
+                variants[int(position)] = choices[rng.integers(len(choices))]
+            for (pos_a, codon_a), (pos_b, codon_b), probability in linked_pairs:
+                if start <= min(pos_a, pos_b) and max(pos_a, pos_b) <= end and rng.random() < probability:
+                    variants[pos_a] = codon_a
+                    variants[pos_b] = codon_b
+            out.write('r{}\t{}\t{}\t{}\n'.format(read, start, end, ','.join('{}:{}'.format(pos, codon) for pos, codon in sorted(variants.items()))))
+
+
+def plot_linkage(pairs: pandas.DataFrame, mutations_per_read: numpy.ndarray, sample_name: str, outdir: str) -> None:
+    '''
+    r^2 of every pair against the distance between its codons, and the distribution of mutated codons per read
+    '''
+    import matplotlib.pyplot as plt
+
+    fig, axs = plt.subplots(1, 2, figsize = (12, 4))
+    axs[0].scatter(pairs['POSITION_B'] - pairs['POSITION_A'], pairs['r2'], s = 4, alpha = 0.4, color = 'black', rasterized = True)
+    axs[0].set_xlabel('distance between codons')
+    axs[0].set_ylabel('r$^2$')
+    axs[0].set_title('Linkage of co-occurring codon mutations')
+    axs[1].bar(numpy.arange(len(mutations_per_read)), mutations_per_read, color = '#56B4E9')
+    axs[1].set_xlabel('mutated codons per read')
+    axs[1].set_ylabel('reads')
+    axs[1].set_yscale('log')
+    axs[1].set_title('Mutations per read')
+    fig.suptitle(sample_name, fontweight = 'bold')
+    fig.tight_layout()
+    fig.savefig(os.path.join(outdir, 'linkage_{}.png'.format(sample_name)), dpi = 600, format = 'png')
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Counts co-occurring codon mutations on the same reads and reports pairwise linkage (D, D\', r^2)',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--reads', required = True, type = str, help = 'read-level variant table (read_id, start, end, variants as POSITION:CODON,...); written when --simulate is set')
+    parser.add_argument('--sampleName', default = 'sample_1', type = str, help = 'name used in output file names')
+    parser.add_argument('--minPairCount', default = 2, type = int, help = 'minimum number of reads carrying both variants to report a pair')
+    parser.add_argument('--chunkSize', default = 100000, type = int, help = 'number of reads processed at once')
+    parser.add_argument('--outdir', default = os.getcwd(), help = 'Path to output directory')
+    parser.add_argument('--simulate', action = 'store_true', help = 'first write a toy read table to --reads from --reference (codons from --orfStart), with two linked pairs')
+    parser.add_argument('--reference', default = None, type = str, help = 'reference fasta for --simulate')
+    parser.add_argument('--orfStart', default = 9821, type = int, help = '1-based genome position of the first base of codon 1 for --simulate')
+    parser.add_argument('--nCodons', default = 400, type = int, help = 'number of codons of the toy reads for --simulate')
+    args = parser.parse_args()
+
+    if args.simulate:
+        from coordinates import CodingRegion
+
+        if args.reference is None:
+            raise SystemExit('--simulate needs --reference')
+        region = CodingRegion.from_fasta(args.reference, orf_start = args.orfStart)
+        reference_codons = [region.ref_codon_str(codon) for codon in range(1, args.nCodons + 1)]
+        amplicons = [(start, min(start + 149, args.nCodons)) for start in range(1, args.nCodons + 1, 100)]
+        simulate_reads(args.reads, reference_codons, amplicons = amplicons,
+                       linked_pairs = [((20, 'TGG'), (60, 'TAA'), 0.05), ((110, 'GCT'), (130, 'GCT'), 0.02)])
+
+    counter = count_linkage(args.reads, chunk_size = args.chunkSize)
+    pairs = counter.statistics(min_pair_count = args.minPairCount).sort_values('r2', ascending = False)
+    pairs.to_csv(os.path.join(args.outdir, 'linkage_pairs_{}.tsv'.format(args.sampleName)), sep = '\t', index = False)
+    pandas.DataFrame({'mutated_codons': numpy.arange(len(counter.mutations_per_read)), 'reads': counter.mutations_per_read}).to_csv(
+        os.path.join(args.outdir, 'mutations_per_read_{}.tsv'.format(args.sampleName)), sep = '\t', index = False)
+    plot_linkage(pairs, counter.mutations_per_read, args.sampleName, args.outdir)
+    print('{} reads, {} variant pairs reported'.format(counter.n_reads, len(pairs)))
@@ -1,6 +1,13 @@
 import pandas
 import typing
 import argparse
+import math
+import concurrent.futures
+import numpy
+
+from coordinates import load_annotations, assign_regions
+from logo_render import draw_logo
+from codon_store import read_position_range
 
 '''
 def format_data()
@@ -9,91 +16,190 @@ def format_data()
         - AA: amino acid to plot, generally this is a single letter amino acid symbol
         - MERGE_FRAC: float [0-1] that shows the height/frequency of the amino acid symbol to plot on the logoplot
     output is a pandas dataframe that is formatted for logomaker in input into def generate_logo_plot()
+    a .parquet input (from codon_store.py) only reads the row groups covering positions, an inclusive (start, end) range
 '''
-def format_data(data_input:pandas.DataFrame) -> pandas.DataFrame:
-     pandas_df = pandas.read_csv(data_input)
+def format_data(data_input:pandas.DataFrame, positions:typing.Optional[typing.Tuple[typing.Optional[int], typing.Optional[int]]] = None) -> pandas.DataFrame:
+     if data_input.endswith('.parquet'):
+         pandas_df = read_position_range(data_input, positions = positions, columns = ['POSITION', 'AA', 'MERGE_FRAC'])
+     else:
+         pandas_df = pandas.read_csv(data_input)
      info_df = pandas_df[['POSITION', 'AA', 'MERGE_FRAC']]
      info_pivot_matrix = info_df.pivot(index = "POSITION", columns = "AA", values = "MERGE_FRAC")
      info_pivot_matrix.fillna(0, inplace=True)
      return info_pivot_matrix
 
 
-def generate_logo_plot(matrix_input:pandas.DataFrame, sample_name:str, annotations:str, increment:int, min_label_len:int) -> None:
-    import json
-    import logomaker
-    import matplotlib.pyplot as plt
-    import math
-    import matplotlib.ticker as mtick
-    
-
-    #assume sorted by start position
-    annot_data = pandas.read_csv(annotations)
-    annot_data = annot_data.to_dict("index")
-
-    # index maps for annotation start and end positions
-    breakpoints = {}
-    for key,value in annot_data.items():
-        breakpoints[key] = range(value['start'], value['end'])
-
+def match_annotation(ax, annot_df: pandas.DataFrame, position_start: int, position_end: int, min_label_len: int, y: float = 1.05) -> None:
     '''
     function to apply annotations to top of logoplots
-        func name: def match_annotation()
-        input:  position_start specifies the codon start postion for the graph line being contructed;
+        input:  ax, axes of the graph line being constructed; annot_df, annotations from coordinates.load_annotations();
+                position_start specifies the codon start postion for the graph line being contructed;
                 position_end specifies the last codon position to be plotted for the graph being constructed;
                 min_label_len of consecutive amino acids under an annotation bar; anything smaller (non-inclusive) than
                 this value will not have text written in the bar, to help prevent text from overflowing into margins
         output: None; adds annotation texts and bars to backend plot but does not return any objects
     '''
-    def match_annotation(position_start:int, position_end:int, min_label_len:int) -> None:
-        annot_start = -1
-        annot_end = -1
-
-        # find the annotation of the lowest codon and the annotation of the largest position codon
-        for key,value in breakpoints.items():
-            if position_start in value:
-                annot_start = key
-            if position_end in value:
-                annot_end = key    
-     
-        # if the start and end annotations are the same, plotting is easy as it is all the same color, no breakpoints
-        if annot_start == annot_end:
-            # rectangular box display control
-            ax.plot([position_start-1, position_end+1], [y+0.1, y+0.1], alpha= 0.5, color = annot_data[annot_start]['color'], linewidth = 10, solid_capstyle="butt")
-            if (position_end - position_start) >= min_label_len: # text control
-              ax.text(((position_start-1 +position_end+1)/2), 1.1 ,annot_data[annot_start]['region_name'],fontsize=10)     
-        
-        # when the graph has 2 or more annotation bars present on the same line, we must identify all the breakpoints
+    annot_data = annot_df.to_dict("index")
+    # find the annotation of the lowest codon and the annotation of the largest position codon
+    annot_start, annot_end = [int(key) for key in assign_regions([position_start, position_end], annot_df)]
+ 
+    # if the start and end annotations are the same, plotting is easy as it is all the same color, no breakpoints
+    if annot_start == annot_end:
+        # rectangular box display control
+        ax.plot([position_start-1, position_end+1], [y+0.1, y+0.1], alpha= 0.5, color = annot_data[annot_start]['color'], linewidth = 10, solid_capstyle="butt")
+        if (position_end - position_start) >= min_label_len: # text control
+          ax.text(((position_start-1 +position_end+1)/2), 1.1 ,annot_data[annot_start]['region_name'],fontsize=10)     
+    
+    # when the graph has 2 or more annotation bars present on the same line, we must identify all the breakpoints
+    else:
+      for subannotations in enumerate(range(annot_start, annot_end + 1)):
+          if subannotations[0] == 0: # meaning it is the left most annotatation
+              begin = max(annot_data[annot_start]['start'], position_start)
+              end = annot_data[annot_start]['end']
+              ax.plot([begin-1, end+1], [y+0.1, y+0.1], alpha= 0.5, color = annot_data[annot_start]['color'], linewidth = 10, solid_capstyle="butt")
+              if (end - begin) >= min_label_len:
+                ax.text(((begin-1 + end+1)/2), 1.1 ,annot_data[annot_start]['region_name'],fontsize=10)
+          elif subannotations[0] == len(range(annot_start, annot_end)): # meaning it is the right most or last annotation
+              begin = annot_data[annot_end]['start']
+              end = min(annot_data[annot_end]['end'], position_end)
+              ax.plot([begin, end+1], [y+0.1, y+0.1], alpha= 0.5, color = annot_data[annot_end]['color'], linewidth = 10, solid_capstyle="butt")
+              if (end - begin) >= min_label_len:
+                ax.text(((begin + end+1)/2), 1.1 ,annot_data[annot_end]['region_name'],fontsize=10)
+          else: # means there are at least 3 annotations, so any annotation in -between the start and end annotations need to be plotted in full
+              begin = annot_data[subannotations[1]]['start']
+              end = annot_data[subannotations[1]]['end']
+              ax.plot([begin, end+1], [y+0.1, y+0.1], alpha= 0.5, color = annot_data[subannotations[1]]['color'], linewidth = 10, solid_capstyle="butt")
+              if (end - begin) >= min_label_len:
+                ax.text(((begin + end+1)/2), 1.1 ,annot_data[subannotations[1]]['region_name'],fontsize=10)                  
+
+
+def row_windows(start_pos: int, end_pos: int, increment: int) -> typing.List[typing.Tuple[int, int]]:
+    '''
+    output: (start, end) codon window of every row of the logo plot, in order
+    '''
+    windows = []
+    start = start_pos
+    end = min(start + increment, end_pos)
+    num_rows = math.ceil((end_pos - start_pos + 1) / increment)
+    for i in range(0, num_rows):
+        windows.append((start, end))
+        # calculate next set of position ranges
+        start = end + 1
+        if (end + increment) > end_pos:
+            end = end_pos # last graph  may be smaller than the increment amount so scale accordingly
         else:
-          for subannotations in enumerate(range(annot_start, annot_end + 1)):
-              if subannotations[0] == 0: # meaning it is the left most annotatation
-                  begin = max(annot_data[annot_start]['start'], position_start)
-                  end = annot_data[annot_start]['end']
-                  ax.plot([begin-1, end+1], [y+0.1, y+0.1], alpha= 0.5, color = annot_data[annot_start]['color'], linewidth = 10, solid_capstyle="butt")
-                  if (end - begin) >= min_label_len:
-                    ax.text(((begin-1 + end+1)/2), 1.1 ,annot_data[annot_start]['region_name'],fontsize=10)
-              elif subannotations[0] == len(range(annot_start, annot_end)): # meaning it is the right most or last annotation
-                  begin = annot_data[annot_end]['start']
-                  end = min(annot_data[annot_end]['end'], position_end)
-                  ax.plot([begin, end+1], [y+0.1, y+0.1], alpha= 0.5, color = annot_data[annot_end]['color'], linewidth = 10, solid_capstyle="butt")
-                  if (end - begin) >= min_label_len:
-                    ax.text(((begin + end+1)/2), 1.1 ,annot_data[annot_end]['region_name'],fontsize=10)
-              else: # means there are at least 3 annotations, so any annotation in -between the start and end annotations need to be plotted in full
-                  begin = annot_data[subannotations[1]]['start']
-                  end = annot_data[subannotations[1]]['end']
-                  ax.plot([begin, end+1], [y+0.1, y+0.1], alpha= 0.5, color = annot_data[subannotations[1]]['color'], linewidth = 10, solid_capstyle="butt")
-                  if (end - begin) >= min_label_len:
-                    ax.text(((begin + end+1)/2), 1.1 ,annot_data[subannotations[1]]['region_name'],fontsize=10)                  
-               
+            end = end + increment
+    return windows
+
+
+def draw_logo_row(ax, tmp: pandas.DataFrame, annot_df: typing.Optional[pandas.DataFrame], start: int, end: int, min_label_len: int) -> None:
+    '''
+    draws one row (codons start..end) of the logo plot and its annotation bar into ax
+    '''
+    import matplotlib.ticker as mtick
+
+    draw_logo(tmp, ax=ax, show_spines=True, stack_order = "fixed") # fixed keeps order of aa based on matrix order; in this case alphabetically
+ 
+    ax.set_ylim([0,1.5]) # make sure all axises are the same; be careful to not truncate to early though; 4 bits can represent 16 values
+    ax.set_yticks([0, 1])
+    ax.set_yticklabels(['0.0','1.0'])
+    ax.spines['left'].set_color('white')
+    ax.spines['right'].set_color('white')
+    ax.spines['top'].set_color('white')
+    #ax.spines['bottom'].set_color('white')
+    #ax.set_ylabel('aa diversity per codon')
+    #ax.set_xlabel('codon position')
+    ax.xaxis.set_major_locator(mtick.MaxNLocator(integer=True)) 
+
+    # if annotations are available, annotate the graphs
+    if annot_df is not None:
+        match_annotation(ax, annot_df, position_start=start, position_end=end, min_label_len= min_label_len)
+
+
+def render_logo_tile(tmp: pandas.DataFrame, annot_df: typing.Optional[pandas.DataFrame], start: int, end: int, min_label_len: int,
+                     figsize: typing.Tuple[float, float], dpi: int) -> numpy.ndarray:
+    '''
+    renders one row of the logo plot as an independent figure; runs in a worker process
+    output: uint8 RGB image array (height x width x 3)
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(1, 1, figsize = figsize, dpi = dpi)
+    draw_logo_row(ax, tmp, annot_df, start, end, min_label_len)
+    fig.tight_layout()
+    fig.canvas.draw()
+    tile = numpy.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+    plt.close(fig)
+    return tile
+
+
+def render_text_strip(text: str, fontsize: float, width: float, height: float, dpi: int, rotation: float = 0) -> numpy.ndarray:
+    ''' title/axis label strip of the stitched figure as a uint8 RGB image array '''
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize = (width, height), dpi = dpi)
+    fig.text(0.5, 0.5, text, fontsize = fontsize, ha = 'center', va = 'center', rotation = rotation)
+    fig.canvas.draw()
+    strip = numpy.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+    plt.close(fig)
+    return strip
+
+
+def generate_logo_plot(matrix_input:pandas.DataFrame, sample_name:str, annotations:str, increment:int, min_label_len:int,
+                       start_pos:typing.Optional[int] = None, end_pos:typing.Optional[int] = None,
+                       threads:int = 1, pages:bool = False) -> None:
+    '''
+    threads > 1 renders every row as an independent tile in a process pool and stitches the tiles in row order
+    into the same png; pages writes the tiles as the pages of a multi-page pdf instead (implies tile rendering)
+    '''
+    import matplotlib.pyplot as plt
+
+    # sorted by start position; positions are assigned to annotations with a binary search
+    annot_df = load_annotations(annotations) if annotations != None else None
 
     # Counts matrix -> Information matrix
     height_per_row = 2
     width_per_col = 15
-    start=args.codonStartPos
-    end=start+increment
-    y = 1.05
-    endPos=max(matrix_input.index)
-    num_pos=endPos-start+1
-    num_rows = math.ceil(num_pos/increment)
+    if start_pos is None:
+        start_pos = min(matrix_input.index)
+    if end_pos is None:
+        end_pos = max(matrix_input.index)
+    matrix_input = matrix_input.loc[start_pos:end_pos]
+    windows = row_windows(start_pos, end_pos, increment)
+    num_rows = len(windows)
+    outfile = '{}_logoplot_of_diversity_of_amino_acids_present_per_codon_position'.format(sample_name)
+
+    if threads > 1 or pages:
+        # each row is rendered independently; results come back in submission order
+        with concurrent.futures.ProcessPoolExecutor(max_workers = max(threads, 1)) as pool:
+            futures = [pool.submit(render_logo_tile, matrix_input.loc[start:end], annot_df, start, end, min_label_len,
+                                   (width_per_col, height_per_row), 600) for start, end in windows]
+            tiles = [future.result() for future in futures]
+
+        if pages:
+            from matplotlib.backends.backend_pdf import PdfPages
+            with PdfPages('{}.pdf'.format(outfile)) as pdf:
+                for page, tile in enumerate(tiles):
+                    fig = plt.figure(figsize = (tile.shape[1] / 600, tile.shape[0] / 600), dpi = 600)
+                    fig.figimage(tile, 0, 0)
+                    if page == 0:
+                        fig.suptitle('All mutations for {} library'.format(sample_name), fontsize=15)
+                    pdf.savefig(fig, dpi = 600)
+                    plt.close(fig)
+        else:
+            width = max(tile.shape[1] for tile in tiles)
+            body = numpy.concatenate([numpy.pad(tile, ((0, 0), (0, width - tile.shape[1]), (0, 0)), constant_values = 255) for tile in tiles])
+            title = render_text_strip('All mutations for {} library \n'.format(sample_name), 15, width / 600, 0.5, 600)
+            xlabel = render_text_strip('codon position', 12, width / 600, 0.3, 600)
+            ylabel = render_text_strip('amino acid diversity per codon (absence vs presence)', 12, 0.3, body.shape[0] / 600, 600, rotation = 90)
+            body = numpy.concatenate([ylabel[:body.shape[0]], body], axis = 1)
+            pad = body.shape[1] - width
+            stitched = numpy.concatenate([numpy.pad(title, ((0, 0), (pad, 0), (0, 0)), constant_values = 255), body,
+                                          numpy.pad(xlabel, ((0, 0), (pad, 0), (0, 0)), constant_values = 255)])
+            plt.imsave('{}.png'.format(outfile), stitched, dpi = 600, format = 'png')
+        return
 
     # sets figure size, title, and x-/y-axis labels
     fig = plt.figure(figsize=[width_per_col * 1, height_per_row * num_rows])
@@ -103,41 +209,19 @@ def generate_logo_plot(matrix_input:pandas.DataFrame, sample_name:str, annotatio
     
     # loop if a graph for each row of the logo plot; each loop is one plot
     # rows are dictated by calculation above
-    for i in range(0, num_rows):
+    for i, (start, end) in enumerate(windows):
           tmp=matrix_input.loc[start:end]
           ax = plt.subplot2grid((num_rows, 1), (i, 0))
-          logomaker.Logo(tmp, ax=ax, color_scheme="skylign_protein", show_spines=True, stack_order = "fixed") # fixed keeps order of aa based on matrix order; in this case alphabetically
-     
-          ax.set_ylim([0,1.5]) # make sure all axises are the same; be careful to not truncate to early though; 4 bits can represent 16 values
-          ax.set_yticks([0, 1])
-          ax.set_yticklabels(['0.0','1.0'])
-          ax.spines['left'].set_color('white')
-          ax.spines['right'].set_color('white')
-          ax.spines['top'].set_color('white')
-          #ax.spines['bottom'].set_color('white')
-          #ax.set_ylabel('aa diversity per codon')
-          #ax.set_xlabel('codon position')
-          ax.xaxis.set_major_locator(mtick.MaxNLocator(integer=True)) 
-
-          # if annotations are available, annotate the graphs
-          if annotations != None:
-            match_annotation(position_start=start, position_end=end, min_label_len= min_label_len)
-
-          # calculate next set of position ranges
-          start=end+1
-          if (end+increment) > max(matrix_input.index):
-              end = max(matrix_input.index) # last graph  may be smaller than the increment amount so scale accordingly
-          else:
-               end=end+increment
+          draw_logo_row(ax, tmp, annot_df, start, end, min_label_len)
 
     fig.tight_layout()
-    fig.savefig('{}_logoplot_of_diversity_of_amino_acids_present_per_codon_position.png'.format(sample_name), dpi=600, format = 'png')
+    fig.savefig('{}.png'.format(outfile), dpi=600, format = 'png')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Generates logo plot for predefined input matrix",
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('--input', type = str, required=True, help = "Path to input csv matrix containing data to plot")
+    parser.add_argument('--input', type = str, required=True, help = "Path to input csv matrix containing data to plot (or a .parquet table written by codon_store.py)")
     parser.add_argument('--sampleName', type = str, default = "sample_1", help = "string indicating the name to give to sample")
     parser.add_argument('--annotConfig', type = str, default = None, help = "Path to csv containing annotations.  Example file located in ref folder of github repo")
     parser.add_argument('--codonStartPos', type = int, default = None, help = "The position of which codon position you want to start at (must be present in your csv matrix provided to --input; default is to plot every position in your matrix)")
@@ -145,8 +229,11 @@ if __name__ == '__main__':
     parser.add_argument('--aaSpacing', type = int, default = 65, help = 'the number of amino acids to show per line on the logo plot')
     parser.add_argument('--minAnnotLabel', type = int, default = 7, help = 'the minimum length of consecutive amino acids under an annotation bar; anything smaller (non-inclusive) than \
                 this value will not have text written in the bar, to help prevent text from overflowing into margins')
+    parser.add_argument('--threads', type = int, default = 1, help = 'number of processes rendering rows of the logo plot in parallel; rows are stitched back together in order')
+    parser.add_argument('--pages', action = 'store_true', help = 'write each row of the logo plot as a page of a multi-page pdf instead of a single png')
     args = parser.parse_args()
 
-    formatted_input_matrix  = format_data(data_input=args.input)
+    formatted_input_matrix  = format_data(data_input=args.input, positions=(args.codonStartPos, args.codonEndPos))
     generate_logo_plot(matrix_input=formatted_input_matrix, sample_name = args.sampleName, 
-                       annotations = args.annotConfig, increment = args.aaSpacing, min_label_len = args.minAnnotLabel)
+                       annotations = args.annotConfig, increment = args.aaSpacing, min_label_len = args.minAnnotLabel,
+                       start_pos = args.codonStartPos, end_pos = args.codonEndPos, threads = args.threads, pages = args.pages)
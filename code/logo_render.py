@@ -0,0 +1,147 @@
+import pandas
+import typing
+import numpy
+
+'''
+Fast sequence logo renderer used instead of logomaker.Logo() by the logo plots.
+
+logomaker builds a TextPath for every (position, character) cell, measures it and transforms it into its own
+patch, which dominates the drawing time of long proteins.  Here the outline of every character is built once
+per font (GlyphCache), normalized to the unit square the same way logomaker stretches glyphs, and each row of a
+logo becomes a single PathCollection holding one compound path per character: the unit outline is scaled and
+translated to every cell it occupies with one vectorized numpy operation on its vertices.  Cost therefore grows
+with the number of cells and not with glyph construction.
+'''
+
+# logomaker's skylign_protein color scheme; stop codons ('.' or X) are black
+SKYLIGN_PROTEIN = {'F': '#29fc2e', 'Y': '#0a660d', 'L': '#fc9940', 'V': '#ffcc45', 'I': '#cc993d', 'H': '#660533', 'W': '#6bc96b',
+                   'A': '#fc996b', 'S': '#0a24fa', 'T': '#2bffff', 'M': '#cc99cc', 'N': '#366666', 'Q': '#6669c9', 'R': '#96050a',
+                   'K': '#663308', 'E': '#c90a38', 'G': '#f2f038', 'D': '#fc0d1c', 'P': '#1a9cfc', 'C': '#179999', '.': '#000000', 'X': '#000000'}
+
+
+class GlyphCache:
+    '''
+    input: font family and weight of the glyphs; dont_stretch_more_than, character whose width limits horizontal
+           stretching so narrow characters like I are not widened to the full cell (as in logomaker)
+
+    get(character) returns (vertices, codes) of the character outline normalized to fill the unit square
+    (centered horizontally when narrower), computed on first use and reused for every cell afterwards.
+    '''
+
+    def __init__(self, font_name: str = 'sans-serif', font_weight: str = 'bold', dont_stretch_more_than: str = 'E'):
+        from matplotlib.font_manager import FontProperties
+
+        self.font = FontProperties(family = font_name, weight = font_weight)
+        self.dont_stretch_more_than = dont_stretch_more_than
+        self.glyphs = {}
+        self.reference_width = None
+
+    def get(self, character: str) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+        if character not in self.glyphs:
+            from matplotlib.textpath import TextPath
+
+            if self.reference_width is None:
+                self.reference_width = TextPath((0, 0), self.dont_stretch_more_than, size = 1, prop = self.font).get_extents().width
+            path = TextPath((0, 0), character, size = 1, prop = self.font)
+            extents = path.get_extents()
+            vertices = numpy.array(path.vertices, dtype = numpy.float64)
+            # fraction of the cell width the glyph may occupy
+            width = min(1.0, extents.width / self.reference_width)
+            vertices[:, 0] = (vertices[:, 0] - extents.xmin) / extents.width * width + (1.0 - width) / 2.0
+            vertices[:, 1] = (vertices[:, 1] - extents.ymin) / extents.height
+            self.glyphs[character] = (vertices, numpy.array(path.codes))
+        return self.glyphs[character]
+
+
+_DEFAULT_CACHE = None
+
+
+def default_glyph_cache() -> GlyphCache:
+    ''' one cache per process, shared by every logo drawn with the default font '''
+    global _DEFAULT_CACHE
+    if _DEFAULT_CACHE is None:
+        _DEFAULT_CACHE = GlyphCache()
+    return _DEFAULT_CACHE
+
+
+def stack_cells(values: numpy.ndarray, stack_order: str = 'big_on_top') -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    '''
+    input: (positions x characters) heights; stack_order, 'big_on_top', 'small_on_top' or 'fixed' (first column
+           on top, as in logomaker)
+    output: (floor, ceiling) arrays of the same shape; positive values stack upward from 0 and negative values
+            downward, in stack order measured away from the baseline
+    '''
+    values = numpy.nan_to_num(numpy.asarray(values, dtype = numpy.float64))
+    n_pos, n_chars = values.shape
+    if stack_order == 'fixed':
+        order = numpy.tile(numpy.arange(n_chars)[::-1], (n_pos, 1))
+    elif stack_order == 'big_on_top':
+        order = numpy.argsort(numpy.abs(values), axis = 1, kind = 'stable')
+    elif stack_order == 'small_on_top':
+        order = numpy.argsort(-numpy.abs(values), axis = 1, kind = 'stable')
+    else:
+        raise ValueError('unknown stack_order {}'.format(stack_order))
+    ordered = numpy.take_along_axis(values, order, axis = 1)
+    positive = numpy.where(ordered > 0, ordered, 0.0)
+    negative = numpy.where(ordered < 0, ordered, 0.0)
+    top = numpy.cumsum(positive, axis = 1)
+    bottom = numpy.cumsum(negative, axis = 1)
+    ordered_floor = numpy.where(ordered > 0, top - positive, bottom)
+    ordered_ceiling = numpy.where(ordered > 0, top, bottom - negative)
+    floor = numpy.empty_like(values)
+    ceiling = numpy.empty_like(values)
+    numpy.put_along_axis(floor, order, ordered_floor, axis = 1)
+    numpy.put_along_axis(ceiling, order, ordered_ceiling, axis = 1)
+    return floor, ceiling
+
+
+def draw_logo(matrix: pandas.DataFrame, ax, colors: typing.Optional[dict] = None, stack_order: str = 'big_on_top', width: float = 0.95,
+              vpad: float = 0.0, flip_below: bool = True, baseline_width: float = 0.5, show_spines: bool = True,
+              cache: typing.Optional[GlyphCache] = None):
+    '''
+    input: matrix, dataframe (positions x characters) of glyph heights, index are the x positions;
+           ax, matplotlib axes to draw on; colors, character -> color (default SKYLIGN_PROTEIN, unknown characters black);
+           the remaining arguments follow logomaker.Logo
+    output: the PathCollection added to ax; x and y limits are set to the drawn stacks like logomaker does
+    '''
+    from matplotlib.collections import PathCollection
+    from matplotlib.path import Path
+
+    colors = SKYLIGN_PROTEIN if colors is None else colors
+    cache = default_glyph_cache() if cache is None else cache
+    x = matrix.index.to_numpy(dtype = numpy.float64)
+    values = matrix.to_numpy(dtype = numpy.float64)
+    floor, ceiling = stack_cells(values, stack_order)
+    heights = ceiling - floor
+
+    paths, facecolors = [], []
+    for col, character in enumerate(matrix.columns):
+        drawn = heights[:, col] > 0
+        if not drawn.any():
+            continue
+        unit_vertices, unit_codes = cache.get(str(character))
+        cell_height = heights[drawn, col] * (1.0 - vpad)
+        cell_bottom = floor[drawn, col] + heights[drawn, col] * vpad / 2.0
+        glyph_y = unit_vertices[None, :, 1]
+        if flip_below:
+            # glyphs below the baseline are drawn upside down
+            glyph_y = numpy.where((values[drawn, col] < 0)[:, None], 1.0 - glyph_y, glyph_y)
+        vertices = numpy.empty((drawn.sum(), len(unit_vertices), 2))
+        vertices[:, :, 0] = x[drawn, None] - width / 2.0 + unit_vertices[None, :, 0] * width
+        vertices[:, :, 1] = cell_bottom[:, None] + glyph_y * cell_height[:, None]
+        paths.append(Path(vertices.reshape(-1, 2), numpy.tile(unit_codes, drawn.sum())))
+        facecolors.append(colors.get(str(character), 'black'))
+
+    collection = PathCollection(paths, facecolors = facecolors, edgecolors = 'none', linewidths = 0)
+    collection.set_transform(ax.transData)
+    ax.add_collection(collection, autolim = False)
+
+    if len(x):
+        ax.set_xlim(x.min() - width / 2.0, x.max() + width / 2.0)
+        ymin, ymax = min(floor.min(), 0.0), max(ceiling.max(), 0.0)
+        ax.set_ylim(ymin, ymax if ymax > ymin else ymin + 1.0)
+    if baseline_width > 0:
+        ax.axhline(0, color = 'black', linewidth = baseline_width, zorder = -1)
+    for spine in ax.spines.values():
+        spine.set_visible(show_spines)
+    return collection
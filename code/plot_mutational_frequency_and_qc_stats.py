@@ -5,13 +5,33 @@ import numpy
 import os
 from matplotlib.ticker import ScalarFormatter
 
+from coordinates import load_annotations, annotations_in_window, domain_summary
+from codon_tables import AMINO_ACIDS, parse_codon_range, load_codon_table, nt_mutation_counts, aa_change_types, aa_frequency_matrix, per_codon_summary
+from aa_properties import AA_ORDERS, PROPERTY_CLASSES, aa_order, property_change_spectra
+from logo_render import draw_logo
+import variant_filters
+
 # since ScalarFormatterClss does not allow flexibility in formatting
 # of scales, override it by changing the class and the _set_format method
 class ScalarFormatterClass(ScalarFormatter):
    def _set_format(self):
       self.format = "%1.1f" # returns format as a value with one digit before the decimal and one significant figure
 
-def filter(df: pandas.DataFrame, minQ: float, minAlt: int, codonRange: str) -> pandas.DataFrame:
+# codon ranges of E3 and E2 used for annotation bars when no annotation csv is given
+DEFAULT_ANNOTATIONS = pandas.DataFrame({'region_name': ['E3', 'E2'], 'start': [9, 73], 'end': [72, 397], 'color': ['lightgreen', 'lightblue']})
+
+
+def annotation_table(annotations: typing.Optional[str], gene: typing.Optional[str] = None) -> pandas.DataFrame:
+    '''
+    output: annotation rows of the csv (only those of gene in whole-genome mode); without a csv DEFAULT_ANNOTATIONS,
+            or no rows for a gene since the E3/E2 bounds are codons of the single ORF
+    '''
+    if annotations is not None:
+        return load_annotations(annotations, gene)
+    return DEFAULT_ANNOTATIONS if gene is None else DEFAULT_ANNOTATIONS.iloc[:0]
+
+
+def filter(df: pandas.DataFrame, minQ: float, minAlt: int, codonRange: str, keepRef: bool = False, **thresholds) -> pandas.DataFrame:
     '''
     Potential columns to make filtering decisions
     FWD_MEAN_MIN_QUAL
@@ -27,38 +47,22 @@ def filter(df: pandas.DataFrame, minQ: float, minAlt: int, codonRange: str) -> p
     codonRange = '9-397'
     minAlt = 100
     minQ = 24.0
+    keepRef = False (set True to keep rows where REF_CODON == CODON, e.g. for rarefaction)
+    thresholds: optional strandBiasP, maxSOR, minFreq, depthWindow of variant_filters.filter_masks()
 
     '''
-    
-    df['FWD_REV_MEAN_QUAL'] = df[['FWD_MEAN_MIN_QUAL', 'REV_MEAN_MIN_QUAL']].mean(axis = 1)
-
-    # minQ filtering
-    df = df.loc[df['FWD_REV_MEAN_QUAL'] >= minQ]
-
-    # min count filtering
-    df = df.loc[df['CNT'] >= minAlt]
-    
-    # remove perfect ref to alt codons and keep mutations only
-    df = df.loc[df['REF_CODON'] != df['CODON']]
-    
-    # select range (inclusive)
-    start, end = [int(region.strip()) for region in codonRange.split('-')]
-    df = df.loc[(df['POSITION'] >= start) & (df['POSITION'] <= end)]
-    df.reset_index(inplace = True, drop=True)
-    
+    df, _ = variant_filters.apply_filters(df, minQ = minQ, minAlt = minAlt, codonRange = codonRange, keepRef = keepRef, **thresholds)
     return df
 
 
-def get_per_codon_ntNum_mutational_freq(df_hash : dict, outdir : str) -> None:
+def get_per_codon_ntNum_mutational_freq(df_hash : dict, colors : dict, outdir : str) -> dict:
     import matplotlib.pyplot as plt
 
-    
+    tables = {} # sample -> per-codon table that is plotted, returned for check_golden_outputs.py
     for key, value in df_hash.items():
         mut_freqs = dict()
         # summarize total number of nucleotide mutations per row/codon
-        value['total_nt_mutations'] = 0
-        for idx, row in value.iterrows():
-            value.loc[idx,'total_nt_mutations'] = len([nt for nt in range(len(row['REF_CODON'])) if row['REF_CODON'][nt] != row['CODON'][nt]])
+        total_nt_mutations = nt_mutation_counts(value)
         
         # iterate through each codon position to generate summary df
         for codon in set(value['POSITION']):
@@ -68,7 +72,7 @@ def get_per_codon_ntNum_mutational_freq(df_hash : dict, outdir : str) -> None:
             freq_values = {}
             freq_values['total_read_depth'] = avg_codon_depth
             for ntChanges in range(1,4):
-                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (value['total_nt_mutations'] == ntChanges)]['CNT'])
+                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (total_nt_mutations == ntChanges)]['CNT'])
                 freq_values['nt_change_{}_counts'.format(ntChanges)] = total_mutational_counts
                 freq_values['nt_change_{}_freq'.format(ntChanges)] = total_mutational_counts/avg_codon_depth
         
@@ -81,6 +85,7 @@ def get_per_codon_ntNum_mutational_freq(df_hash : dict, outdir : str) -> None:
         # sum all nucleotide mutations per codon position
         mut_freqs_df['all_nt_muts_counts']  = mut_freqs_df['nt_change_1_counts'] + mut_freqs_df['nt_change_2_counts'] + mut_freqs_df['nt_change_3_counts']
         mut_freqs_df['all_nt_muts_freq'] = mut_freqs_df['all_nt_muts_counts']/mut_freqs_df['total_read_depth']
+        tables[key] = mut_freqs_df
         
         combined_fig, axs = plt.subplots(2, 2)
         combined_fig.suptitle('Frequency of nucleotide changes per codon in {} sample'.format(key), fontweight = 'bold')
@@ -141,9 +146,10 @@ def get_per_codon_ntNum_mutational_freq(df_hash : dict, outdir : str) -> None:
 
         combined_fig.tight_layout()
         combined_fig.savefig(os.path.join(outdir, 'freq_of_nt_changes_per_codon_{}.png'.format(key)), dpi=600, format = 'png')
+    return tables
         
 
-def get_per_codon_aaTypeChange_mutational_freq(df_hash: dict, colors: dict, outdir : str) -> None:
+def get_per_codon_aaTypeChange_mutational_freq(df_hash: dict, colors: dict, outdir : str) -> dict:
     import matplotlib.pyplot as plt
     import matplotlib.ticker as mtick
     from matplotlib.lines import Line2D
@@ -153,17 +159,7 @@ def get_per_codon_aaTypeChange_mutational_freq(df_hash: dict, colors: dict, outd
     for key, value in df_hash.items():
         mut_freqs = dict()
         # summarize total number of nucleotide mutations per row/codon
-        value['aaType'] = ''
-        
-        for idx, row in value.iterrows():
-            if row['REF_AA'] == row['AA'] and (row['AA'] != '.'):
-                value.loc[idx,'aaType'] = 'synonymous'
-            elif row['REF_AA'] != row['AA'] and (row['AA'] != '.'):
-                value.loc[idx,'aaType'] = 'nonsynonymous'
-            elif row['AA'] == '.':
-                value.loc[idx,'aaType'] = 'stop'
-            else:
-                print(row)
+        aaType = aa_change_types(value)
 
         # iterate through each codon position to generate summary df
         for codon in set(value['POSITION']):
@@ -173,7 +169,7 @@ def get_per_codon_aaTypeChange_mutational_freq(df_hash: dict, colors: dict, outd
             freq_values = {}
             freq_values['total_read_depth'] = avg_codon_depth
             for aaTypes in ['synonymous', 'nonsynonymous', 'stop']:
-                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (value['aaType'] == aaTypes)]['CNT'])
+                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (aaType == aaTypes)]['CNT'])
                 freq_values['aa_type_change_{}_counts'.format(aaTypes)] = total_mutational_counts
                 freq_values['aa_type_change_{}_freq'.format(aaTypes)] = total_mutational_counts/avg_codon_depth
         
@@ -274,11 +270,10 @@ def get_per_codon_aaTypeChange_mutational_freq(df_hash: dict, colors: dict, outd
         axs[2].yaxis.set_major_formatter(yScalarFormatter)
         axs[2].tick_params(axis='y', labelsize= 9)
     # add manual legend
-    axs[2].legend([Line2D([0], [0], color=colors[legend_labels[0]], lw=4),
-                Line2D([0], [0], color=colors[legend_labels[1]], lw=4), 
-                Line2D([0], [0], color=colors[legend_labels[2]], lw=4)], legend_labels)
+    axs[2].legend([Line2D([0], [0], color=colors[label], lw=4) for label in legend_labels], legend_labels)
     combined_sample_fig.tight_layout()
     combined_sample_fig.savefig(os.path.join(outdir, 'freq_of_aa_changes_per_codon_lineplot_sample_overlay.png'), dpi=600, format = 'png')
+    return combined_samples
 
 
 def get_per_sample_aaTypeChange_mutational_freq_stackedBarPlot(df_hash: dict, outdir : str) -> None:
@@ -295,17 +290,7 @@ def get_per_sample_aaTypeChange_mutational_freq_stackedBarPlot(df_hash: dict, ou
     
         mut_freqs = dict()
         # summarize total number of nucleotide mutations per row/codon
-        value['aaType'] = ''
-        
-        for idx, row in value.iterrows():
-            if row['REF_AA'] == row['AA'] and (row['AA'] != '.'):
-                value.loc[idx,'aaType'] = 'synonymous'
-            elif row['REF_AA'] != row['AA'] and (row['AA'] != '.'):
-                value.loc[idx,'aaType'] = 'nonsynonymous'
-            elif row['AA'] == '.':
-                value.loc[idx,'aaType'] = 'stop'
-            else:
-                print(row)
+        aaType = aa_change_types(value)
 
         # iterate through each codon position to generate summary df
         for codon in set(value['POSITION']):
@@ -315,7 +300,7 @@ def get_per_sample_aaTypeChange_mutational_freq_stackedBarPlot(df_hash: dict, ou
             freq_values = {}
             freq_values['total_read_depth'] = avg_codon_depth
             for aaTypes in ['synonymous', 'nonsynonymous', 'stop']:
-                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (value['aaType'] == aaTypes)]['CNT'])
+                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (aaType == aaTypes)]['CNT'])
                 freq_values['aa_type_change_{}_counts'.format(aaTypes)] = total_mutational_counts
                 freq_values['aa_type_change_{}_freq'.format(aaTypes)] = total_mutational_counts/avg_codon_depth
         
@@ -370,9 +355,7 @@ def get_per_sample_ntNum_mutational_freq_stackedBarPlot(df_hash: dict, nonsynOnl
             value = value.loc[value['REF_AA'] != value['AA']]
         
         # summarize total number of nucleotide mutations per row/codon
-        value['total_nt_mutations'] = 0
-        for idx, row in value.iterrows():
-            value.loc[idx,'total_nt_mutations'] = len([nt for nt in range(len(row['REF_CODON'])) if row['REF_CODON'][nt] != row['CODON'][nt]])
+        total_nt_mutations = nt_mutation_counts(value)
         
         # iterate through each codon position to generate summary df
         for codon in set(value['POSITION']):
@@ -382,7 +365,7 @@ def get_per_sample_ntNum_mutational_freq_stackedBarPlot(df_hash: dict, nonsynOnl
             freq_values = {}
             freq_values['total_read_depth'] = avg_codon_depth
             for ntChanges in range(1,4):
-                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (value['total_nt_mutations'] == ntChanges)]['CNT'])
+                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (total_nt_mutations == ntChanges)]['CNT'])
                 freq_values['nt_change_{}_counts'.format(ntChanges)] = total_mutational_counts
                 freq_values['nt_change_{}_freq'.format(ntChanges)] = total_mutational_counts/avg_codon_depth
         
@@ -434,7 +417,7 @@ def get_per_sample_ntNum_mutational_freq_stackedBarPlot(df_hash: dict, nonsynOnl
     combined_fig.savefig(os.path.join(outdir, 'freq_of_nt_changes_across_codons_all_samples_stackedBarPlot.png'), dpi=600, format = 'png')
 
     
-def get_per_codon_aa_mutational_information_logoplot(df_hash: dict, nonsynOnly: bool, outdir: str) -> None:
+def get_per_codon_aa_mutational_information_logoplot(df_hash: dict, nonsynOnly: bool, outdir: str, aaSpacing: int = 41) -> dict:
     import logomaker
     import matplotlib.pyplot as plt
     import math
@@ -467,13 +450,14 @@ def get_per_codon_aa_mutational_information_logoplot(df_hash: dict, nonsynOnly:
         mut_freqs_df = pandas.DataFrame(mut_freqs).T
         #mut_freqs_df['CODON_POSITION'] = mut_freqs_df.index
         mut_freqs_df.rename(columns={'.':'X'}, inplace = True) # so elongated stop codon does not look like an I or L
+        all_aa_counts[key] = mut_freqs_df
                 
         # Counts matrix -> Information matrix
         height_per_row = 2
         width_per_col = 7
-        start=9
-        end=50
-        increment=end-start
+        start=min(mut_freqs_df.index)
+        end=start+aaSpacing
+        increment=aaSpacing
         endPos=max(mut_freqs_df.index)
         num_pos=endPos-start+1
         num_rows = math.ceil(num_pos/increment)
@@ -491,7 +475,7 @@ def get_per_codon_aa_mutational_information_logoplot(df_hash: dict, nonsynOnly:
                                       from_type='counts', 
                                       to_type='information')
             ax = plt.subplot2grid((num_rows, 1), (i, 0))
-            logomaker.Logo(info_mat, ax=ax, color_scheme="skylign_protein", show_spines=True)
+            draw_logo(info_mat, ax=ax, show_spines=True)
             #logomaker.Logo(info_mat, ax=ax, color_scheme="charge", show_spines=True)
             #logomaker.Logo(info_mat, ax=ax, color_scheme="dmslogo_funcgroup", show_spines=True)
 
@@ -504,6 +488,7 @@ def get_per_codon_aa_mutational_information_logoplot(df_hash: dict, nonsynOnly:
 
         fig.tight_layout()
         fig.savefig(os.path.join(outdir, 'logoplot_of_mutations_information_{}.png'.format(key)), dpi=600, format = 'png')
+    return all_aa_counts
 
 
 def get_coverage_per_codon(df_hash : dict, outdir : str) -> None:
@@ -552,9 +537,7 @@ def get_combined_mutational_frequencies_stacked_barplot(df_hash: dict, nonsynOnl
             value = value.loc[value['AA'] != '.']
 
         # summarize total number of nucleotide mutations per row/codon
-        value['total_nt_mutations'] = 0
-        for idx, row in value.iterrows():
-            value.loc[idx,'total_nt_mutations'] = len([nt for nt in range(len(row['REF_CODON'])) if row['REF_CODON'][nt] != row['CODON'][nt]])
+        total_nt_mutations = nt_mutation_counts(value)
         
         # iterate through each codon position to generate summary df
         for codon in set(value['POSITION']):
@@ -564,7 +547,7 @@ def get_combined_mutational_frequencies_stacked_barplot(df_hash: dict, nonsynOnl
             freq_values = {}
             freq_values['total_read_depth'] = avg_codon_depth
             for ntChanges in range(1,4):
-                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (value['total_nt_mutations'] == ntChanges)]['CNT'])
+                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (total_nt_mutations == ntChanges)]['CNT'])
                 freq_values['nt_change_{}_counts'.format(ntChanges)] = total_mutational_counts
                 freq_values['nt_change_{}_freq'.format(ntChanges)] = total_mutational_counts/avg_codon_depth
         
@@ -604,17 +587,7 @@ def get_combined_mutational_frequencies_stacked_barplot(df_hash: dict, nonsynOnl
     
         mut_freqs = dict()
         # summarize total number of nucleotide mutations per row/codon
-        value['aaType'] = ''
-        
-        for idx, row in value.iterrows():
-            if row['REF_AA'] == row['AA'] and (row['AA'] != '.'):
-                value.loc[idx,'aaType'] = 'synonymous'
-            elif row['REF_AA'] != row['AA'] and (row['AA'] != '.'):
-                value.loc[idx,'aaType'] = 'nonsynonymous'
-            elif row['AA'] == '.':
-                value.loc[idx,'aaType'] = 'stop'
-            else:
-                print(row)
+        aaType = aa_change_types(value)
 
         # iterate through each codon position to generate summary df
         for codon in set(value['POSITION']):
@@ -624,7 +597,7 @@ def get_combined_mutational_frequencies_stacked_barplot(df_hash: dict, nonsynOnl
             freq_values = {}
             freq_values['total_read_depth'] = avg_codon_depth
             for aaTypes in ['synonymous', 'nonsynonymous', 'stop']:
-                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (value['aaType'] == aaTypes)]['CNT'])
+                total_mutational_counts = sum(value.loc[(value['POSITION'] == codon) & (aaType == aaTypes)]['CNT'])
                 freq_values['aa_type_change_{}_counts'.format(aaTypes)] = total_mutational_counts
                 freq_values['aa_type_change_{}_freq'.format(aaTypes)] = total_mutational_counts/avg_codon_depth
         
@@ -691,13 +664,14 @@ def get_combined_mutational_frequencies_stacked_barplot(df_hash: dict, nonsynOnl
     '''    
 
 
-def get_aa_diversity(df_hash : dict, outdir : str, colors : dict) -> None:
+def get_aa_diversity(df_hash : dict, outdir : str, colors : dict) -> dict:
     import matplotlib.pyplot as plt
     
     
     combined_fig, axs = plt.subplots(1, 1,figsize=(20,7))
     combined_fig.suptitle('Amino acid diversity per codon position', fontweight = 'bold', fontsize=30)
     legend_order = []  
+    tables = {}
     for key, value in df_hash.items():
         mut_freqs = dict()
         legend_order.append(key)
@@ -709,6 +683,7 @@ def get_aa_diversity(df_hash : dict, outdir : str, colors : dict) -> None:
         mut_freqs_df = pandas.DataFrame.from_dict(mut_freqs, orient = 'index')
         mut_freqs_df['CODON_POSITION'] = mut_freqs_df.index
         mut_freqs_df.rename({0:'total amino acids'}, axis = 1, inplace=True)
+        tables[key] = mut_freqs_df
 
     
         print('{}: max diversity is {}, mean diversity is {}'.format(key, max(mut_freqs.values()), float(sum(mut_freqs.values()))/float(len(mut_freqs.values()))))
@@ -726,16 +701,19 @@ def get_aa_diversity(df_hash : dict, outdir : str, colors : dict) -> None:
         
     axs.legend(legend_order)
     combined_fig.savefig(os.path.join(outdir, 'amino_acid_diversity_at_each_codon_across_samples.png'), dpi=600, format = 'png')
+    return tables
    
 
-def get_per_codon_aa_mutational_freq_logoplot(df_hash: dict, nonsynOnly: bool, includeStop: bool, annot: bool, outdir: str) -> None:
-    import logomaker
+def get_per_codon_aa_mutational_freq_logoplot(df_hash: dict, nonsynOnly: bool, includeStop: bool, annot: bool, outdir: str,
+                                              annotations: typing.Optional[str] = None, aaSpacing: int = 41, gene: typing.Optional[str] = None) -> dict:
     import matplotlib.pyplot as plt
     import math
     import matplotlib.ticker as mtick
 
 
     all_aa_counts = {}
+    if annot:
+        annot_df = annotation_table(annotations, gene)
     
     for key, value in df_hash.items():
         print(key)
@@ -765,15 +743,16 @@ def get_per_codon_aa_mutational_freq_logoplot(df_hash: dict, nonsynOnly: bool, i
         # formatting logoplot iteration
         height_per_row = 2
         width_per_col = 7
-        start=9
-        end=50
-        increment=end-start
+        start=min(mut_freqs_df.index)
+        end=start+aaSpacing
+        increment=aaSpacing
         endPos=max(mut_freqs_df.index)
         num_pos=endPos-start+1
         num_rows = math.ceil(num_pos/increment)
         fig = plt.figure(figsize=[width_per_col * 1, height_per_row * num_rows])
         if includeStop == False:
             mut_freqs_df.drop(axis = 1, labels = 'X', inplace=True)
+        all_aa_counts[key] = mut_freqs_df
         if nonsynOnly:
             fig.suptitle('Nonsynonymous mutations for {} library'.format(key), fontsize=15)
         else:
@@ -785,53 +764,18 @@ def get_per_codon_aa_mutational_freq_logoplot(df_hash: dict, nonsynOnly: bool, i
             tmp=mut_freqs_df.loc[start:end]
             #info_mat = logomaker.Logo(tmp)
             ax = plt.subplot2grid((num_rows, 1), (i, 0))
-            logomaker.Logo(tmp, ax=ax, color_scheme="skylign_protein", show_spines=True)
+            draw_logo(tmp, ax=ax, show_spines=True)
 
             #logomaker.Logo(info_mat, ax=ax, color_scheme="charge", show_spines=True)
             #logomaker.Logo(info_mat, ax=ax, color_scheme="dmslogo_funcgroup", show_spines=True)
 
-            ## TESTING ONLY -- NOT AUTOMATED ##
+            # annotation bars under each row; E3/E2 unless an annotation csv is provided
             if annot:
-                E3_start = 9
-                E3_end = 72
-                E2_start = 73
-                E2_end = 397 
                 y = -0.005
-                plot_coords = range(start, end+1)
-                try:
-                    e2_coords = range(E2_start, E2_end+1)
-                    e2_plot_range_start = min(set(e2_coords).intersection(set(plot_coords)))
-                    e2_plot_range_end = max(set(e2_coords).intersection(set(plot_coords)))
-                except ValueError:
-                    print("There is no E2!")
-                    e2_plot_range_start = None
-                try:
-                    e3_coords = range(E3_start, E3_end+1)
-                    e3_plot_range_start = min(set(e3_coords).intersection(set(plot_coords)))
-                    e3_plot_range_end = max(set(e3_coords).intersection(set(plot_coords)))
-                except ValueError:
-                    print("There is no E3!")
-                    e3_plot_range_start = None
-
-                if e2_plot_range_start != None:
-                    ax.plot([e2_plot_range_start, e2_plot_range_end+1], [y, y], color = "lightblue", linewidth = 10, solid_capstyle="butt")
-                    ax.text(((e2_plot_range_start + e2_plot_range_end)/2), y*1.4,'E2',fontsize=12)
-                    #if len(set([E2_start]).intersection(set(plot_coords))) == 1:
-                    #    ax.plot(E2_start, y*2, '^k', markersize=10)
-                    #    ax.text(E2_start, y*3.5, start, fontsize=10)
-                    #if len(set([E2_end]).intersection(set(plot_coords))) == 1:
-                    #    ax.plot(E2_end, y*2, '^k', markersize=10)
-                    #    ax.text(E2_end, y*3.5, start, fontsize=10)
-                if e3_plot_range_start != None:
-                    ax.plot([e3_plot_range_start, e3_plot_range_end+1], [y, y], color = "lightgreen", linewidth = 10, solid_capstyle="butt")
-                    ax.text(((e3_plot_range_start + e3_plot_range_end)/2), y*1.4,'E3',fontsize=12)
-                    #if len(set([E3_start]).intersection(set(plot_coords))) == 1:
-                    #    ax.plot(E3_start, y*2, '^k', markersize=10)
-                    #    ax.text(E3_start, y*3.5, start, fontsize=10)
-                    #if len(set([E3_end]).intersection(set(plot_coords))) == 1:
-                    #    ax.plot(E3_end, y*2, '^k', markersize=10)
-                    #    ax.text(E3_end, y*3.5, start, fontsize=10)
-            ## END OF ANNOTATION TESTING ##        
+                for _, region in annotations_in_window(start, end, annot_df).iterrows():
+                    ax.plot([region['start'], region['end']+1], [y, y], color = region['color'], linewidth = 10, solid_capstyle="butt")
+                    ax.text(((region['start'] + region['end'])/2), y*1.4, region['region_name'], fontsize=12)
+        
                     
             ax.set_ylim([-0.01,0.04]) # make sure all axises are the same; be careful to not truncate to early though; 4 bits can represent 16 values
             ax.set_yticks([0, 0.04])
@@ -846,15 +790,200 @@ def get_per_codon_aa_mutational_freq_logoplot(df_hash: dict, nonsynOnly: bool, i
             fig.savefig(os.path.join(outdir, 'logoplot_of_mutations_freq_{}_including_stop_codons.png'.format(key)), dpi=600, format = 'png')
         else:
             fig.savefig(os.path.join(outdir, 'logoplot_of_mutations_freq_{}_excluding_stop_codons.png'.format(key)), dpi=600, format = 'png')
+    return all_aa_counts
             
 
+def get_per_codon_aa_heatmap(df_hash: dict, nonsynOnly: bool, includeStop: bool, annot: bool, outdir: str,
+                             annotations: typing.Optional[str] = None, aaOrder: str = 'property', positionsPerRow: int = 400,
+                             gene: typing.Optional[str] = None) -> None:
+    '''
+    input: df_hash of sample -> filtered codon table; aaOrder, amino acid row order (see aa_properties.AA_ORDERS);
+           positionsPerRow, number of codons drawn per block of the figure; annotations and gene, the annotation bars
+           drawn when annot is set (see annotation_table)
+    output: None; writes heatmap_of_aa_freq_<sample>.png, codon position x amino acid frequency (log10 scale)
+            with the reference amino acid of every codon marked, drawn as one image per block of positions
+    '''
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as mcolors
+    import math
+
+    if annot:
+        annot_df = annotation_table(annotations, gene)
+
+    for key, value in df_hash.items():
+        print(key)
+        if nonsynOnly:
+            print('Removing synonymous amino acid changes')
+            value = value.loc[value['REF_AA'] != value['AA']]
+
+        positions = numpy.arange(value['POSITION'].min(), value['POSITION'].max() + 1)
+        freqs = aa_frequency_matrix(value, positions = positions)
+        ref_aa = value.drop_duplicates('POSITION').set_index('POSITION')['REF_AA'].astype(str).reindex(positions)
+
+        order = aa_order(aaOrder, freqs.to_numpy())
+        if not includeStop:
+            order = [idx for idx in order if AMINO_ACIDS[idx] != '.']
+        aa_labels = ['X' if AMINO_ACIDS[idx] == '.' else AMINO_ACIDS[idx] for idx in order]
+        matrix = freqs.to_numpy().T[order]  # amino acids x positions
+        row_of_aa = {AMINO_ACIDS[idx]: row for row, idx in enumerate(order)}
+
+        observed = matrix[matrix > 0]
+        vmin = observed.min() if len(observed) else 1e-5
+        vmax = observed.max() if len(observed) else 1.0
+        norm = mcolors.LogNorm(vmin = vmin, vmax = max(vmax, vmin * 10))
+        cmap = plt.get_cmap('viridis').copy()
+        cmap.set_bad('white') # frequency 0 (not observed or filtered)
+        masked = numpy.ma.masked_less_equal(matrix, 0)
+
+        num_rows = math.ceil(len(positions) / positionsPerRow)
+        fig, axs = plt.subplots(num_rows, 1, figsize = (14, 0.11 * len(order) * num_rows + 1.5), squeeze = False)
+        fig.suptitle('{} mutations for {} library'.format('Nonsynonymous' if nonsynOnly else 'All', key), fontsize = 15)
+        for row in range(num_rows):
+            ax = axs[row, 0]
+            block = slice(row * positionsPerRow, min((row + 1) * positionsPerRow, len(positions)))
+            start, end = positions[block][0], positions[block][-1]
+            image = ax.imshow(masked[:, block], aspect = 'auto', interpolation = 'nearest', cmap = cmap, norm = norm,
+                              extent = (start - 0.5, end + 0.5, len(order) - 0.5, -0.5))
+            # reference amino acid of every codon
+            ref_rows = ref_aa.iloc[block].map(row_of_aa)
+            known = ref_rows.notna().to_numpy()
+            ax.scatter(positions[block][known], ref_rows[known].to_numpy(), s = 2, color = 'red', marker = 'o', linewidths = 0)
+            ax.set_xlim(start - 0.5, start - 0.5 + positionsPerRow)
+            ax.set_yticks(range(len(order)))
+            ax.set_yticklabels(aa_labels, fontsize = 6)
+            ax.tick_params(axis = 'x', labelsize = 8)
+
+            if annot:
+                for _, region in annotations_in_window(start, end, annot_df).iterrows():
+                    ax.plot([region['start'] - 0.5, region['end'] + 0.5], [-1.2, -1.2], color = region['color'], linewidth = 6,
+                            solid_capstyle = 'butt', clip_on = False)
+                    ax.text((region['start'] + region['end']) / 2, -1.8, region['region_name'], fontsize = 8, ha = 'center', clip_on = False)
+        axs[-1, 0].set_xlabel('codon position')
+        fig.colorbar(image, ax = axs[:, 0].tolist(), label = 'frequency', fraction = 0.02, pad = 0.01)
+        fig.savefig(os.path.join(outdir, 'heatmap_of_aa_freq_{}.png'.format(key)), dpi = 600, format = 'png')
+        plt.close(fig)
+
+
+def top_changes(spectrum: pandas.DataFrame, prop: str, keep: int = 12) -> pandas.DataFrame:
+    '''
+    input: dataframe whose columns are '<property>:<transition>' labels (per codon or per sample); property; number to keep
+    output: the class changes of prop (without 'unchanged') as columns named by transition, the keep largest by total
+            and the remainder summed into 'other', so legends stay readable for properties with many classes
+    '''
+    columns = [column for column in spectrum.columns if column.startswith(prop + ':') and not column.endswith(':unchanged')]
+    changes = spectrum[columns].rename(columns = lambda column: column.split(':', 1)[1])
+    changes = changes.loc[:, changes.sum(axis = 0) > 0]
+    ranked = changes.sum(axis = 0).sort_values(ascending = False).index
+    if len(ranked) > keep:
+        changes = changes[ranked[:keep]].assign(other = changes[ranked[keep:]].sum(axis = 1))
+    return changes
+
+
+def get_physicochemical_change_spectrum(df_hash: dict, outdir: str) -> None:
+    '''
+    input: df_hash of sample -> filtered codon table; outdir
+    output: physicochemical_changes_per_codon_<sample>.tsv/.png, frequency of every property class transition and
+            named change (charge reversal, hydrophobic to hydrophilic, ...) at each codon;
+            physicochemical_change_spectrum_all_samples.tsv, the per-sample spectra (mean frequency per codon and
+            share of mutant counts); physicochemical_change_spectrum_stackedBarPlot.png, the share of mutant counts
+            in every transition per property and sample
+    '''
+    import matplotlib.pyplot as plt
+
+    properties = list(PROPERTY_CLASSES)
+    spectra = []
+    for key, value in df_hash.items():
+        per_codon, per_sample = property_change_spectra(value)
+        per_codon.to_csv(os.path.join(outdir, 'physicochemical_changes_per_codon_{}.tsv'.format(key)), sep = '\t')
+        spectra.append(per_sample.rename_axis('change').reset_index().assign(sample = key))
+
+        # one row of stacked bars per property; only class changes are stacked
+        fig, axes = plt.subplots(len(properties), 1, figsize = (15, 2.2 * len(properties)), sharex = True, squeeze = False)
+        for ax, prop in zip(axes[:, 0], properties):
+            changes = top_changes(per_codon, prop)
+            bottom = numpy.zeros(len(per_codon))
+            palette = plt.get_cmap('tab20')
+            for index, change in enumerate(changes.columns):
+                # one step polygon per change instead of one rectangle per codon keeps long proteins fast to draw
+                top = bottom + changes[change].to_numpy()
+                ax.fill_between(per_codon.index, bottom, top, step = 'mid', color = palette(index % 20), label = change, linewidth = 0)
+                bottom = top
+            ax.set_ylabel('{}\nfrequency'.format(prop), fontweight = 'bold', color = 'darkblue', fontsize = 9)
+            ax.legend(loc = 'upper left', bbox_to_anchor = (1.005, 1.0), fontsize = 6, ncol = 2, frameon = False)
+        axes[-1, 0].set_xlabel('Codon position', fontweight = 'bold', color = 'darkblue', fontsize = 10)
+        axes[0, 0].set_title('Physicochemical changes per codon in {} sample'.format(key), fontweight = 'bold')
+        fig.savefig(os.path.join(outdir, 'physicochemical_changes_per_codon_{}.png'.format(key)), dpi=600, format = 'png', bbox_inches = 'tight')
+        plt.close(fig)
+
+    spectra = pandas.concat(spectra, ignore_index = True)[['sample', 'change', 'mean_freq_per_codon', 'count_fraction']]
+    spectra.to_csv(os.path.join(outdir, 'physicochemical_change_spectrum_all_samples.tsv'), sep = '\t', index = False)
+
+    fractions = spectra.pivot(index = 'sample', columns = 'change', values = 'count_fraction').loc[list(df_hash)]
+    fig, axes = plt.subplots(1, len(properties), figsize = (3.2 * len(properties), 5), squeeze = False)
+    for ax, prop in zip(axes[0], properties):
+        changes = top_changes(fractions, prop)
+        bottom = numpy.zeros(len(fractions))
+        palette = plt.get_cmap('tab20')
+        for index, change in enumerate(changes.columns):
+            ax.bar(fractions.index, changes[change], bottom = bottom, color = palette(index % 20), label = change)
+            bottom += changes[change].to_numpy()
+        ax.set_title(prop, fontweight = 'bold')
+        ax.tick_params(axis = 'x', labelrotation = 90, labelsize = 8)
+        ax.legend(loc = 'upper center', bbox_to_anchor = (0.5, -0.25), fontsize = 6, frameon = False)
+    axes[0, 0].set_ylabel('fraction of mutant counts')
+    fig.suptitle('Physicochemical class changes across samples', fontweight = 'bold')
+    # the legends hang below the axes, so the saved area is fitted to them instead of tight_layout
+    fig.savefig(os.path.join(outdir, 'physicochemical_change_spectrum_stackedBarPlot.png'), dpi=600, format = 'png', bbox_inches = 'tight')
+    plt.close(fig)
+
+
+# domain_summary columns drawn as heatmap panels, with their titles
+DOMAIN_HEATMAP_METRICS = [('mutation_freq', 'mean mutation frequency'), ('nonsyn_syn_ratio', 'nonsynonymous / synonymous counts'),
+                          ('mean_aa_diversity', 'mean amino acid diversity'), ('mean_depth', 'mean depth')]
+
+
+def get_domain_summary(df_hash: dict, outdir: str, annotations: typing.Optional[str] = None, gene: typing.Optional[str] = None) -> None:
+    '''
+    input: df_hash of sample -> filtered codon table; annotations, csv of region_name,start,end,color (default E3/E2);
+           gene, the gene of a whole-genome run whose rows of annotations are used (see annotation_table)
+    output: None; writes domain_summary_all_samples.tsv, the per-region statistics of coordinates.domain_summary for
+            every sample, and domain_summary_heatmap.png, region x sample heatmaps of mutation frequency,
+            nonsynonymous/synonymous ratio, amino acid diversity and depth
+    '''
+    import matplotlib.pyplot as plt
+
+    annot_df = annotation_table(annotations, gene)
+    rolled = pandas.concat([domain_summary(per_codon_summary(value), annot_df).assign(sample = key) for key, value in df_hash.items()], ignore_index = True)
+    rolled = rolled[['sample'] + [column for column in rolled.columns if column != 'sample']]
+    rolled.to_csv(os.path.join(outdir, 'domain_summary_all_samples.tsv'), sep = '\t', index = False)
+
+    regions = list(dict.fromkeys(rolled['region_name']))
+    samples = list(df_hash)
+    fig, axes = plt.subplots(1, len(DOMAIN_HEATMAP_METRICS), figsize = (max(3.5, 0.6 * len(samples) + 2) * len(DOMAIN_HEATMAP_METRICS), 0.45 * len(regions) + 2.5), squeeze = False)
+    for ax, (metric, title) in zip(axes[0], DOMAIN_HEATMAP_METRICS):
+        values = rolled.pivot(index = 'region_name', columns = 'sample', values = metric).loc[regions, samples]
+        image = ax.imshow(values.to_numpy(dtype = float), aspect = 'auto', cmap = 'viridis')
+        for (row, column), value in numpy.ndenumerate(values.to_numpy(dtype = float)):
+            if not numpy.isnan(value):
+                ax.text(column, row, '{:.3g}'.format(value), ha = 'center', va = 'center', fontsize = 6, color = 'white' if value < numpy.nanmean(values.to_numpy(dtype = float)) else 'black')
+        ax.set_xticks(range(len(samples)))
+        ax.set_xticklabels(samples, rotation = 90, fontsize = 8)
+        ax.set_yticks(range(len(regions)))
+        ax.set_yticklabels(regions if ax is axes[0, 0] else [], fontsize = 8)
+        ax.set_title(title, fontweight = 'bold', fontsize = 9)
+        fig.colorbar(image, ax = ax, fraction = 0.05, pad = 0.02)
+    fig.suptitle('Per-domain summaries across samples', fontweight = 'bold')
+    fig.savefig(os.path.join(outdir, 'domain_summary_heatmap.png'), dpi=600, format = 'png', bbox_inches = 'tight')
+    plt.close(fig)
+
+
 if __name__ == '__main__':
     
     #TO DO
     
     parser = argparse.ArgumentParser(description = 'Generates plots of mutational frequencies from deep mutational scanning experiments.')
     
-    parser.add_argument('--data', required = True, action = 'extend', nargs = '+', type = str, help = 'list of all codon tables per sample as generated by virVar')
+    parser.add_argument('--data', required = True, action = 'extend', nargs = '+', type = str, help = 'list of all codon tables per sample as generated by virVar (or .parquet tables from codon_store.py)')
     parser.add_argument('--qual', default = 24.0, type = float, help = 'A float specifying the minimum average quality of reads to keep for filtering of results')
     parser.add_argument('--counts', default = 100, type = int, help = 'minimum average number of counts for a codon variant to keep post filtering')
     parser.add_argument('--pos', default = "0-0", type = str, help= 'integer range of codon positions to use in analysis. Default is to use all availble. Ex: 7-100, would include codon 7 through codon 100, inclusive on both ends based upon your input fasta file. WARNING: makes assumption that codon 1 is the first 3 bp of your input fasta reference file')
@@ -862,31 +991,19 @@ if __name__ == '__main__':
     parser.add_argument('--nonSynOnly', action = 'store_true', help='If setting this flag, only nonsynonymous mutations will be considered')
     parser.add_argument('--includeStop', action = 'store_true', help='If setting this flag, include STOP codons')
     parser.add_argument('--annotate', action = 'store_true', help='DO NOT SET THIS -- experimental and needs testing')
+    parser.add_argument('--annotConfig', default = None, type = str, help = 'csv of region_name,start,end,color codon annotations, used for the logo and heatmap annotation bars of --annotate and the per-domain summaries (default: E3/E2 bounds)')
     parser.add_argument('--outdir', default = os.getcwd(), help = "Path to output directory to write plots")
     parser.add_argument('--colors', type = str, help = 'comma-separated list of hex values in the same order as --samplename')
+    parser.add_argument('--strandBiasP', default = None, type = float, help = 'reject variants whose forward/reverse read split differs from the coverage with binomial p below this')
+    parser.add_argument('--maxSOR', default = None, type = float, help = 'reject variants with a strand odds ratio above this (GATK uses 3)')
+    parser.add_argument('--minFreq', default = 0.0, type = float, help = 'reject variants with fewer counts than this fraction of the local depth (rolling median over --depthWindow codons)')
+    parser.add_argument('--depthWindow', default = 25, type = int, help = 'number of codons over which the local depth for --minFreq is taken')
+    parser.add_argument('--aaOrder', default = 'property', choices = AA_ORDERS, help = 'order of the amino acid rows of the heatmap; cluster groups amino acids with similar profiles (requires scipy)')
     args = parser.parse_args()
     
     df_hash = {} # dict to store each samples data as a panda df
     colors = {} # dict to store each sample's colors
     
-    # Below commment block should be replaced with for loop at bottom
-    # TO DO: TESTING REQUIRED!!
-    '''
-    # TO DO: read in csv lists to automate and productionize
-    
-    all_results = pandas.read_csv('/home/tonya/Downloads/mutDNA_S15_cleaned.codon', sep = '\t')
-    all_results = pandas.read_csv('/home/tonya/Downloads/wtDNA_S16_cleaned.codon', sep = '\t')
-    df = all_results
-    
-    # TO DO: for each df of all reasults filter first and then add to dict
-    
-    
-    df_hash = {}
-    df_hash['mutant'] = df
-    df_hash['wildtype'] = df
-    '''
-    
-    
     # The colorblind friendly palette with grey:
     #cbPalette <- c("#999999", "#E69F00", "#56B4E9", "#009E73", "#F0E442", "#0072B2", "#D55E00", "#CC79A7")
 
@@ -906,12 +1023,13 @@ if __name__ == '__main__':
     
     
     for index,samples in enumerate(args.data):
-        sample_df = pandas.read_csv(samples, sep = '\t')
-        sample_df = filter(df = sample_df, minQ = args.qual, minAlt = args.counts, codonRange = args.pos)
+        sample_df = load_codon_table(samples, positions = parse_codon_range(args.pos))
+        sample_df = filter(df = sample_df, minQ = args.qual, minAlt = args.counts, codonRange = args.pos,
+                           strandBiasP = args.strandBiasP, maxSOR = args.maxSOR, minFreq = args.minFreq, depthWindow = args.depthWindow)
         df_hash[args.samplename.split(',')[index].strip()] = sample_df
         print(df_hash)
         
-    get_per_codon_ntNum_mutational_freq(df_hash = df_hash, outdir = args.outdir)
+    get_per_codon_ntNum_mutational_freq(df_hash = df_hash, colors = colors, outdir = args.outdir)
     get_per_codon_aaTypeChange_mutational_freq(df_hash = df_hash, colors = colors, outdir = args.outdir)
     get_per_sample_aaTypeChange_mutational_freq_stackedBarPlot(df_hash = df_hash, outdir = args.outdir)
     get_per_sample_ntNum_mutational_freq_stackedBarPlot(df_hash = df_hash, nonsynOnly = args.nonSynOnly, outdir = args.outdir)
@@ -919,4 +1037,9 @@ if __name__ == '__main__':
     get_coverage_per_codon(df_hash = df_hash, outdir = args.outdir)
     get_combined_mutational_frequencies_stacked_barplot(df_hash = df_hash, nonsynOnly = args.nonSynOnly, includeStop = args.includeStop, outdir = args.outdir)
     get_aa_diversity(df_hash = df_hash, colors = colors, outdir = args.outdir)
-    get_per_codon_aa_mutational_freq_logoplot(df_hash = df_hash, nonsynOnly = args.nonSynOnly, includeStop = args.includeStop, annot = args.annotate, outdir = args.outdir)
\ No newline at end of file
+    get_per_codon_aa_mutational_freq_logoplot(df_hash = df_hash, nonsynOnly = args.nonSynOnly, includeStop = args.includeStop, annot = args.annotate, outdir = args.outdir,
+                                              annotations = args.annotConfig)
+    get_per_codon_aa_heatmap(df_hash = df_hash, nonsynOnly = args.nonSynOnly, includeStop = args.includeStop, annot = args.annotate, outdir = args.outdir,
+                             annotations = args.annotConfig, aaOrder = args.aaOrder)
+    get_physicochemical_change_spectrum(df_hash = df_hash, outdir = args.outdir)
+    get_domain_summary(df_hash = df_hash, outdir = args.outdir, annotations = args.annotConfig)
@@ -0,0 +1,290 @@
+import pandas
+import argparse
+import typing
+import datetime
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import time
+
+'''
+Content-addressed store of run outputs with a SQLite index of runs and their artifacts.
+
+A run is identified by the sha256 of its configuration: the content hash of every input codon table, the
+manifest columns (sample, color, role, replicate group), all run parameters (files given as parameters, e.g.
+--reference or --annotConfig, are replaced by their content hash), the selected analyses and the source of
+the scripts in this directory.  Its outputs live in <store>/objects/<hash[:2]>/<hash>/ together with a
+provenance.json describing the configuration, so runs with different --qual/--counts never overwrite each
+other, and a repeated request for an identical configuration is served from the store instead of recomputed.
+
+<store>/index.sqlite holds
+    runs       - one row per run: hash, status, creation and last use time, total size, configuration
+    artifacts  - every file of a run with its size and sha256
+    file_hashes - cache of input file hashes keyed by path, size and mtime so large tables are hashed once
+
+python3 provenance.py --store STORE list|show|compare|gc lists runs, shows one run, compares two runs
+(configuration and artifact differences) or garbage-collects runs by age (--maxAgeDays) or total size
+(--maxSizeMB, least recently used runs are removed first).
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (run_hash TEXT PRIMARY KEY, status TEXT, created REAL, last_used REAL,
+                                 size_bytes INTEGER, config TEXT);
+CREATE TABLE IF NOT EXISTS artifacts (run_hash TEXT, path TEXT, size_bytes INTEGER, sha256 TEXT,
+                                      PRIMARY KEY (run_hash, path));
+CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, size_bytes INTEGER, mtime_ns INTEGER, sha256 TEXT);
+'''
+
+# files of a run directory that are bookkeeping and not artifacts
+EXCLUDED_DIRS = ['.stages']
+
+
+def open_store(store: str) -> sqlite3.Connection:
+    ''' output: connection to <store>/index.sqlite, created with the schema above if needed '''
+    os.makedirs(os.path.join(store, 'objects'), exist_ok = True)
+    conn = sqlite3.connect(os.path.join(store, 'index.sqlite'))
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def sha256_file(path: str, block_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cached_file_hash(conn: sqlite3.Connection, path: str) -> str:
+    '''
+    output: sha256 of the file content; reused from file_hashes while the size and mtime of the path are unchanged
+    '''
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    row = conn.execute('SELECT size_bytes, mtime_ns, sha256 FROM file_hashes WHERE path = ?', (path,)).fetchone()
+    if row is not None and row['size_bytes'] == stat.st_size and row['mtime_ns'] == stat.st_mtime_ns:
+        return row['sha256']
+    digest = sha256_file(path)
+    conn.execute('INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns, digest))
+    conn.commit()
+    return digest
+
+
+def code_version() -> str:
+    ''' sha256 over the python sources next to this module, so changed analysis code gives a new run '''
+    digest = hashlib.sha256()
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(code_dir)):
+        if name.endswith('.py'):
+            digest.update(name.encode())
+            digest.update(open(os.path.join(code_dir, name), 'rb').read())
+    return digest.hexdigest()
+
+
+def run_config(conn: sqlite3.Connection, samples: pandas.DataFrame, params: dict, analyses: list) -> typing.Tuple[str, dict]:
+    '''
+    input: manifest samples (as from run_manifest.read_manifest), run parameters, analyses
+    output: (run hash, configuration dict it was computed from)
+    '''
+    sample_config = []
+    for _, row in samples.iterrows():
+        sample_config.append({'sample': row['sample'], 'path': row['path'], 'sha256': cached_file_hash(conn, row['path']),
+                              'color': row['color'], 'role': row['role'], 'replicate_group': row['replicate_group'],
+                              'passage': row.get('passage')})
+    param_config = {}
+    for key, value in sorted(params.items()):
+        if isinstance(value, str) and os.path.isfile(value):
+            param_config[key] = {'path': value, 'sha256': cached_file_hash(conn, value)}
+        else:
+            param_config[key] = value
+    config = {'samples': sample_config, 'params': param_config, 'analyses': sorted(analyses), 'code': code_version()}
+    # paths are recorded for reference but do not identify a run; moved or copied inputs hash the same
+    hashed = json.loads(json.dumps(config, default = str))
+    for sample in hashed['samples']:
+        del sample['path']
+    for value in hashed['params'].values():
+        if isinstance(value, dict):
+            del value['path']
+    run_hash = hashlib.sha256(json.dumps(hashed, sort_keys = True).encode()).hexdigest()
+    return run_hash, config
+
+
+def run_directory(store: str, run_hash: str) -> str:
+    return os.path.join(store, 'objects', run_hash[:2], run_hash)
+
+
+def lookup_run(conn: sqlite3.Connection, run_hash: str) -> typing.Optional[sqlite3.Row]:
+    return conn.execute('SELECT * FROM runs WHERE run_hash = ?', (run_hash,)).fetchone()
+
+
+def resolve_run(conn: sqlite3.Connection, prefix: str) -> str:
+    ''' output: the full hash of the single run starting with prefix '''
+    matches = [row['run_hash'] for row in conn.execute('SELECT run_hash FROM runs WHERE run_hash LIKE ?', (prefix + '%',))]
+    if len(matches) != 1:
+        raise KeyError('{} runs match {}'.format(len(matches), prefix))
+    return matches[0]
+
+
+def list_artifacts(run_dir: str) -> typing.List[str]:
+    ''' output: paths relative to run_dir of every artifact file '''
+    artifacts = []
+    for root, dirs, files in os.walk(run_dir):
+        dirs[:] = sorted(directory for directory in dirs if directory not in EXCLUDED_DIRS)
+        for name in sorted(files):
+            artifacts.append(os.path.relpath(os.path.join(root, name), run_dir))
+    return artifacts
+
+
+def register_run(conn: sqlite3.Connection, store: str, run_hash: str, config: dict, status: str) -> None:
+    '''
+    writes provenance.json into the run directory and records the run and its artifacts in the index
+    '''
+    run_dir = run_directory(store, run_hash)
+    now = time.time()
+    provenance = {'run_hash': run_hash, 'status': status, 'created': datetime.datetime.fromtimestamp(now).isoformat(),
+                  'python': platform.python_version(), 'pandas': pandas.__version__, 'config': config}
+    with open(os.path.join(run_dir, 'provenance.json'), 'w') as handle:
+        json.dump(provenance, handle, indent = 1, default = str)
+
+    artifacts = [(run_hash, path, os.path.getsize(os.path.join(run_dir, path)), sha256_file(os.path.join(run_dir, path)))
+                 for path in list_artifacts(run_dir)]
+    conn.execute('DELETE FROM artifacts WHERE run_hash = ?', (run_hash,))
+    conn.executemany('INSERT INTO artifacts VALUES (?, ?, ?, ?)', artifacts)
+    conn.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                 (run_hash, status, now, now, sum(artifact[2] for artifact in artifacts), json.dumps(config, default = str)))
+    conn.commit()
+
+
+def verify_run(conn: sqlite3.Connection, store: str, run_hash: str) -> typing.List[str]:
+    '''
+    output: paths of the artifacts of a run that are missing from the store or whose sha256 no longer matches the index
+    '''
+    run_dir = run_directory(store, run_hash)
+    damaged = []
+    for row in conn.execute('SELECT path, sha256 FROM artifacts WHERE run_hash = ?', (run_hash,)).fetchall():
+        source = os.path.join(run_dir, row['path'])
+        if not os.path.isfile(source) or sha256_file(source) != row['sha256']:
+            damaged.append(row['path'])
+    return damaged
+
+
+def materialize(conn: sqlite3.Connection, store: str, run_hash: str, outdir: str) -> int:
+    '''
+    copies every artifact of a run into outdir and marks the run used; copies rather than hard links, since the
+    analyses rewrite their outputs in place and a later run into outdir would otherwise change the stored artifacts
+    output: number of files placed
+    '''
+    run_dir = run_directory(store, run_hash)
+    placed = 0
+    for row in conn.execute('SELECT path FROM artifacts WHERE run_hash = ?', (run_hash,)).fetchall():
+        source = os.path.join(run_dir, row['path'])
+        target = os.path.join(outdir, row['path'])
+        if os.path.abspath(source) == os.path.abspath(target):
+            continue
+        os.makedirs(os.path.dirname(target) or '.', exist_ok = True)
+        if os.path.lexists(target):
+            os.remove(target) # may still be a hard link into the store from an earlier version
+        shutil.copy2(source, target)
+        placed += 1
+    conn.execute('UPDATE runs SET last_used = ? WHERE run_hash = ?', (time.time(), run_hash))
+    conn.commit()
+    return placed
+
+
+def list_runs(conn: sqlite3.Connection) -> pandas.DataFrame:
+    rows = conn.execute('SELECT run_hash, status, created, last_used, size_bytes, config FROM runs ORDER BY created').fetchall()
+    runs = pandas.DataFrame([dict(row) for row in rows], columns = ['run_hash', 'status', 'created', 'last_used', 'size_bytes', 'config'])
+    configs = [json.loads(config) for config in runs['config']]
+    runs['samples'] = [','.join(sample['sample'] for sample in config['samples']) for config in configs]
+    runs['analyses'] = [','.join(config['analyses']) for config in configs]
+    for column in ['created', 'last_used']:
+        runs[column] = pandas.to_datetime(runs[column], unit = 's').dt.strftime('%Y-%m-%d %H:%M:%S')
+    return runs.drop(columns = 'config')
+
+
+def flatten_config(config: dict) -> dict:
+    ''' output: configuration as flat name -> value pairs for comparison '''
+    flat = {'analyses': ','.join(config['analyses']), 'code': config['code']}
+    for key, value in config['params'].items():
+        flat['param:{}'.format(key)] = value['sha256'] if isinstance(value, dict) else value
+    for sample in config['samples']:
+        for key in ['sha256', 'color', 'role', 'replicate_group']:
+            flat['sample:{}:{}'.format(sample['sample'], key)] = sample[key]
+    return flat
+
+
+def compare_runs(conn: sqlite3.Connection, run_a: str, run_b: str) -> pandas.DataFrame:
+    '''
+    output: dataframe (kind, name, run_a, run_b) of every configuration value and artifact that differs
+            between the two runs; artifacts are compared by content hash
+    '''
+    configs = [flatten_config(json.loads(lookup_run(conn, run)['config'])) for run in (run_a, run_b)]
+    differences = [('config', name, configs[0].get(name), configs[1].get(name)) for name in sorted(set(configs[0]) | set(configs[1]))
+                   if configs[0].get(name) != configs[1].get(name)]
+    artifacts = [dict(conn.execute('SELECT path, sha256 FROM artifacts WHERE run_hash = ?', (run,)).fetchall()) for run in (run_a, run_b)]
+    differences += [('artifact', path, artifacts[0].get(path), artifacts[1].get(path)) for path in sorted(set(artifacts[0]) | set(artifacts[1]))
+                    if artifacts[0].get(path) != artifacts[1].get(path) and path != 'provenance.json']
+    return pandas.DataFrame(differences, columns = ['kind', 'name', run_a[:12], run_b[:12]])
+
+
+def remove_run(conn: sqlite3.Connection, store: str, run_hash: str) -> None:
+    shutil.rmtree(run_directory(store, run_hash), ignore_errors = True)
+    conn.execute('DELETE FROM artifacts WHERE run_hash = ?', (run_hash,))
+    conn.execute('DELETE FROM runs WHERE run_hash = ?', (run_hash,))
+    conn.commit()
+
+
+def garbage_collect(conn: sqlite3.Connection, store: str, max_age_days: typing.Optional[float] = None, max_size_mb: typing.Optional[float] = None) -> typing.List[str]:
+    '''
+    removes runs not used for more than max_age_days and failed runs, then the least recently used runs until
+    the store holds at most max_size_mb
+    output: hashes of the removed runs
+    '''
+    removed = []
+    runs = conn.execute('SELECT run_hash, status, last_used, size_bytes FROM runs ORDER BY last_used').fetchall()
+    kept = []
+    for run in runs:
+        if run['status'] != 'complete' or (max_age_days is not None and run['last_used'] < time.time() - max_age_days * 86400):
+            removed.append(run['run_hash'])
+        else:
+            kept.append(run)
+    if max_size_mb is not None:
+        total = sum(run['size_bytes'] for run in kept)
+        while kept and total > max_size_mb * 1024 * 1024:
+            run = kept.pop(0)
+            total -= run['size_bytes']
+            removed.append(run['run_hash'])
+    for run_hash in removed:
+        remove_run(conn, store, run_hash)
+    return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Inspects, compares and garbage-collects the content-addressed run store of run_manifest.py --store',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('action', choices = ['list', 'show', 'compare', 'gc'], help = 'list runs, show one run, compare two runs or garbage-collect')
+    parser.add_argument('runs', nargs = '*', help = 'run hashes (or unique prefixes) for show and compare')
+    parser.add_argument('--store', required = True, type = str, help = 'store directory given to run_manifest.py --store')
+    parser.add_argument('--maxAgeDays', default = None, type = float, help = 'gc: remove runs not used for this many days')
+    parser.add_argument('--maxSizeMB', default = None, type = float, help = 'gc: remove least recently used runs until the store is at most this size')
+    args = parser.parse_args()
+
+    conn = open_store(args.store)
+    if args.action == 'list':
+        print(list_runs(conn).to_string(index = False))
+    elif args.action == 'show':
+        run_hash = resolve_run(conn, args.runs[0])
+        run = lookup_run(conn, run_hash)
+        print(json.dumps({'run_hash': run_hash, 'status': run['status'], 'directory': run_directory(args.store, run_hash),
+                          'config': json.loads(run['config'])}, indent = 1))
+        for row in conn.execute('SELECT path, size_bytes, sha256 FROM artifacts WHERE run_hash = ? ORDER BY path', (run_hash,)):
+            print('{}\t{}\t{}'.format(row['path'], row['size_bytes'], row['sha256'][:12]))
+    elif args.action == 'compare':
+        print(compare_runs(conn, resolve_run(conn, args.runs[0]), resolve_run(conn, args.runs[1])).to_string(index = False))
+    else:
+        removed = garbage_collect(conn, args.store, max_age_days = args.maxAgeDays, max_size_mb = args.maxSizeMB)
+        print('removed {} runs{}'.format(len(removed), ': ' + ', '.join(run[:12] for run in removed) if removed else ''))
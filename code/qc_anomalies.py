@@ -0,0 +1,182 @@
+import pandas
+import argparse
+import typing
+import os
+import warnings
+import numpy
+
+from codon_tables import per_codon_summary
+
+'''
+Cross-sample detection of per-codon depth and mutation frequency outliers (amplicon dropouts, primer-site
+artifacts, index hopping).
+
+The per-codon aggregates of every sample (codon_tables.per_codon_summary) are stacked into one (samples x
+positions) array per metric on the union of positions, on a log10 scale (depth + 1, mutation frequency + 1e-4)
+since both vary multiplicatively.  Each sample is first centered on its own median, so libraries sequenced deeper
+or selected harder are not outliers as a whole.  Then at every position the samples are compared by a robust z-score
+(deviation from the median of the samples over 1.4826 x their median absolute deviation).  The MAD of a position
+is floored at the median MAD of all positions, and at least at MIN_MAD.  Where most samples agree exactly (MAD 0,
+e.g. duplicate libraries) a position has no spread to compare against and is not scored.  A within-sample robust
+z-score along the positions of each library is reported next to it.  Every median and MAD is one numpy.nanmedian along the sample
+or the position axis of the stacked array.
+
+A sample/position/metric is flagged when its across-sample |z| reaches --anomalyZ, and as missing when the sample
+has no rows at a position that at least half of the samples cover.
+'''
+
+# metric -> (per_codon_summary column, pseudocount added before log10)
+QC_METRICS = {'depth': ('total_read_depth', 1.0), 'mutation_freq': ('all_nt_muts_freq', 1e-4)}
+MAD_SCALE = 1.4826 # MAD of a normal distribution is 0.6745 standard deviations
+MIN_MAD = 0.01 # log10 units (about 2%); floor of the MAD when most positions have none
+
+
+def stack_metrics(df_hash: dict) -> typing.Tuple[list, numpy.ndarray, dict]:
+    '''
+    output: (samples, union of positions, dict of metric -> (samples x positions) array of the raw metric, nan
+            where a sample has no rows at a position)
+    '''
+    summaries = {key: per_codon_summary(value) for key, value in df_hash.items()}
+    positions = numpy.unique(numpy.concatenate([summary.index.to_numpy() for summary in summaries.values()]))
+    stacked = {}
+    for metric, (column, _) in QC_METRICS.items():
+        values = numpy.full((len(summaries), len(positions)), numpy.nan)
+        for row, summary in enumerate(summaries.values()):
+            values[row, numpy.searchsorted(positions, summary.index.to_numpy())] = summary[column].to_numpy(dtype = numpy.float64)
+        stacked[metric] = values
+    return list(summaries), positions, stacked
+
+
+def robust_z(values: numpy.ndarray) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    '''
+    input: (samples x positions) array on the scale to compare (nan where missing)
+    output: (across-sample z of every sample at each position after centering every sample on its median,
+             within-sample z of every position against the other positions of the sample; nan where the MAD is 0)
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category = RuntimeWarning) # all-nan rows or columns stay nan
+        sample_median = numpy.nanmedian(values, axis = 1, keepdims = True)
+        sample_mad = MAD_SCALE * numpy.nanmedian(numpy.abs(values - sample_median), axis = 1, keepdims = True)
+        centered = values - sample_median
+        position_median = numpy.nanmedian(centered, axis = 0, keepdims = True)
+        position_mad = MAD_SCALE * numpy.nanmedian(numpy.abs(centered - position_median), axis = 0, keepdims = True)
+        floor = numpy.fmax(numpy.nanmedian(position_mad), MIN_MAD)
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            # a MAD of 0 leaves no spread to compare against, so those positions (or samples) get no z-score
+            across = numpy.where(position_mad > 0, (centered - position_median) / numpy.fmax(position_mad, floor), numpy.nan)
+            within = numpy.where(sample_mad > 0, (values - sample_median) / sample_mad, numpy.nan)
+    return across, within
+
+
+def find_anomalies(samples: list, positions: numpy.ndarray, stacked: dict, threshold: float) -> typing.Tuple[pandas.DataFrame, dict]:
+    '''
+    output: (table of flagged sample/position/metric with value, cohort median, both z-scores and direction
+             high, low or missing; dict of metric -> across-sample z array for plotting)
+    '''
+    flagged, scores = [], {}
+    for metric, (_, pseudocount) in QC_METRICS.items():
+        raw = stacked[metric]
+        across, within = robust_z(numpy.log10(raw + pseudocount))
+        scores[metric] = across
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category = RuntimeWarning)
+            cohort_median = numpy.nanmedian(raw, axis = 0)
+        # a codon without rows lacks every metric, so it is reported once, under depth
+        missing = numpy.isnan(raw) & ((~numpy.isnan(raw)).sum(axis = 0) >= len(samples) / 2.0) & (metric == 'depth')
+        outlier = numpy.abs(numpy.nan_to_num(across)) >= threshold
+        rows, columns = numpy.nonzero(outlier | missing)
+        flagged.append(pandas.DataFrame({'sample': numpy.array(samples, dtype = object)[rows], 'POSITION': positions[columns], 'metric': metric,
+                                         'value': raw[rows, columns], 'cohort_median': cohort_median[columns],
+                                         'z_across_samples': across[rows, columns], 'z_within_sample': within[rows, columns],
+                                         'direction': numpy.where(missing[rows, columns], 'missing', numpy.where(across[rows, columns] > 0, 'high', 'low'))}))
+    anomalies = pandas.concat(flagged, ignore_index = True)
+    anomalies['sample'] = pandas.Categorical(anomalies['sample'], categories = samples)
+    anomalies = anomalies.sort_values(['sample', 'POSITION'], kind = 'stable').reset_index(drop = True)
+    return anomalies, scores
+
+
+def anomaly_summary(samples: list, stacked: dict, anomalies: pandas.DataFrame) -> pandas.DataFrame:
+    '''
+    output: per-sample counts of covered positions and of flagged positions per metric and direction
+    '''
+    summary = pandas.DataFrame({'sample': samples, 'n_positions': (~numpy.isnan(stacked['depth'])).sum(axis = 1),
+                                'median_depth': numpy.nanmedian(stacked['depth'], axis = 1)})
+    for metric in QC_METRICS:
+        for direction in ['missing', 'low', 'high']:
+            if metric != 'depth' and direction == 'missing':
+                continue # missing codons are reported once, under depth
+            mask = (anomalies['metric'] == metric) & (anomalies['direction'] == direction)
+            summary['{}_{}'.format(metric, direction)] = anomalies.loc[mask].groupby('sample', observed = False).size().reindex(samples, fill_value = 0).to_numpy()
+    return summary
+
+
+def plot_anomaly_overview(samples: list, positions: numpy.ndarray, scores: dict, summary: pandas.DataFrame, threshold: float, outdir: str) -> None:
+    '''
+    output: qc_anomaly_overview.png, sample x position heatmaps of the across-sample z-scores of every metric (missing
+            positions in grey) next to the number of flagged positions per sample
+    '''
+    import matplotlib.pyplot as plt
+
+    height = min(max(2.5, 0.12 * len(samples) + 1.5), 30)
+    fig, axes = plt.subplots(len(scores), 2, figsize = (16, height * len(scores)), squeeze = False, gridspec_kw = {'width_ratios': [6, 1]})
+    cmap = plt.get_cmap('RdBu_r').copy()
+    cmap.set_bad('lightgrey')
+    # without any codon left after filtering the heatmaps are a single grey column
+    first = positions.min() if len(positions) else 0
+    n_columns = int(positions.max() - first + 1) if len(positions) else 1
+    extent = [first - 0.5, first + n_columns - 0.5, len(samples) - 0.5, -0.5]
+    for (ax, bar_ax), (metric, z) in zip(axes, scores.items()):
+        # positions are dense codon numbers, so each column of the image is one codon
+        full = numpy.full((len(samples), n_columns), numpy.nan)
+        full[:, positions - first] = z
+        image = ax.imshow(full, aspect = 'auto', interpolation = 'nearest', cmap = cmap, vmin = -2 * threshold, vmax = 2 * threshold, extent = extent)
+        ax.set_yticks(range(len(samples)))
+        ax.set_yticklabels(samples, fontsize = max(3, min(8, 400 / max(len(samples), 1))))
+        ax.set_title('{}: robust z across samples'.format(metric), fontweight = 'bold', fontsize = 10)
+        fig.colorbar(image, ax = ax, fraction = 0.02, pad = 0.01)
+
+        left = numpy.zeros(len(samples))
+        for column, label, color in [('depth_missing', 'missing', '#999999'), ('{}_low'.format(metric), 'low', '#0072B2'), ('{}_high'.format(metric), 'high', '#D55E00')]:
+            values = summary[column].to_numpy()
+            bar_ax.barh(range(len(samples)), values, left = left, color = color, label = label)
+            left += values
+        bar_ax.set_ylim(len(samples) - 0.5, -0.5)
+        bar_ax.set_yticks([])
+        bar_ax.set_xlabel('flagged codons', fontsize = 8)
+        bar_ax.legend(fontsize = 6, frameon = False, loc = 'lower right')
+    axes[-1, 0].set_xlabel('Codon Position', fontweight = 'bold', color = 'darkblue', fontsize = 10)
+    fig.tight_layout()
+    fig.savefig(os.path.join(outdir, 'qc_anomaly_overview.png'), dpi = 600, format = 'png')
+    plt.close(fig)
+
+
+def get_qc_anomalies(df_hash: dict, params: dict, outdir: str) -> None:
+    '''
+    input: df_hash of sample -> filtered codon table; params with anomalyZ, the |z| at which codons are flagged
+    output: None; writes qc_anomalies.tsv (flagged sample/position/metric), qc_anomaly_summary.tsv (counts per
+            sample) and qc_anomaly_overview.png
+    '''
+    if len(df_hash) < 3:
+        raise ValueError('cross-sample anomaly detection needs at least 3 samples, got {}'.format(len(df_hash)))
+    samples, positions, stacked = stack_metrics(df_hash)
+    anomalies, scores = find_anomalies(samples, positions, stacked, params['anomalyZ'])
+    summary = anomaly_summary(samples, stacked, anomalies)
+    anomalies.to_csv(os.path.join(outdir, 'qc_anomalies.tsv'), sep = '\t', index = False)
+    summary.to_csv(os.path.join(outdir, 'qc_anomaly_summary.tsv'), sep = '\t', index = False)
+    plot_anomaly_overview(samples, positions, scores, summary, params['anomalyZ'], outdir)
+    print('{} anomalies flagged in {} samples over {} codons'.format(len(anomalies), len(samples), len(positions)))
+
+
+if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('Agg')
+    from variant_filters import add_sample_arguments, load_filtered_samples
+
+    parser = argparse.ArgumentParser(description = 'Flags codons whose depth or mutation frequency in one library deviates from the other libraries',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    add_sample_arguments(parser, colors = False)
+    parser.add_argument('--anomalyZ', default = 4.0, type = float, help = 'robust z-score (median/MAD across samples) from which a codon of a sample is flagged')
+    args = parser.parse_args()
+
+    df_hash, _, _ = load_filtered_samples(args)
+    get_qc_anomalies(df_hash, {'anomalyZ': args.anomalyZ}, args.outdir)
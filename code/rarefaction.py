@@ -0,0 +1,206 @@
+import pandas
+import typing
+import numpy
+import os
+
+from codon_tables import AMINO_ACIDS, CODON_AA_INDEX, encode_codons, load_codon_table
+
+'''
+Rarefaction of codon tables to a common read depth.
+
+Libraries sequenced to different depths pass different numbers of variants through the --counts
+filter, which inflates amino acid diversity and mutational frequency of deep libraries.  Here each
+position is reduced to counts per mutant amino acid (the 21 symbols in AMINO_ACIDS) plus one remainder
+category holding every other read (reference codon and reads not in the table, i.e. DENOM - sum(CNT)).
+Subsampling without replacement to a common depth is a multivariate hypergeometric draw over those
+categories, done as a sequence of conditional hypergeometric draws vectorized over
+(iterations x positions); reads are never materialized.  Monte-Carlo iterations run in batches and
+the --counts threshold is applied after subsampling, so the tables must only be quality filtered.
+'''
+
+N_CATEGORIES = len(AMINO_ACIDS) + 1 # mutant amino acids + remainder
+
+
+def aa_category_counts(df: pandas.DataFrame) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    '''
+    input: codon table of one sample (reference codon rows may be present, they count as remainder)
+    output: tuple of (sorted int array of positions, int array positions x N_CATEGORIES of read counts)
+    '''
+    positions, pos_idx = numpy.unique(df['POSITION'].to_numpy(dtype = numpy.int64), return_inverse = True)
+    codon_idx = encode_codons(df['CODON'])
+    mutant = (codon_idx >= 0) & (df['CODON'].to_numpy() != df['REF_CODON'].to_numpy())
+    aa_idx = CODON_AA_INDEX[codon_idx[mutant]]
+
+    counts = numpy.zeros((len(positions), N_CATEGORIES), dtype = numpy.int64)
+    counts[:, :-1] = numpy.bincount(pos_idx[mutant] * len(AMINO_ACIDS) + aa_idx, weights = df['CNT'].to_numpy(dtype = numpy.float64)[mutant],
+                                    minlength = len(positions) * len(AMINO_ACIDS)).reshape(len(positions), len(AMINO_ACIDS)).round().astype(numpy.int64)
+    rows = numpy.bincount(pos_idx, minlength = len(positions))
+    depth = numpy.round(numpy.bincount(pos_idx, weights = df['DENOM'].to_numpy(dtype = numpy.float64), minlength = len(positions)) / rows).astype(numpy.int64)
+    counts[:, -1] = numpy.clip(depth - counts[:, :-1].sum(axis = 1), 0, None)
+    return positions, counts
+
+
+def subsample(counts: numpy.ndarray, target: numpy.ndarray, iterations: int, rng: numpy.random.Generator, method: str = 'hypergeometric') -> numpy.ndarray:
+    '''
+    input: counts, int array (positions x categories); target, int array (positions,) of reads to draw,
+           must not exceed the row totals; number of iterations to draw at once; numpy random generator;
+           method 'hypergeometric' (without replacement) or 'multinomial' (with replacement)
+    output: int array (iterations x positions x categories) of subsampled counts
+    '''
+    n_pos, n_cat = counts.shape
+    shape = (iterations, n_pos)
+    remaining_pop = numpy.broadcast_to(counts.sum(axis = 1), shape).astype(numpy.int64)
+    remaining_draw = numpy.broadcast_to(target, shape).astype(numpy.int64).copy()
+    drawn = numpy.zeros((iterations, n_pos, n_cat), dtype = numpy.int64)
+
+    for category in range(n_cat - 1):
+        good = numpy.broadcast_to(counts[:, category], shape)
+        if method == 'hypergeometric':
+            draw = rng.hypergeometric(good, remaining_pop - good, remaining_draw)
+        elif method == 'multinomial':
+            with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+                p = numpy.where(remaining_pop > 0, good / remaining_pop, 0.0)
+            draw = rng.binomial(remaining_draw, numpy.clip(p, 0.0, 1.0))
+        else:
+            raise ValueError('unknown subsampling method "{}", use hypergeometric or multinomial'.format(method))
+        drawn[:, :, category] = draw
+        remaining_pop = remaining_pop - good
+        remaining_draw = remaining_draw - draw
+    drawn[:, :, -1] = remaining_draw # whatever is left comes from the last category
+
+    return drawn
+
+
+def rarefy(counts: numpy.ndarray, target: numpy.ndarray, min_count: int, iterations: int, batch_size: int, seed: int, method: str = 'hypergeometric') -> dict:
+    '''
+    Monte-Carlo rarefaction of one sample to per-position target depths.
+
+    input: counts (positions x N_CATEGORIES), target depth per position, minimum subsampled count for a
+           mutant amino acid to be called present, total iterations, iterations per batch, random seed
+    output: dict of (iterations x positions) float arrays 'diversity' (number of mutant amino acids
+            present) and 'mut_freq' (summed frequency of present mutant amino acids); nan where a
+            position is shallower than its target
+    '''
+    depth = counts.sum(axis = 1)
+    valid = (depth >= target) & (target > 0)
+    diversity = numpy.full((iterations, len(depth)), numpy.nan)
+    mut_freq = numpy.full((iterations, len(depth)), numpy.nan)
+    if not valid.any():
+        return {'diversity': diversity, 'mut_freq': mut_freq}
+
+    # one independent stream per batch so results only depend on seed and batch size
+    streams = numpy.random.SeedSequence(seed).spawn(int(numpy.ceil(iterations / batch_size)))
+    for batch, stream in enumerate(streams):
+        first = batch * batch_size
+        size = min(batch_size, iterations - first)
+        drawn = subsample(counts[valid], target[valid], size, numpy.random.default_rng(stream), method = method)
+        present = drawn[:, :, :-1] >= max(min_count, 1)
+        diversity[first:first + size, valid] = present.sum(axis = 2)
+        mut_freq[first:first + size, valid] = (drawn[:, :, :-1] * present).sum(axis = 2) / target[valid]
+
+    return {'diversity': diversity, 'mut_freq': mut_freq}
+
+
+def summarize_iterations(values: numpy.ndarray, alpha: float = 0.05) -> typing.Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    '''
+    output: mean, lower and upper (1 - alpha) Monte-Carlo quantile band along the iteration axis
+    '''
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category = RuntimeWarning) # all-nan columns stay nan
+        return (numpy.nanmean(values, axis = 0), numpy.nanquantile(values, alpha / 2, axis = 0),
+                numpy.nanquantile(values, 1 - alpha / 2, axis = 0))
+
+
+def get_rarefied_aa_diversity(sample_paths: dict, params: dict, colors: dict, outdir: str) -> None:
+    '''
+    input: sample_paths of sample -> raw codon table; params with qual, pos and counts (applied after
+           subsampling) and optionally rarefyDepth (common depth for every position; default is the
+           minimum depth across samples at each position), rarefyIterations, rarefyBatch, seed,
+           rarefyMethod and rarefyCurvePoints
+    output: None; writes per-codon rarefied diversity/frequency tables per sample, diversity
+            rarefaction curves with confidence bands (table and plot) and a per-codon diversity plot
+    '''
+    import matplotlib.pyplot as plt
+    import plot_mutational_frequency_and_qc_stats as dms_plots
+
+    iterations = int(params.get('rarefyIterations', 100))
+    batch_size = int(params.get('rarefyBatch', 50))
+    seed = int(params.get('seed', 0))
+    method = params.get('rarefyMethod', 'hypergeometric')
+    curve_points = int(params.get('rarefyCurvePoints', 10))
+    min_count = int(params['counts'])
+
+    per_sample = {}
+    for sample, path in sample_paths.items():
+        # quality and range filtering only; the count threshold is applied to the subsampled counts
+        df = dms_plots.filter(df = load_codon_table(path), minQ = params['qual'], minAlt = 0, codonRange = params['pos'], keepRef = True)
+        per_sample[sample] = aa_category_counts(df)
+
+    positions = numpy.unique(numpy.concatenate([pos for pos, _ in per_sample.values()]))
+    aligned = {}
+    for sample, (pos, counts) in per_sample.items():
+        full = numpy.zeros((len(positions), N_CATEGORIES), dtype = numpy.int64)
+        full[numpy.searchsorted(positions, pos)] = counts
+        aligned[sample] = full
+    depths = numpy.stack([counts.sum(axis = 1) for counts in aligned.values()])
+
+    if params.get('rarefyDepth'):
+        target = numpy.full(len(positions), int(params['rarefyDepth']), dtype = numpy.int64)
+    else:
+        target = depths.min(axis = 0)
+
+    # rarefaction curves: the same depths for every sample, up to the shallowest sample's median depth
+    max_depth = int(numpy.median(depths.min(axis = 0)[depths.min(axis = 0) > 0])) if (depths.min(axis = 0) > 0).any() else 0
+    curve_depths = numpy.unique(numpy.linspace(max(max_depth // curve_points, 1), max_depth, curve_points).astype(numpy.int64)) if max_depth > 0 else numpy.array([], dtype = numpy.int64)
+
+    curve_rows = []
+    position_fig, position_ax = plt.subplots(1, 1, figsize = (20, 7))
+    curve_fig, curve_ax = plt.subplots(1, 1, figsize = (7, 5))
+    for sample, counts in aligned.items():
+        result = rarefy(counts, target, min_count, iterations, batch_size, seed, method = method)
+        div_mean, div_lo, div_hi = summarize_iterations(result['diversity'])
+        freq_mean, freq_lo, freq_hi = summarize_iterations(result['mut_freq'])
+        pandas.DataFrame({'POSITION': positions, 'depth': counts.sum(axis = 1), 'target_depth': target,
+                          'diversity_mean': div_mean, 'diversity_lo': div_lo, 'diversity_hi': div_hi,
+                          'mut_freq_mean': freq_mean, 'mut_freq_lo': freq_lo, 'mut_freq_hi': freq_hi}).to_csv(
+            os.path.join(outdir, 'rarefied_aa_diversity_per_codon_{}.tsv'.format(sample)), sep = '\t', index = False)
+
+        color = colors.get(sample, 'black')
+        position_ax.plot(positions, div_mean, color = color, linewidth = 1, label = sample)
+        position_ax.fill_between(positions, div_lo, div_hi, color = color, alpha = 0.2, linewidth = 0)
+
+        # mean diversity across positions for each iteration, at every curve depth
+        curve_mean, curve_lo, curve_hi = [], [], []
+        for depth in curve_depths:
+            at_depth = rarefy(counts, numpy.full(len(positions), depth, dtype = numpy.int64), min_count, iterations, batch_size, seed, method = method)
+            covered = numpy.isfinite(at_depth['diversity'][0])
+            if covered.any():
+                mean, lo, hi = [value[0] for value in summarize_iterations(at_depth['diversity'][:, covered].mean(axis = 1)[:, None])]
+            else:
+                mean, lo, hi = numpy.nan, numpy.nan, numpy.nan
+            curve_mean.append(mean)
+            curve_lo.append(lo)
+            curve_hi.append(hi)
+            curve_rows.append({'sample': sample, 'depth': depth, 'positions_covered': int(covered.sum()),
+                               'mean_diversity': mean, 'diversity_lo': lo, 'diversity_hi': hi})
+        curve_ax.plot(curve_depths, curve_mean, color = color, linewidth = 1, marker = 'o', markersize = 3, label = sample)
+        curve_ax.fill_between(curve_depths, curve_lo, curve_hi, color = color, alpha = 0.2, linewidth = 0)
+
+    pandas.DataFrame(curve_rows).to_csv(os.path.join(outdir, 'rarefaction_curves_aa_diversity.tsv'), sep = '\t', index = False)
+
+    position_fig.suptitle('Rarefied amino acid diversity per codon position ({} iterations, 95% band)'.format(iterations), fontweight = 'bold', fontsize = 20)
+    position_ax.set_ylim([0, 22])
+    position_ax.set_ylabel('total number of different \n amino acids represented', fontsize = 15)
+    position_ax.set_xlabel('codon position', fontsize = 15)
+    position_ax.legend()
+    position_fig.savefig(os.path.join(outdir, 'rarefied_amino_acid_diversity_at_each_codon_across_samples.png'), dpi = 600, format = 'png')
+    plt.close(position_fig)
+
+    curve_ax.set_title('Rarefaction curves of amino acid diversity', fontweight = 'bold')
+    curve_ax.set_xlabel('subsampled reads per codon')
+    curve_ax.set_ylabel('mean amino acids per codon')
+    curve_ax.legend()
+    curve_fig.tight_layout()
+    curve_fig.savefig(os.path.join(outdir, 'rarefaction_curves_aa_diversity.png'), dpi = 600, format = 'png')
+    plt.close(curve_fig)
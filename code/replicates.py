@@ -0,0 +1,159 @@
+import pandas
+import numpy
+import os
+
+from codon_tables import CODONS, CODON_AA, stack_codon_counts, codon_frequencies
+
+'''
+Replicate-aware statistics for filtered codon tables.
+
+All samples are stacked once into a (samples x positions x 64 codons) frequency array with
+codon_tables.stack_codon_counts(); every statistic below is a reduction over the sample axis of the
+slice belonging to a replicate group, so the cost does not depend on how many replicates a group has
+beyond the size of that array.
+'''
+
+
+def replicate_statistics(freqs: numpy.ndarray, depth: numpy.ndarray) -> dict:
+    '''
+    input: freqs, float array (replicates x positions x 64) of codon variant frequencies for one group;
+           depth, float array (replicates x positions) of mean read depth
+    output: dict of
+            variant_mean, variant_sd - (positions x 64) mean and sample standard deviation across replicates
+            n_observed               - (positions x 64) number of replicates in which the variant was seen
+            mut_freq                 - (replicates x positions) summed variant frequency per position
+            mut_freq_mean, mut_freq_sd, mean_depth - (positions,)
+            position_r               - (positions,) mean pairwise Pearson correlation between replicates of
+                                       the 64 variant frequencies at each position
+            correlation              - (replicates x replicates) Pearson correlation over all variants
+                                       observed in at least one replicate
+    '''
+    n_reps = freqs.shape[0]
+    ddof = 1 if n_reps > 1 else 0
+    stats = {}
+    stats['variant_mean'] = freqs.mean(axis = 0)
+    stats['variant_sd'] = freqs.std(axis = 0, ddof = ddof) if n_reps > 1 else numpy.full(freqs.shape[1:], numpy.nan)
+    stats['n_observed'] = (freqs > 0).sum(axis = 0)
+
+    mut_freq = freqs.sum(axis = 2)
+    stats['mut_freq'] = mut_freq
+    stats['mut_freq_mean'] = mut_freq.mean(axis = 0)
+    stats['mut_freq_sd'] = mut_freq.std(axis = 0, ddof = ddof) if n_reps > 1 else numpy.full(mut_freq.shape[1], numpy.nan)
+    observed_depth = numpy.isfinite(depth)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        stats['mean_depth'] = numpy.where(observed_depth, depth, 0.0).sum(axis = 0) / observed_depth.sum(axis = 0)
+
+    # per-position correlation of every replicate pair at once: (reps x reps x positions)
+    centered = freqs - freqs.mean(axis = 2, keepdims = True)
+    cross = numpy.einsum('apc,bpc->abp', centered, centered)
+    norms = numpy.sqrt(numpy.einsum('apc,apc->ap', centered, centered))
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        pair_r = cross / (norms[:, None, :] * norms[None, :, :])
+    upper_a, upper_b = numpy.triu_indices(n_reps, k = 1)
+    pairs = pair_r[upper_a, upper_b, :]
+    finite = numpy.isfinite(pairs)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        # positions with no variance in any pair (e.g. unobserved) stay nan
+        stats['position_r'] = numpy.where(finite, pairs, 0.0).sum(axis = 0) / finite.sum(axis = 0)
+
+    flat = freqs.reshape(n_reps, -1)
+    flat = flat[:, (flat > 0).any(axis = 0)]
+    if n_reps > 1 and flat.shape[1] > 1:
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            stats['correlation'] = numpy.corrcoef(flat)
+    else:
+        stats['correlation'] = numpy.ones((n_reps, n_reps))
+
+    return stats
+
+
+def plot_replicate_concordance(freqs: numpy.ndarray, replicates: list, group: str, color: str, outfile: str) -> None:
+    '''
+    pairwise log-log scatter plots of codon variant frequencies between all replicates of a group
+    '''
+    import matplotlib.pyplot as plt
+
+    n_reps = len(replicates)
+    fig, axs = plt.subplots(n_reps - 1, n_reps - 1, figsize = (3 * (n_reps - 1), 3 * (n_reps - 1)), squeeze = False)
+    fig.suptitle('Replicate concordance of codon variant frequencies in {}'.format(group), fontweight = 'bold')
+    flat = freqs.reshape(n_reps, -1)
+    observed = flat > 0
+    for row in range(1, n_reps):
+        for col in range(0, n_reps - 1):
+            ax = axs[row - 1, col]
+            if col >= row:
+                ax.axis('off')
+                continue
+            both = observed[row] & observed[col]
+            ax.scatter(flat[col, both], flat[row, both], s = 2, alpha = 0.3, color = color, rasterized = True)
+            ax.set_xscale('log')
+            ax.set_yscale('log')
+            if both.sum() > 1:
+                r = numpy.corrcoef(numpy.log10(flat[col, both]), numpy.log10(flat[row, both]))[0, 1]
+                ax.set_title('log10 r = {:.3f} (n = {})'.format(r, both.sum()), fontsize = 8)
+            if row == n_reps - 1:
+                ax.set_xlabel(replicates[col], fontsize = 9)
+            if col == 0:
+                ax.set_ylabel(replicates[row], fontsize = 9)
+            ax.tick_params(labelsize = 7)
+    fig.tight_layout()
+    fig.savefig(outfile, dpi = 600, format = 'png')
+    plt.close(fig)
+
+
+def get_replicate_statistics(df_hash: dict, replicate_groups: dict, colors: dict, outdir: str) -> None:
+    '''
+    input: df_hash of sample -> filtered codon table; replicate_groups of group name -> list of samples
+    output: None; writes per-variant, per-position and correlation tables for every replicate group,
+            a concordance scatter plot for groups with 2+ replicates and an overlay of mean per-codon
+            mutation frequency +/- SD for all groups
+    '''
+    import matplotlib.pyplot as plt
+
+    samples = [sample for members in replicate_groups.values() for sample in members]
+    stacked = stack_codon_counts(df_hash, samples = samples)
+    freqs = codon_frequencies(stacked)
+    positions = stacked['positions']
+
+    overlay_fig, overlay_ax = plt.subplots(1, 1, figsize = (12, 4))
+    start = 0
+    for group, members in replicate_groups.items():
+        group_slice = slice(start, start + len(members))
+        start += len(members)
+        stats = replicate_statistics(freqs[group_slice], stacked['depth'][group_slice])
+
+        observed = stats['n_observed'] > 0
+        pos_idx, codon_idx = numpy.nonzero(observed)
+        variant_df = pandas.DataFrame({'POSITION': positions[pos_idx], 'CODON': numpy.array(CODONS)[codon_idx],
+                                       'AA': CODON_AA[codon_idx], 'mean_freq': stats['variant_mean'][observed],
+                                       'sd_freq': stats['variant_sd'][observed], 'n_replicates_observed': stats['n_observed'][observed]})
+        variant_df.to_csv(os.path.join(outdir, 'replicate_variant_stats_{}.tsv'.format(group)), sep = '\t', index = False)
+
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            cv = stats['mut_freq_sd'] / stats['mut_freq_mean']
+        position_df = pandas.DataFrame({'POSITION': positions, 'mean_depth': stats['mean_depth'], 'mean_mut_freq': stats['mut_freq_mean'],
+                                        'sd_mut_freq': stats['mut_freq_sd'], 'cv_mut_freq': cv, 'mean_pairwise_r': stats['position_r']})
+        for idx, sample in enumerate(members):
+            position_df['mut_freq_{}'.format(sample)] = stats['mut_freq'][idx]
+        position_df.to_csv(os.path.join(outdir, 'replicate_position_stats_{}.tsv'.format(group)), sep = '\t', index = False)
+
+        pandas.DataFrame(stats['correlation'], index = members, columns = members).to_csv(
+            os.path.join(outdir, 'replicate_correlation_{}.tsv'.format(group)), sep = '\t')
+
+        color = colors.get(members[0], 'black')
+        if len(members) > 1:
+            plot_replicate_concordance(freqs[group_slice], members, group, color, os.path.join(outdir, 'replicate_concordance_{}.png'.format(group)))
+
+        overlay_ax.plot(positions, stats['mut_freq_mean'], color = color, linewidth = 1, label = '{} (n={})'.format(group, len(members)))
+        if len(members) > 1:
+            overlay_ax.fill_between(positions, stats['mut_freq_mean'] - stats['mut_freq_sd'], stats['mut_freq_mean'] + stats['mut_freq_sd'],
+                                    color = color, alpha = 0.25, linewidth = 0)
+
+    overlay_ax.set_title('Mean mutational frequency per codon across replicates (+/- SD)', fontweight = 'bold')
+    overlay_ax.set_xlabel('codon position')
+    overlay_ax.set_ylabel('mutational frequency')
+    overlay_ax.ticklabel_format(axis = 'y', style = 'scientific', scilimits = (0.0, 0.0), useMathText = True)
+    overlay_ax.legend()
+    overlay_fig.tight_layout()
+    overlay_fig.savefig(os.path.join(outdir, 'replicate_mutation_freq_per_codon_all_groups.png'), dpi = 600, format = 'png')
+    plt.close(overlay_fig)
@@ -0,0 +1,520 @@
+import pandas
+import argparse
+import typing
+import inspect
+import io
+import json
+import os
+import concurrent.futures
+import numpy
+
+import plot_mutational_frequency_and_qc_stats as dms_plots
+import replicates
+import rarefaction
+import html_report
+import library_audit
+import substitution_spectrum
+import timecourse
+import qc_anomalies
+import codon_usage
+import sinple_to_codon
+import variant_filters
+import provenance
+import coordinates
+from codon_tables import load_codon_table
+from aa_properties import AA_ORDERS
+
+'''
+Manifest-driven entry point for plot_mutational_frequency_and_qc_stats.py
+
+A manifest describes every library of an experiment in one place, instead of tying
+--data, --samplename and --colors together by list order.  Either format is accepted:
+
+    TSV (tab-separated, lines starting with # are ignored)
+        sample    path                       color     role      replicate_group
+        wtDNA     wtDNA_S16_cleaned.codon    #999999   control   wt
+        mutDNA    mutDNA_S15_cleaned.codon   #E69F00   selected  mut
+
+    YAML (requires pyyaml)
+        params:
+          qual: 24.0
+          counts: 100
+          pos: 9-397
+          analyses: [nt_mutations, aa_type, coverage]
+        samples:
+          - {sample: wtDNA, path: wtDNA_S16_cleaned.codon, color: '#999999', role: control, replicate_group: wt}
+
+Only sample and path are required; relative paths are resolved against the manifest's directory.
+An optional passage column (numeric passage or time of each library) is used by the timecourse analysis.
+Paths ending in .variants are SiNPle output and are converted with sinple_to_codon.py (needs --reference).
+Paths ending in .parquet are tables from codon_store.py; only the row groups covering --pos are read.
+
+The run is executed as a dependency graph: one filter stage per sample, followed by
+one stage per selected analysis that depends on every filter stage.  Each stage
+leaves a stamp in <outdir>/.stages recording its parameters and the size/mtime of its
+inputs, so rerunning the same manifest only recomputes stages whose inputs or
+parameters changed (or whose outputs were deleted).  Independent stages run
+concurrently in a process pool.
+
+Whole-genome mode (--genes, a GFF3 or TSV of ORFs): a route stage per sample splits it into one codon table per
+gene (coordinates.route_codon_positions for codon tables, whose codon 1 starts at --orfStart; SiNPle files are
+converted in every gene's own frame), then the filter and analysis stages above run per gene, in parallel, with
+codons numbered within the gene and outputs in <outdir>/<gene>.
+'''
+
+MANIFEST_COLUMNS = ['sample', 'path', 'color', 'role', 'replicate_group']
+
+# The colorblind friendly palette with grey, used when the manifest does not provide colors
+CB_PALETTE = ["#999999", "#E69F00", "#56B4E9", "#009E73", "#F0E442", "#0072B2", "#D55E00", "#CC79A7"]
+
+DEFAULT_PARAMS = {'qual': 24.0, 'counts': 100, 'pos': '0-0', 'nonSynOnly': False, 'includeStop': False, 'annotate': False,
+                  'strandBiasP': None, 'maxSOR': None, 'minFreq': 0.0, 'depthWindow': 25,
+                  'reference': None, 'orfStart': 9821, 'annotConfig': None, 'aaOrder': 'property',
+                  'designScheme': 'NNK', 'designCustom': None, 'underQuantile': 0.05, 'spectrumWindow': 50, 'timecourseTop': 10, 'genes': None, 'anomalyZ': 4.0,
+                  'codonBiasZ': 3.0, 'synonymousBias': 0.5,
+                  'rarefyDepth': None, 'rarefyIterations': 100, 'rarefyBatch': 50, 'rarefyMethod': 'hypergeometric', 'rarefyCurvePoints': 10, 'seed': 0}
+
+# analysis name -> function to run and the files it writes into outdir
+# outputs receives the list of sample names and the run parameters
+ANALYSES = {
+    'nt_mutations': {'func': dms_plots.get_per_codon_ntNum_mutational_freq,
+                     'outputs': lambda samples, params: ['freq_of_nt_changes_per_codon_{}.png'.format(s) for s in samples]},
+    'aa_type': {'func': dms_plots.get_per_codon_aaTypeChange_mutational_freq,
+                'outputs': lambda samples, params: ['freq_of_aa_changes_per_codon_lineplot_{}.png'.format(s) for s in samples] + ['freq_of_aa_changes_per_codon_lineplot_sample_overlay.png']},
+    'aa_type_barplot': {'func': dms_plots.get_per_sample_aaTypeChange_mutational_freq_stackedBarPlot,
+                        'outputs': lambda samples, params: ['freq_of_aa_changes_across_codons_all_samples_stackedBarPlot.png']},
+    'nt_barplot': {'func': dms_plots.get_per_sample_ntNum_mutational_freq_stackedBarPlot,
+                   'outputs': lambda samples, params: ['freq_of_nt_changes_across_codons_all_samples_stackedBarPlot.png']},
+    'information_logo': {'func': dms_plots.get_per_codon_aa_mutational_information_logoplot,
+                         'outputs': lambda samples, params: ['logoplot_of_mutations_information_{}.png'.format(s) for s in samples]},
+    'coverage': {'func': dms_plots.get_coverage_per_codon,
+                 'outputs': lambda samples, params: ['depth_of_coverage_{}.png'.format(s) for s in samples]},
+    'combined_barplot': {'func': dms_plots.get_combined_mutational_frequencies_stacked_barplot,
+                         'outputs': lambda samples, params: ['combined_mutational_frequencies_across_samples_and_mutations_grouped_stackedBarPlot.png']},
+    'aa_diversity': {'func': dms_plots.get_aa_diversity,
+                     'outputs': lambda samples, params: ['amino_acid_diversity_at_each_codon_across_samples.png']},
+    'freq_logo': {'func': dms_plots.get_per_codon_aa_mutational_freq_logoplot,
+                  'outputs': lambda samples, params: ['logoplot_of_mutations_freq_{}_{}_stop_codons.png'.format(s, 'including' if params['includeStop'] else 'excluding') for s in samples]},
+    'replicates': {'func': replicates.get_replicate_statistics,
+                   'outputs': lambda samples, params: ['replicate_mutation_freq_per_codon_all_groups.png']},
+    'rarefaction': {'func': rarefaction.get_rarefied_aa_diversity,
+                    'outputs': lambda samples, params: ['rarefaction_curves_aa_diversity.tsv'] + ['rarefied_aa_diversity_per_codon_{}.tsv'.format(s) for s in samples]},
+    'physicochemical': {'func': dms_plots.get_physicochemical_change_spectrum,
+                        'outputs': lambda samples, params: ['physicochemical_changes_per_codon_{}.{}'.format(s, ext) for s in samples for ext in ['tsv', 'png']]
+                                                           + ['physicochemical_change_spectrum_all_samples.tsv', 'physicochemical_change_spectrum_stackedBarPlot.png']},
+    'domains': {'func': dms_plots.get_domain_summary,
+                'outputs': lambda samples, params: ['domain_summary_all_samples.tsv', 'domain_summary_heatmap.png']},
+    'aa_heatmap': {'func': dms_plots.get_per_codon_aa_heatmap,
+                   'outputs': lambda samples, params: ['heatmap_of_aa_freq_{}.png'.format(s) for s in samples]},
+    'library_audit': {'func': library_audit.get_library_audit,
+                      'outputs': lambda samples, params: ['library_completeness_per_codon.png'] + ['library_audit_positions_{}.tsv'.format(s) for s in samples]},
+    'substitution_spectrum': {'func': substitution_spectrum.get_substitution_spectrum,
+                              'outputs': lambda samples, params: ['substitution_spectrum_all_samples.tsv', 'substitution_tstv_all_samples.tsv',
+                                                                  'substitution_spectrum_heatmaps.png', 'substitution_tstv_per_window.png']},
+    'timecourse': {'func': timecourse.get_timecourse,
+                   'outputs': lambda samples, params: ['timecourse_selection_coefficients.tsv', 'timecourse_frequencies.tsv', 'timecourse_top_trajectories.png']},
+    'qc_anomalies': {'func': qc_anomalies.get_qc_anomalies,
+                     'outputs': lambda samples, params: ['qc_anomalies.tsv', 'qc_anomaly_summary.tsv', 'qc_anomaly_overview.png']},
+    'codon_usage': {'func': codon_usage.get_codon_usage,
+                    'outputs': lambda samples, params: ['codon_usage_matrix_{}.tsv'.format(s) for s in samples]
+                                                       + ['codon_usage_all_samples.tsv', 'codon_usage_per_position.tsv', 'codon_usage_rscu.png', 'codon_usage_enc_per_codon.png']},
+    'html_report': {'func': html_report.get_html_report,
+                    'outputs': lambda samples, params: ['dms_report.html']},
+}
+
+# same set and order of analyses that plot_mutational_frequency_and_qc_stats.py runs
+DEFAULT_ANALYSES = ['nt_mutations', 'aa_type', 'aa_type_barplot', 'nt_barplot', 'information_logo', 'coverage', 'combined_barplot', 'aa_diversity']
+
+
+def read_manifest(manifest: str) -> typing.Tuple[pandas.DataFrame, dict]:
+    '''
+    input: path to a .tsv/.txt or .yaml/.yml manifest
+    output: tuple of (dataframe with one row per sample and the columns in MANIFEST_COLUMNS,
+            dict of run parameters found in the manifest; always empty for TSV manifests)
+    '''
+    params = {}
+    if manifest.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('pyyaml is required to read YAML manifests; install it or provide a TSV manifest')
+        with open(manifest, 'r') as handle:
+            content = yaml.safe_load(handle) or {}
+        params = content.get('params', {}) or {}
+        samples = pandas.DataFrame(content.get('samples', []))
+    else:
+        # comment lines are dropped up front since pandas' comment option would also cut hex colors like #E69F00
+        with open(manifest, 'r') as handle:
+            lines = [line for line in handle if not line.startswith('#') and line.strip() != '']
+        samples = pandas.read_csv(io.StringIO(''.join(lines)), sep = '\t', dtype = str)
+
+    samples.columns = [column.strip() for column in samples.columns]
+    for required in ['sample', 'path']:
+        if required not in samples.columns:
+            raise ValueError('manifest {} is missing required column "{}"'.format(manifest, required))
+    if samples.empty:
+        raise ValueError('manifest {} does not list any samples'.format(manifest))
+
+    samples['sample'] = samples['sample'].astype(str).str.strip()
+    duplicated = samples.loc[samples['sample'].duplicated(), 'sample'].tolist()
+    if duplicated:
+        raise ValueError('sample names must be unique in the manifest, found duplicates: {}'.format(', '.join(duplicated)))
+
+    # relative paths are relative to the manifest, not to the working directory
+    manifest_dir = os.path.dirname(os.path.abspath(manifest))
+    samples['path'] = [path if os.path.isabs(path) else os.path.join(manifest_dir, path) for path in samples['path'].astype(str).str.strip()]
+    missing = [path for path in samples['path'] if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError('codon tables listed in manifest do not exist: {}'.format(', '.join(missing)))
+
+    if 'color' not in samples.columns:
+        samples['color'] = None
+    samples['color'] = [color if isinstance(color, str) and color.strip() != '' else CB_PALETTE[idx % len(CB_PALETTE)]
+                        for idx, color in enumerate(samples['color'])]
+    if 'role' not in samples.columns:
+        samples['role'] = ''
+    samples['role'] = samples['role'].fillna('').astype(str).str.strip().str.lower()
+    if 'replicate_group' not in samples.columns:
+        samples['replicate_group'] = None
+    # a sample without a replicate group is its own group
+    samples['replicate_group'] = [group if isinstance(group, str) and group.strip() != '' else sample
+                                  for sample, group in zip(samples['sample'], samples['replicate_group'])]
+
+    extra_columns = [column for column in samples.columns if column not in MANIFEST_COLUMNS]
+    samples = samples[MANIFEST_COLUMNS + extra_columns].reset_index(drop = True)
+
+    return samples, params
+
+
+def passages(samples: pandas.DataFrame) -> dict:
+    '''
+    output: dict of sample -> passage (float) from the optional manifest column passage; samples with an empty
+            passage are left out
+    '''
+    if 'passage' not in samples.columns:
+        return {}
+    timepoints = {}
+    for sample, passage in zip(samples['sample'], samples['passage']):
+        if pandas.isna(passage) or str(passage).strip() == '':
+            continue
+        try:
+            timepoints[sample] = float(passage)
+        except ValueError:
+            raise ValueError('passage of sample {} must be a number, found "{}"'.format(sample, passage))
+    return timepoints
+
+
+def codon_table_path(path: str, reference: typing.Optional[str], orfStart: int, converted: str) -> str:
+    '''
+    output: path of the codon table of a sample; SiNPle .variants files are converted to converted first
+    '''
+    if not path.endswith('.variants'):
+        return path
+    if reference is None:
+        raise ValueError('{} is SiNPle output; a reference fasta (--reference) is required to convert it to codons'.format(path))
+    sinple_to_codon.convert_sinple(variants = path, reference = reference, orf_start = orfStart, outfile = converted)
+    return converted
+
+
+def filter_stage(path: str, outfile: str, qual: float, counts: int, pos: str, strandBiasP: typing.Optional[float], maxSOR: typing.Optional[float],
+                 minFreq: float, depthWindow: int, reference: typing.Optional[str], orfStart: int) -> None:
+    '''
+    filters one virVar codon table in chunks with variant_filters and writes the filtered table as tsv and the
+    rejection counts of every filter as <sample>.filter_report.tsv next to it
+    SiNPle .variants files are converted to a codon table (next to outfile) first
+    '''
+    path = codon_table_path(path, reference, orfStart, outfile.replace('.filtered.tsv', '.codon'))
+    report = variant_filters.filter_codon_file(path, outfile, minQ = qual, minAlt = counts, codonRange = pos,
+                                               strandBiasP = strandBiasP, maxSOR = maxSOR, minFreq = minFreq, depthWindow = depthWindow)
+    report.to_csv(outfile.replace('.filtered.tsv', '.filter_report.tsv'), sep = '\t')
+
+
+def call_analysis(name: str, df_hash: typing.Optional[dict], sample_paths: dict, colors: dict, replicate_groups: dict, params: dict, outdir: str,
+                  timepoints: typing.Optional[dict] = None) -> None:
+    '''
+    runs one registered analysis on already loaded filtered tables (df_hash may be None when the analysis does
+    not take it); only the keyword arguments the analysis function accepts are passed to it
+    timepoints maps sample -> passage for the samples that have one
+    '''
+    func = ANALYSES[name]['func']
+    accepted = inspect.signature(func).parameters
+    available = {'df_hash': df_hash, 'sample_paths': sample_paths, 'colors': colors, 'replicate_groups': replicate_groups, 'timepoints': timepoints or {}, 'outdir': outdir, 'nonsynOnly': params['nonSynOnly'],
+                 'includeStop': params['includeStop'], 'annot': params['annotate'], 'annotations': params['annotConfig'], 'aaOrder': params['aaOrder'],
+                 'gene': params.get('gene'), 'params': params}
+    func(**{key: value for key, value in available.items() if key in accepted})
+
+
+def analysis_stage(name: str, filtered: dict, sample_paths: dict, colors: dict, replicate_groups: dict, params: dict, outdir: str,
+                   timepoints: typing.Optional[dict] = None) -> None:
+    '''
+    loads the filtered tables of all samples (in manifest order) and runs one registered analysis
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    # analyses that work from the raw tables (sample_paths) do not need the filtered ones loaded
+    needs_tables = 'df_hash' in inspect.signature(ANALYSES[name]['func']).parameters
+    df_hash = {sample: load_codon_table(path) for sample, path in filtered.items()} if needs_tables else None
+    call_analysis(name, df_hash, sample_paths, colors, replicate_groups, params, outdir, timepoints)
+    plt.close('all') # workers are reused between stages
+
+
+def route_stage(path: str, outfiles: dict, genes: str, reference: typing.Optional[str], orfStart: int) -> None:
+    '''
+    splits one sample into one codon table per gene of the gene table (whole-genome mode), numbered by the codons
+    of the gene; codon tables are split by codon number (their codon 1 starts at orfStart), SiNPle .variants
+    files are converted in the frame of every gene
+    '''
+    gene_table = coordinates.load_genes(genes)
+    if path.endswith('.variants'):
+        if reference is None:
+            raise ValueError('{} is SiNPle output; a reference fasta (--reference) is required to convert it to codons'.format(path))
+        sinple_to_codon.convert_sinple_genes(variants = path, reference = reference, genes = gene_table, outfiles = outfiles)
+        return
+    df = load_codon_table(path)
+    for gene, (rows, positions) in coordinates.route_codon_positions(df['POSITION'].to_numpy(), gene_table, orfStart).items():
+        routed = df.iloc[rows].copy()
+        routed['POSITION'] = positions
+        routed.to_csv(outfiles[gene], sep = '\t', index = False)
+
+
+def filter_stages(stages: dict, sample_paths: dict, params: dict, outdir: str, prefix: str = '', deps: typing.Optional[dict] = None) -> dict:
+    '''
+    adds one filter stage per sample to stages, named filter:<prefix><sample> and writing to outdir/<sample>.filtered.tsv
+    output: dict of sample -> filtered table
+    '''
+    filtered = {}
+    filter_params = {key: params[key] for key in ['qual', 'counts', 'pos', 'strandBiasP', 'maxSOR', 'minFreq', 'depthWindow', 'reference', 'orfStart']}
+    for sample, path in sample_paths.items():
+        outfile = os.path.join(outdir, '{}.filtered.tsv'.format(sample))
+        filtered[sample] = outfile
+        stages['filter:{}{}'.format(prefix, sample)] = {'func': filter_stage, 'kwargs': dict(path = path, outfile = outfile, **filter_params),
+                                                       'deps': (deps or {}).get(sample, []), 'inputs': [path] + ([params['reference']] if path.endswith('.variants') else []),
+                                                       'outputs': [outfile, outfile.replace('.filtered.tsv', '.filter_report.tsv')], 'params': filter_params}
+    return filtered
+
+
+def analysis_stages(stages: dict, analyses: list, filtered: dict, sample_paths: dict, colors: dict, replicate_groups: dict, timepoints: dict,
+                    params: dict, outdir: str, prefix: str = '') -> None:
+    '''
+    adds one stage per analysis to stages, named analysis:<prefix><analysis>, depending on the filter stages of every sample
+    '''
+    filter_prefix = 'filter:{}'.format(prefix)
+    for name in analyses:
+        outputs = [os.path.join(outdir, output) for output in ANALYSES[name]['outputs'](list(filtered), params)]
+        stages['analysis:{}{}'.format(prefix, name)] = {'func': analysis_stage,
+                                                        'kwargs': dict(name = name, filtered = filtered, sample_paths = sample_paths, colors = colors, replicate_groups = replicate_groups,
+                                                                      params = params, outdir = outdir, timepoints = timepoints),
+                                                        'deps': ['{}{}'.format(filter_prefix, sample) for sample in filtered],
+                                                        'inputs': list(filtered.values()) + list(sample_paths.values()), 'outputs': outputs,
+                                                        'params': {'params': params, 'colors': colors, 'replicate_groups': replicate_groups, 'timepoints': timepoints, 'samples': list(filtered)}}
+
+
+def build_stages(samples: pandas.DataFrame, params: dict, analyses: list, outdir: str) -> dict:
+    '''
+    output: dict of stage name -> stage description (function, kwargs, dependencies, inputs, outputs and
+            the parameters that make up its signature)
+    with params['genes'] (whole-genome mode) every sample is first routed into one codon table per gene
+    (genes/<gene>/<sample>.codon) and filter and analysis stages run per gene, writing into <outdir>/<gene>
+    '''
+    for name in analyses:
+        if name not in ANALYSES:
+            raise ValueError('unknown analysis "{}", choose from: {}'.format(name, ', '.join(ANALYSES)))
+    stages = {}
+    sample_paths = dict(zip(samples['sample'], samples['path']))
+    colors = dict(zip(samples['sample'], samples['color']))
+    replicate_groups = {}
+    for sample, group in zip(samples['sample'], samples['replicate_group']):
+        replicate_groups.setdefault(group, []).append(sample)
+    timepoints = passages(samples)
+
+    if params['genes'] is None:
+        filtered = filter_stages(stages, sample_paths, params, os.path.join(outdir, 'filtered'))
+        analysis_stages(stages, analyses, filtered, sample_paths, colors, replicate_groups, timepoints, params, outdir)
+        return stages
+
+    genes = coordinates.load_genes(params['genes'])
+    if params['annotConfig'] is not None:
+        # fails here, before anything runs, when the annotations cannot be assigned to the genes
+        coordinates.load_annotations(params['annotConfig'], gene = '')
+    directories = coordinates.gene_directories(genes)
+    if any(not path.endswith('.variants') for path in sample_paths.values()):
+        # fails here, before anything runs, when a codon table cannot be read in the frame of every gene
+        coordinates.route_codon_positions(numpy.zeros(0, dtype = numpy.int64), genes, params['orfStart'])
+    route_params = {key: params[key] for key in ['genes', 'reference', 'orfStart']}
+    for sample, path in sample_paths.items():
+        outfiles = {gene: os.path.join(outdir, 'genes', directory, '{}.codon'.format(sample)) for gene, directory in directories.items()}
+        stages['route:{}'.format(sample)] = {'func': route_stage, 'kwargs': dict(path = path, outfiles = outfiles, **route_params),
+                                             'deps': [], 'inputs': [path, params['genes']] + ([params['reference']] if path.endswith('.variants') else []),
+                                             'outputs': list(outfiles.values()), 'params': route_params}
+    for gene, orf_start in zip(genes['gene'], genes['orf_start']):
+        directory = directories[gene]
+        # codon numbers, --pos, the reference codons and the annotation rows of the analyses are those of the gene
+        gene_params = dict(params, orfStart = int(orf_start), gene = gene)
+        gene_paths = {sample: os.path.join(outdir, 'genes', directory, '{}.codon'.format(sample)) for sample in sample_paths}
+        prefix = '{}:'.format(directory)
+        filtered = filter_stages(stages, gene_paths, gene_params, os.path.join(outdir, 'filtered', directory), prefix,
+                                 deps = {sample: ['route:{}'.format(sample)] for sample in sample_paths})
+        analysis_stages(stages, analyses, filtered, gene_paths, colors, replicate_groups, timepoints, gene_params, os.path.join(outdir, directory), prefix)
+    return stages
+
+
+def stage_signature(stage: dict) -> dict:
+    inputs = {}
+    for path in stage['inputs']:
+        stat = os.stat(path)
+        inputs[path] = [stat.st_size, stat.st_mtime_ns]
+    return {'params': stage['params'], 'inputs': inputs}
+
+
+def stamp_path(outdir: str, name: str) -> str:
+    return os.path.join(outdir, '.stages', '{}.json'.format(name.replace(':', '__')))
+
+
+def is_up_to_date(stage: dict, name: str, outdir: str) -> bool:
+    if not all(os.path.exists(output) for output in stage['outputs']):
+        return False
+    try:
+        with open(stamp_path(outdir, name), 'r') as handle:
+            recorded = json.load(handle)
+    except (OSError, ValueError):
+        return False
+    # round trip through json so tuples/lists and numeric types compare the same way
+    return recorded == json.loads(json.dumps(stage_signature(stage), default = str))
+
+
+def run_stages(stages: dict, outdir: str, threads: int = 1, force: bool = False) -> dict:
+    '''
+    executes stages in dependency order, running every stage whose dependencies are satisfied concurrently
+    output: dict of stage name -> one of 'ran', 'up-to-date', 'failed' or 'blocked' (a dependency failed)
+    '''
+    os.makedirs(os.path.join(outdir, '.stages'), exist_ok = True)
+    for directory in set(os.path.dirname(output) for stage in stages.values() for output in stage['outputs']):
+        os.makedirs(directory, exist_ok = True)
+    status = {}
+    pending = dict(stages)
+    running = {}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = threads) as pool:
+        while pending or running:
+            # a stage is ready once all its dependencies finished; blocked if any of them did not succeed
+            for name, stage in list(pending.items()):
+                if any(status.get(dep) in ['failed', 'blocked'] for dep in stage['deps']):
+                    status[name] = 'blocked'
+                    del pending[name]
+                elif all(status.get(dep) in ['ran', 'up-to-date'] for dep in stage['deps']):
+                    del pending[name]
+                    if not force and is_up_to_date(stage, name, outdir):
+                        status[name] = 'up-to-date'
+                        print('{}: up to date, skipping'.format(name))
+                    else:
+                        print('{}: running'.format(name))
+                        running[pool.submit(stage['func'], **stage['kwargs'])] = name
+            if not running:
+                if pending:
+                    # nothing can make progress, which only happens with a dependency that is not a stage
+                    for name in pending:
+                        status[name] = 'blocked'
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    status[name] = 'failed'
+                    print('{}: failed with {}: {}'.format(name, type(error).__name__, error))
+                    continue
+                status[name] = 'ran'
+                with open(stamp_path(outdir, name), 'w') as handle:
+                    json.dump(stage_signature(stages[name]), handle, default = str)
+
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Runs filtering and plotting of deep mutational scanning codon tables from a sample manifest.',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--manifest', required = True, type = str, help = 'TSV or YAML manifest listing sample, path, and optionally color, role and replicate_group')
+    parser.add_argument('--outdir', default = os.getcwd(), help = 'Path to output directory to write filtered tables, stage stamps and plots')
+    parser.add_argument('--analyses', default = None, type = str, help = 'comma-separated list of analyses to run; choose from {} (default: params.analyses in a YAML manifest, else {})'.format(', '.join(ANALYSES), ','.join(DEFAULT_ANALYSES)))
+    parser.add_argument('--qual', default = None, type = float, help = 'minimum average quality of reads to keep (default: params.qual in a YAML manifest, else {})'.format(DEFAULT_PARAMS['qual']))
+    parser.add_argument('--counts', default = None, type = int, help = 'minimum number of counts for a codon variant to keep (default: params.counts in a YAML manifest, else {})'.format(DEFAULT_PARAMS['counts']))
+    parser.add_argument('--pos', default = None, type = str, help = 'integer range of codon positions to use, e.g. 7-100 (default: params.pos in a YAML manifest, else all positions)')
+    parser.add_argument('--nonSynOnly', action = 'store_true', default = None, help = 'If setting this flag, only nonsynonymous mutations will be considered')
+    parser.add_argument('--includeStop', action = 'store_true', default = None, help = 'If setting this flag, include STOP codons')
+    parser.add_argument('--strandBiasP', default = None, type = float, help = 'reject variants whose forward/reverse read split differs from the coverage with binomial p below this (default: no strand bias test)')
+    parser.add_argument('--maxSOR', default = None, type = float, help = 'reject variants with a strand odds ratio above this, GATK uses 3 (default: no strand odds ratio filter)')
+    parser.add_argument('--minFreq', default = None, type = float, help = 'reject variants with fewer counts than this fraction of the local depth (default: {})'.format(DEFAULT_PARAMS['minFreq']))
+    parser.add_argument('--depthWindow', default = None, type = int, help = 'number of codons over which the local depth for --minFreq is taken (default: {})'.format(DEFAULT_PARAMS['depthWindow']))
+    parser.add_argument('--reference', default = None, type = str, help = 'reference fasta; required when the manifest lists SiNPle .variants files, which are converted to codon tables')
+    parser.add_argument('--orfStart', default = None, type = int, help = '1-based genome position of the first base of codon 1 for SiNPle conversion, and of the codon tables with --genes (default: {})'.format(DEFAULT_PARAMS['orfStart']))
+    parser.add_argument('--genes', default = None, type = str, help = 'whole-genome mode: GFF3 or TSV (gene,start,end[,strand,phase]) of ORFs; samples are routed to every gene and all analyses run per gene into <outdir>/<gene>')
+    parser.add_argument('--annotate', action = 'store_true', default = None, help = 'draw annotation bars on the frequency logo plots')
+    parser.add_argument('--annotConfig', default = None, type = str, help = 'csv of region_name,start,end,color codon annotations for the logo annotation bars and the domains analysis; with --genes it needs a gene column and every gene uses its own rows (default: E3/E2 bounds, none with --genes)')
+    parser.add_argument('--aaOrder', default = None, choices = AA_ORDERS, help = 'aa_heatmap analysis: order of the amino acid rows (default: {})'.format(DEFAULT_PARAMS['aaOrder']))
+    parser.add_argument('--designScheme', default = None, type = str, help = 'library_audit analysis: degenerate codon of the library design (NNK, NNS, ...), 19aa or custom (default: {})'.format(DEFAULT_PARAMS['designScheme']))
+    parser.add_argument('--designCustom', default = None, type = str, help = 'library_audit analysis: codons of a custom design, comma-separated or csv/tsv with CODON and optional POSITION columns')
+    parser.add_argument('--underQuantile', default = None, type = float, help = 'library_audit analysis: frequency quantile below which designed variants are under-represented (default: {})'.format(DEFAULT_PARAMS['underQuantile']))
+    parser.add_argument('--spectrumWindow', default = None, type = int, help = 'substitution_spectrum analysis: number of codons per window of the Ts/Tv profile (default: {})'.format(DEFAULT_PARAMS['spectrumWindow']))
+    parser.add_argument('--timecourseTop', default = None, type = int, help = 'timecourse analysis: number of most increasing and most decreasing variants to plot (default: {})'.format(DEFAULT_PARAMS['timecourseTop']))
+    parser.add_argument('--anomalyZ', default = None, type = float, help = 'qc_anomalies analysis: robust z-score across samples from which a codon of a sample is flagged (default: {})'.format(DEFAULT_PARAMS['anomalyZ']))
+    parser.add_argument('--codonBiasZ', default = None, type = float, help = 'codon_usage analysis: flag positions whose effective number of codons is this many robust z-scores below the sample median (default: {})'.format(DEFAULT_PARAMS['codonBiasZ']))
+    parser.add_argument('--synonymousBias', default = None, type = float, help = 'codon_usage analysis: flag positions whose synonymous codons are used less evenly than this, (effective - 1) / (available - 1) between 0 (one codon) and 1 (even) (default: {})'.format(DEFAULT_PARAMS['synonymousBias']))
+    parser.add_argument('--rarefyDepth', default = None, type = int, help = 'rarefaction analysis: common read depth to subsample every position to (default: the minimum depth across samples at each position)')
+    parser.add_argument('--rarefyIterations', default = None, type = int, help = 'rarefaction analysis: number of Monte-Carlo subsampling iterations (default: {})'.format(DEFAULT_PARAMS['rarefyIterations']))
+    parser.add_argument('--rarefyBatch', default = None, type = int, help = 'rarefaction analysis: iterations drawn at once; bounds memory (default: {})'.format(DEFAULT_PARAMS['rarefyBatch']))
+    parser.add_argument('--rarefyMethod', default = None, choices = ['hypergeometric', 'multinomial'], help = 'rarefaction analysis: subsample without (hypergeometric) or with (multinomial) replacement (default: hypergeometric)')
+    parser.add_argument('--rarefyCurvePoints', default = None, type = int, help = 'rarefaction analysis: number of subsampling depths on the rarefaction curves (default: {})'.format(DEFAULT_PARAMS['rarefyCurvePoints']))
+    parser.add_argument('--seed', default = None, type = int, help = 'random seed for rarefaction (default: {})'.format(DEFAULT_PARAMS['seed']))
+    parser.add_argument('--threads', default = os.cpu_count(), type = int, help = 'number of stages to run concurrently')
+    parser.add_argument('--force', action = 'store_true', help = 'rerun every stage even if its outputs are up to date')
+    parser.add_argument('--store', default = None, type = str, help = 'content-addressed run store; runs are written to <store>/objects/<hash> keyed by the input files, parameters and analyses, an identical configuration is served from the store, and the outputs are placed into --outdir')
+    args = parser.parse_args()
+
+    samples, manifest_params = read_manifest(args.manifest)
+
+    # command line overrides manifest, manifest overrides defaults
+    params = dict(DEFAULT_PARAMS)
+    params.update({key: value for key, value in manifest_params.items() if key in DEFAULT_PARAMS})
+    params.update({key: getattr(args, key) for key in DEFAULT_PARAMS if getattr(args, key, None) is not None})
+
+    if args.analyses is not None:
+        analyses = [analysis.strip() for analysis in args.analyses.split(',') if analysis.strip() != '']
+    else:
+        analyses = manifest_params.get('analyses', DEFAULT_ANALYSES)
+
+    os.makedirs(args.outdir, exist_ok = True)
+    if args.store is not None:
+        conn = provenance.open_store(args.store)
+        run_hash, config = provenance.run_config(conn, samples, params, analyses)
+        run = provenance.lookup_run(conn, run_hash)
+        damaged = provenance.verify_run(conn, args.store, run_hash) if run is not None and run['status'] == 'complete' and not args.force else []
+        if damaged:
+            # artifacts changed after the run was stored; recompute rather than serve them
+            print('run {} in store {} has {} changed artifacts ({}), recomputing'.format(run_hash[:12], args.store, len(damaged), ', '.join(damaged[:3])))
+            provenance.remove_run(conn, args.store, run_hash)
+            run = None
+        if run is not None and run['status'] == 'complete' and not args.force:
+            placed = provenance.materialize(conn, args.store, run_hash, args.outdir)
+            print('run {} served from store {} ({} files)'.format(run_hash[:12], args.store, placed))
+            raise SystemExit(0)
+        run_dir = provenance.run_directory(args.store, run_hash)
+        os.makedirs(run_dir, exist_ok = True)
+    else:
+        run_dir = args.outdir
+    stages = build_stages(samples = samples, params = params, analyses = analyses, outdir = run_dir)
+    status = run_stages(stages = stages, outdir = run_dir, threads = args.threads, force = args.force)
+
+    if args.store is not None:
+        failed = any(state in ['failed', 'blocked'] for state in status.values())
+        provenance.register_run(conn, args.store, run_hash, config, 'failed' if failed else 'complete')
+        provenance.materialize(conn, args.store, run_hash, args.outdir)
+        print('run {} stored in {}'.format(run_hash[:12], run_dir))
+
+    for name, state in status.items():
+        print('{}\t{}'.format(name, state))
+    if any(state in ['failed', 'blocked'] for state in status.values()):
+        raise SystemExit(1)
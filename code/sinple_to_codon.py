@@ -0,0 +1,192 @@
+import argparse
+import csv
+import os
+import typing
+import pandas
+
+from codon_tables import CODON_TABLE_COLUMNS, CODON_TO_AA
+from coordinates import CodingRegion, gene_directories, genes_at, load_genes, read_reference
+
+'''
+Converts SiNPle .variants output into a virVar-style codon table, so SiNPle-called samples can go
+through plot_mutational_frequency_and_qc_stats.py and every other codon-table tool unchanged.
+
+SiNPle writes one line per reference base with a variable number of fields:
+    chrom  pos  (variant  total_reads  avg_read_qual  posterior_probability)*
+The file is streamed once; sites are grouped into codons using the reference reading frame given by
+--orfStart (1-based genome position of the first base of codon 1), and each codon is written as soon
+as the stream moves past it, so memory does not depend on the size of the input.
+
+SiNPle calls are per site and not phased, so every alternative base becomes a single-nucleotide codon
+variant of the reference codon.  CNT is the read count of the alternative base and DENOM the total
+read count of its site; the reference codon row gets the smallest reference-base count and depth of the
+sites of that codon.  SiNPle does not split reads by strand, so the average read quality is written to
+both FWD_MEAN_MIN_QUAL and REV_MEAN_MIN_QUAL and the strand count/stddev columns are left empty.
+Insertions, deletions and other non A/C/G/T calls are skipped.
+
+With --genes (GFF3 or TSV of ORFs, see coordinates.load_genes) one codon table per gene is written in a single
+pass, each gene numbered and read in its own frame: --output is then a directory receiving <gene>.codon.
+'''
+
+SINPLE_COLUMNS = CODON_TABLE_COLUMNS + ['POSTERIOR']
+
+
+def parse_sinple_line(line: str) -> typing.Optional[typing.Tuple[int, dict]]:
+    '''
+    input: one line of a SiNPle .variants file
+    output: None for header or malformed lines, otherwise (1-based position,
+            dict of variant -> (total_reads, avg_read_qual, posterior_probability))
+    '''
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) < 2 or not fields[1].strip().isdigit():
+        return None
+    calls = {}
+    for idx in range(2, len(fields) - 3, 4):
+        variant = fields[idx].strip()
+        if variant == '':
+            continue
+        calls[variant] = (int(fields[idx + 1]), float(fields[idx + 2]) if fields[idx + 2] != '' else float('nan'),
+                          float(fields[idx + 3]) if fields[idx + 3] != '' else float('nan'))
+    return int(fields[1]), calls
+
+
+def codon_rows(codon_number: int, ref_codon: str, sites: dict) -> typing.List[dict]:
+    '''
+    input: codon number, reference codon, dict of codon phase (0-2) -> SiNPle calls at that site
+    output: codon table rows (dicts keyed by SINPLE_COLUMNS) for the reference codon and every
+            single-nucleotide alternative
+    '''
+    rows = []
+    ref_aa = CODON_TO_AA.get(ref_codon, 'X')
+    ref_cnt, ref_denom, ref_qual = None, None, None
+    for phase, calls in sorted(sites.items()):
+        depth = sum(reads for reads, _, _ in calls.values())
+        ref_base = ref_codon[phase]
+        if ref_base in calls:
+            if ref_cnt is None or calls[ref_base][0] < ref_cnt:
+                ref_cnt, ref_qual = calls[ref_base][0], calls[ref_base][1]
+        if ref_denom is None or depth < ref_denom:
+            ref_denom = depth
+        for variant, (reads, qual, posterior) in calls.items():
+            base = variant.upper()
+            if base == ref_base or base not in ('A', 'C', 'G', 'T'):
+                continue
+            codon = ref_codon[:phase] + base + ref_codon[phase + 1:]
+            rows.append({'POSITION': codon_number, 'REF_CODON': ref_codon, 'CODON': codon, 'REF_AA': ref_aa,
+                         'AA': CODON_TO_AA.get(codon, 'X'), 'CNT': reads, 'DENOM': depth,
+                         'FREQ': reads / depth if depth > 0 else 0.0,
+                         'FWD_MEAN_MIN_QUAL': qual, 'REV_MEAN_MIN_QUAL': qual, 'POSTERIOR': posterior})
+    if ref_denom:
+        ref_cnt = ref_cnt or 0
+        rows.insert(0, {'POSITION': codon_number, 'REF_CODON': ref_codon, 'CODON': ref_codon, 'REF_AA': ref_aa, 'AA': ref_aa,
+                        'CNT': ref_cnt, 'DENOM': ref_denom, 'FREQ': ref_cnt / ref_denom,
+                        'FWD_MEAN_MIN_QUAL': ref_qual, 'REV_MEAN_MIN_QUAL': ref_qual})
+    return rows
+
+
+class CodonWriter:
+    '''
+    groups the sites of one CodingRegion into codons and writes the rows of each codon to outfile as soon as
+    the (position sorted) stream moves past it
+    '''
+
+    def __init__(self, region: CodingRegion, outfile: str):
+        self.region = region
+        self.handle = open(outfile, 'w', newline = '')
+        self.writer = csv.DictWriter(self.handle, fieldnames = SINPLE_COLUMNS, delimiter = '\t', restval = '', lineterminator = '\n')
+        self.writer.writeheader()
+        self.current_codon = 0
+        self.sites = {}
+        self.written = 0
+
+    def add(self, pos: int, calls: dict) -> None:
+        codon_number = int(self.region.codon_index[pos])
+        if codon_number == 0:
+            return # outside the region or upstream of codon 1, e.g. the last base of the preceding codon
+        if codon_number != self.current_codon:
+            self.flush()
+            self.current_codon = codon_number
+            self.sites = {}
+        self.sites[int(self.region.codon_phase[pos])] = calls
+
+    def flush(self) -> None:
+        if self.current_codon != 0:
+            rows = codon_rows(self.current_codon, self.region.ref_codon_str(self.current_codon), self.sites)
+            self.writer.writerows(rows)
+            self.written += len(rows)
+            self.current_codon = 0
+
+    def close(self) -> int:
+        ''' output: number of codon table rows written '''
+        self.flush()
+        self.handle.close()
+        return self.written
+
+
+def sinple_sites(variants: str, length: int) -> typing.Iterator[typing.Tuple[int, dict]]:
+    ''' yields (position, calls) of every site of a SiNPle .variants file up to the end of a reference of this length '''
+    with open(variants, 'r') as unpadded:
+        for line in unpadded:
+            parsed = parse_sinple_line(line)
+            if parsed is None:
+                continue
+            if parsed[0] > length:
+                break # past the end of the reference
+            yield parsed
+
+
+def convert_sinple(variants: str, reference: str, orf_start: int, outfile: str) -> int:
+    '''
+    input: path to SiNPle .variants file, path to reference fasta, 1-based genome position of the
+           first base of codon 1, path of the codon table to write (tab-separated)
+    output: number of codon table rows written
+    '''
+    region = CodingRegion.from_fasta(reference, orf_start = orf_start)
+    writer = CodonWriter(region, outfile)
+    try:
+        for pos, calls in sinple_sites(variants, len(region.sequence)):
+            writer.add(pos, calls)
+    finally:
+        written = writer.close()
+    return written
+
+
+def convert_sinple_genes(variants: str, reference: str, genes: pandas.DataFrame, outfiles: dict) -> dict:
+    '''
+    input: path to SiNPle .variants file, path to reference fasta, gene table from coordinates.load_genes,
+           dict of gene -> path of the codon table to write for it
+    output: dict of gene -> number of codon table rows written
+    the file is streamed once; every site is routed to the genes containing it and read in each gene's frame
+    '''
+    sequence = read_reference(reference)
+    writers = [CodonWriter(CodingRegion(sequence, orf_start, start, min(end, len(sequence))), outfiles[gene])
+               for gene, start, end, orf_start in zip(genes['gene'], genes['start'], genes['end'], genes['orf_start'])]
+    try:
+        for pos, calls in sinple_sites(variants, len(sequence)):
+            for index in genes_at(pos, genes):
+                writers[index].add(pos, calls)
+    finally:
+        written = {gene: writer.close() for gene, writer in zip(genes['gene'], writers)}
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Converts a SiNPle .variants file into a virVar-style codon table',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input', required = True, type = str, help = 'Path to SiNPle .variants file (sorted by position)')
+    parser.add_argument('--reference', required = True, type = str, help = 'Path to reference fasta the reads were aligned to')
+    parser.add_argument('--orfStart', default = 9821, type = int, help = '1-based genome position of the first base of codon 1 (default is the start of E3 in pCHIKV_AF15561)')
+    parser.add_argument('--output', required = True, type = str, help = 'Path of the codon table to write (with --genes, the directory receiving <gene>.codon)')
+    parser.add_argument('--genes', default = None, type = str, help = 'GFF3 or TSV (gene,start,end[,strand,phase]) of the ORFs to write one codon table each for; --orfStart is then ignored')
+    args = parser.parse_args()
+
+    if args.genes is not None:
+        genes = load_genes(args.genes)
+        os.makedirs(args.output, exist_ok = True)
+        written = convert_sinple_genes(variants = args.input, reference = args.reference, genes = genes,
+                                       outfiles = {gene: os.path.join(args.output, '{}.codon'.format(directory)) for gene, directory in gene_directories(genes).items()})
+        for gene, total in written.items():
+            print('{}: wrote {} codon variants'.format(gene, total))
+    else:
+        total = convert_sinple(variants = args.input, reference = args.reference, orf_start = args.orfStart, outfile = args.output)
+        print('wrote {} codon variants to {}'.format(total, args.output))
@@ -0,0 +1,200 @@
+import pandas
+import argparse
+import typing
+import os
+import numpy
+
+'''
+Nucleotide substitution spectrum of codon tables: which base changed into which, at which codon phase.
+
+REF_CODON and CODON are decoded to fixed-width (rows x 3) byte arrays; with the categorical schema of
+load_codon_table() only the few distinct codon strings are decoded and rows take their bytes by category code.
+Every substituted base becomes one integer key window * 48 + phase * 16 + ref * 4 + alt (bases in ACGT order)
+and a single numpy.bincount weighted by CNT accumulates all 4 x 4 matrices per codon phase and per window of
+--spectrumWindow codons at once, so tens of millions of rows take seconds.
+
+Transitions are A<->G and C<->T, every other substitution is a transversion.  A mutagenesis or polymerase bias
+shows up as a skewed spectrum, a Ts/Tv ratio far from the library design, or a phase dependence (e.g. NNK
+libraries only vary the third base between G and T).
+'''
+
+BASES = 'ACGT'
+TRANSITION = numpy.zeros((4, 4), dtype = bool)
+for _ref, _alt in ['AG', 'GA', 'CT', 'TC']:
+    TRANSITION[BASES.index(_ref), BASES.index(_alt)] = True
+SUBSTITUTION = ~numpy.eye(4, dtype = bool)
+
+# byte -> base index, 4 for anything that is not A/C/G/T (U is read as T)
+BASE_LOOKUP = numpy.full(256, 4, dtype = numpy.int64)
+for _index, _base in enumerate(BASES):
+    BASE_LOOKUP[ord(_base)] = BASE_LOOKUP[ord(_base.lower())] = _index
+BASE_LOOKUP[ord('U')] = BASE_LOOKUP[ord('u')] = BASES.index('T')
+
+
+def codon_bases(codons: pandas.Series) -> numpy.ndarray:
+    '''
+    input: series of codon strings (categorical or not)
+    output: int array (rows x 3) of base indices into BASES, 4 for other characters
+    '''
+    if isinstance(codons.dtype, pandas.CategoricalDtype):
+        categories = codon_bases(pandas.Series(codons.cat.categories.astype(str)))
+        categories = numpy.vstack([categories, numpy.full((1, 3), 4)]) # code -1 (missing) takes the last row
+        return categories[codons.cat.codes.to_numpy()]
+    raw = codons.astype(str).to_numpy().astype('S3')
+    return BASE_LOOKUP[raw.view(numpy.uint8).reshape(-1, 3)]
+
+
+def substitution_matrices(df: pandas.DataFrame, window: typing.Optional[int] = None) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    '''
+    input: codon table; window size in codons (None: one window over all positions)
+    output: (counts, window_starts); counts is a float array (windows x 3 phases x 4 ref x 4 alt) of CNT summed over
+            the substituted bases, window k covering codons window_starts[k] to window_starts[k] + window - 1
+    '''
+    ref = codon_bases(df['REF_CODON'])
+    alt = codon_bases(df['CODON'])
+    positions = df['POSITION'].to_numpy()
+    if window is None or len(positions) == 0:
+        window_index = numpy.zeros(len(positions), dtype = numpy.int64)
+        window_starts = numpy.array([positions.min() if len(positions) else 1])
+    else:
+        first = (positions.min() - 1) // window
+        window_index = (positions - 1) // window - first
+        window_starts = (numpy.arange(window_index.max() + 1) + first) * window + 1
+    changed = (ref != alt) & (ref < 4) & (alt < 4)
+    rows, phases = numpy.nonzero(changed)
+    keys = window_index[rows] * 48 + phases * 16 + ref[rows, phases] * 4 + alt[rows, phases]
+    weights = df['CNT'].to_numpy(dtype = numpy.float64)[rows]
+    counts = numpy.bincount(keys, weights = weights, minlength = len(window_starts) * 48)
+    return counts.reshape(len(window_starts), 3, 4, 4), window_starts
+
+
+def tstv(counts: numpy.ndarray) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    ''' output: (transition counts, transversion counts) summed over the last two (4 x 4) axes '''
+    return (counts * TRANSITION).sum(axis = (-2, -1)), (counts * (SUBSTITUTION & ~TRANSITION)).sum(axis = (-2, -1))
+
+
+def spectrum_tables(df: pandas.DataFrame, window: int) -> typing.Tuple[pandas.DataFrame, pandas.DataFrame]:
+    '''
+    output: (spectrum, tstv_table)
+            spectrum - one row per phase (1, 2, 3, all) and substitution with counts and the fraction of all
+                       substituted counts of that phase
+            tstv_table - transitions, transversions and Ts/Tv per window and phase
+    '''
+    windowed, window_starts = substitution_matrices(df, window)
+    per_phase = windowed.sum(axis = 0)
+    per_phase = numpy.concatenate([per_phase, per_phase.sum(axis = 0, keepdims = True)]) # (4 phases incl. 'all') x 4 x 4
+    phase_labels = ['1', '2', '3', 'all']
+    ref_index, alt_index = numpy.nonzero(SUBSTITUTION)
+    counts = per_phase[:, ref_index, alt_index] # phases x 12
+    totals = counts.sum(axis = 1, keepdims = True)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        fractions = counts / totals
+    spectrum = pandas.DataFrame({'phase': numpy.repeat(phase_labels, len(ref_index)),
+                                 'ref': numpy.tile([BASES[i] for i in ref_index], len(phase_labels)),
+                                 'alt': numpy.tile([BASES[i] for i in alt_index], len(phase_labels)),
+                                 'type': numpy.tile(numpy.where(TRANSITION[ref_index, alt_index], 'transition', 'transversion'), len(phase_labels)),
+                                 'counts': counts.ravel(), 'fraction': fractions.ravel()})
+
+    windowed = numpy.concatenate([windowed, windowed.sum(axis = 1, keepdims = True)], axis = 1) # windows x 4 phases x 4 x 4
+    ts, tv = tstv(windowed)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        ratio = ts / tv
+    tstv_table = pandas.DataFrame({'window_start': numpy.repeat(window_starts, len(phase_labels)),
+                                   'window_end': numpy.repeat(window_starts + (window if window is not None else 0) - 1, len(phase_labels)),
+                                   'phase': numpy.tile(phase_labels, len(window_starts)),
+                                   'transitions': ts.ravel(), 'transversions': tv.ravel(), 'ts_tv': ratio.ravel()})
+    return spectrum, tstv_table
+
+
+def plot_spectrum_heatmaps(matrices: dict, outdir: str) -> None:
+    '''
+    input: dict of sample -> (4 phases x 4 x 4) fractions of substituted counts (phases 1, 2, 3, all)
+    output: substitution_spectrum_heatmaps.png, one row of heatmaps per sample and one column per codon phase
+    '''
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(len(matrices), 4, figsize = (10, 2.6 * len(matrices) + 0.6), squeeze = False)
+    vmax = max(numpy.nanmax(matrix) for matrix in matrices.values()) if matrices else 1.0
+    for row, (sample, matrix) in enumerate(matrices.items()):
+        for col, phase in enumerate(['codon phase 1', 'codon phase 2', 'codon phase 3', 'all phases']):
+            ax = axes[row, col]
+            shown = numpy.where(SUBSTITUTION, matrix[col], numpy.nan)
+            image = ax.imshow(shown, cmap = 'viridis', vmin = 0, vmax = vmax)
+            for i in range(4):
+                for j in range(4):
+                    if SUBSTITUTION[i, j] and numpy.isfinite(shown[i, j]):
+                        ax.text(j, i, '{:.2f}'.format(shown[i, j]), ha = 'center', va = 'center', fontsize = 7,
+                                color = 'white' if shown[i, j] < vmax / 2 else 'black', fontweight = 'bold' if TRANSITION[i, j] else 'normal')
+            ax.set_xticks(range(4))
+            ax.set_xticklabels(list(BASES))
+            ax.set_yticks(range(4))
+            ax.set_yticklabels(list(BASES))
+            ax.set_xlabel('alt base', fontsize = 8)
+            if col == 0:
+                ax.set_ylabel('{}\nref base'.format(sample), fontweight = 'bold', fontsize = 9)
+            if row == 0:
+                ax.set_title(phase, fontweight = 'bold', fontsize = 10)
+    fig.colorbar(image, ax = axes.ravel().tolist(), shrink = 0.6, label = 'fraction of substituted counts (transitions bold)')
+    fig.savefig(os.path.join(outdir, 'substitution_spectrum_heatmaps.png'), dpi=600, format = 'png', bbox_inches = 'tight')
+    plt.close(fig)
+
+
+def plot_tstv_windows(tables: dict, colors: dict, outdir: str) -> None:
+    ''' output: substitution_tstv_per_window.png, Ts/Tv ratio per window for every sample '''
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize = (10, 4))
+    for sample, table in tables.items():
+        table = table[table['phase'] == 'all']
+        centers = (table['window_start'] + table['window_end']) / 2.0
+        ax.plot(centers, table['ts_tv'], marker = 'o', markersize = 3, linewidth = 1, color = colors.get(sample), label = sample)
+    ax.axhline(0.5, color = 'grey', linestyle = '--', linewidth = 0.8, label = 'unbiased (Ts/Tv = 0.5)')
+    ax.set_xlabel('Codon position', fontweight = 'bold', color = 'darkblue', fontsize = 10)
+    ax.set_ylabel('Ts/Tv ratio', fontweight = 'bold', color = 'darkblue', fontsize = 10)
+    ax.set_title('Transition/transversion ratio per codon window', fontweight = 'bold')
+    ax.legend(fontsize = 8, frameon = False)
+    fig.tight_layout()
+    fig.savefig(os.path.join(outdir, 'substitution_tstv_per_window.png'), dpi=600, format = 'png')
+    plt.close(fig)
+
+
+def get_substitution_spectrum(df_hash: dict, colors: dict, params: dict, outdir: str) -> None:
+    '''
+    input: df_hash of sample -> filtered codon table; params with spectrumWindow (codons per window)
+    output: None; writes substitution_spectrum_all_samples.tsv, substitution_tstv_all_samples.tsv,
+            substitution_spectrum_heatmaps.png and substitution_tstv_per_window.png
+    '''
+    spectra, tstv_tables, matrices = [], {}, {}
+    for key, value in df_hash.items():
+        spectrum, tstv_table = spectrum_tables(value, params['spectrumWindow'])
+        spectra.append(spectrum.assign(sample = key))
+        tstv_tables[key] = tstv_table
+        matrix = numpy.full((4, 4, 4), numpy.nan)
+        for phase_index, phase in enumerate(['1', '2', '3', 'all']):
+            rows = spectrum[spectrum['phase'] == phase]
+            matrix[phase_index, [BASES.index(b) for b in rows['ref']], [BASES.index(b) for b in rows['alt']]] = rows['fraction']
+        matrices[key] = matrix
+        overall = tstv_table[tstv_table['phase'] == 'all'][['transitions', 'transversions']].sum()
+        print('{}: Ts/Tv = {:.3f}'.format(key, overall['transitions'] / overall['transversions'] if overall['transversions'] > 0 else numpy.nan))
+    spectra = pandas.concat(spectra, ignore_index = True)
+    spectra[['sample', 'phase', 'ref', 'alt', 'type', 'counts', 'fraction']].to_csv(os.path.join(outdir, 'substitution_spectrum_all_samples.tsv'), sep = '\t', index = False)
+    pandas.concat([table.assign(sample = key) for key, table in tstv_tables.items()], ignore_index = True)[
+        ['sample', 'window_start', 'window_end', 'phase', 'transitions', 'transversions', 'ts_tv']].to_csv(
+        os.path.join(outdir, 'substitution_tstv_all_samples.tsv'), sep = '\t', index = False)
+    plot_spectrum_heatmaps(matrices, outdir)
+    plot_tstv_windows(tstv_tables, colors, outdir)
+
+
+if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('Agg')
+    from variant_filters import add_sample_arguments, load_filtered_samples
+
+    parser = argparse.ArgumentParser(description = 'Nucleotide substitution spectrum per codon phase and transition/transversion ratios of codon tables',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    add_sample_arguments(parser)
+    parser.add_argument('--spectrumWindow', default = 50, type = int, help = 'number of codons per window of the Ts/Tv profile')
+    args = parser.parse_args()
+
+    df_hash, _, colors = load_filtered_samples(args)
+    get_substitution_spectrum(df_hash, colors, {'spectrumWindow': args.spectrumWindow}, args.outdir)
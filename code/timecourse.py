@@ -0,0 +1,195 @@
+import pandas
+import argparse
+import os
+import numpy
+
+from codon_tables import CODONS, encode_codons
+
+'''
+Selection of codon variants over serial passages.
+
+Samples carry a passage (or any numeric time) label, the 'passage' column of the run_manifest.py manifest.
+Every codon variant (POSITION, CODON) seen in any sample becomes one row of a dense (variants x samples) array
+of counts and depths, built with integer keys POSITION * 64 + codon and numpy.searchsorted; a variant missing
+from a sample's filtered table is treated as unobserved (weight 0), not as frequency 0, since the count filter
+removed it.  Samples sharing a passage (replicates) are separate observations of the same time point.
+
+For every variant the log frequency y = ln((CNT + 0.5) / (DENOM + 1)) is regressed on time by weighted least
+squares, with inverse variance weights w = DENOM f / (1 - f) (var ln f is about (1 - f) / (DENOM f)).  All
+fits are done at once: the weighted sums of 1, t, t^2, y and t y are row sums of the (variants x samples) arrays,
+slope and intercept follow from them elementwise and the residual variance from one more row sum.  The slope is
+the selection coefficient per time unit (relative to the whole population at that codon), its standard error is
+scaled by the residual variance of the fit and needs at least three observed time points.
+'''
+
+MIN_TIMEPOINTS = 2
+
+
+def variant_time_array(df_hash: dict, timepoints: dict) -> dict:
+    '''
+    input: df_hash of sample -> filtered codon table; timepoints, sample -> numeric time
+    output: dict with
+            samples   - samples sorted by time (axis 1)
+            times     - float array of their times
+            keys      - sorted int array of variant keys POSITION * 64 + codon code (axis 0)
+            counts    - float array (variants x samples) of CNT, 0 where unobserved
+            depth     - float array (variants x samples) of DENOM, 0 where the variant is unobserved
+            labels    - dataframe (variants) with POSITION, REF_CODON, CODON, REF_AA, AA
+    '''
+    samples = sorted(df_hash, key = lambda sample: timepoints[sample])
+    encoded = {}
+    for sample in samples:
+        df = df_hash[sample]
+        codes = encode_codons(df['CODON'])
+        valid = codes >= 0
+        encoded[sample] = (df['POSITION'].to_numpy(dtype = numpy.int64)[valid] * 64 + codes[valid], df.loc[valid])
+    keys = numpy.unique(numpy.concatenate([sample_keys for sample_keys, _ in encoded.values()])) if encoded else numpy.zeros(0, dtype = numpy.int64)
+    counts = numpy.zeros((len(keys), len(samples)))
+    depth = numpy.zeros((len(keys), len(samples)))
+    labels = {}
+    for column, (sample, (sample_keys, df)) in enumerate(encoded.items()):
+        rows = numpy.searchsorted(keys, sample_keys)
+        # duplicated keys (should not happen in virVar tables) are summed
+        numpy.add.at(counts[:, column], rows, df['CNT'].to_numpy(dtype = numpy.float64))
+        depth[rows, column] = df['DENOM'].to_numpy(dtype = numpy.float64)
+        labels[sample] = pandas.DataFrame({'key': sample_keys, 'REF_CODON': df['REF_CODON'].astype(str).to_numpy(),
+                                           'REF_AA': df['REF_AA'].astype(str).to_numpy(), 'AA': df['AA'].astype(str).to_numpy()})
+    first_seen = pandas.concat(labels.values()).drop_duplicates('key').set_index('key').reindex(keys) if labels else pandas.DataFrame(index = keys)
+    labels = pandas.DataFrame({'POSITION': keys // 64, 'REF_CODON': first_seen.get('REF_CODON'), 'CODON': numpy.array(CODONS)[keys % 64],
+                               'REF_AA': first_seen.get('REF_AA'), 'AA': first_seen.get('AA')}).reset_index(drop = True)
+    return {'samples': samples, 'times': numpy.array([timepoints[sample] for sample in samples], dtype = numpy.float64),
+            'keys': keys, 'counts': counts, 'depth': depth, 'labels': labels}
+
+
+def fit_selection(counts: numpy.ndarray, depth: numpy.ndarray, times: numpy.ndarray) -> pandas.DataFrame:
+    '''
+    input: (variants x samples) counts and depths (depth 0 = unobserved); time of every sample
+    output: dataframe (one row per variant) with n_timepoints, slope, se, z and intercept of the weighted least
+            squares fit of log frequency on time; nan where fewer than MIN_TIMEPOINTS (slope) or 3 (se) time points
+    '''
+    observed = depth > 0
+    freq = (counts + 0.5) / (depth + 1.0)
+    y = numpy.log(freq)
+    w = numpy.where(observed, depth * freq / (1.0 - numpy.minimum(freq, 1.0 - 1e-9)), 0.0)
+    t = times[None, :]
+    sw = w.sum(axis = 1)
+    swt = (w * t).sum(axis = 1)
+    swtt = (w * t * t).sum(axis = 1)
+    swy = (w * y).sum(axis = 1)
+    swty = (w * t * y).sum(axis = 1)
+    # distinct observed time points per variant: replicates of one passage do not add a time point
+    _, time_index = numpy.unique(times, return_inverse = True)
+    per_time = numpy.zeros((len(counts), time_index.max() + 1 if len(times) else 0), dtype = bool)
+    for column, index in enumerate(time_index):
+        per_time[:, index] |= observed[:, column]
+    n_points = per_time.sum(axis = 1)
+
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        det = sw * swtt - swt * swt
+        slope = (sw * swty - swt * swy) / det
+        intercept = (swy - slope * swt) / sw
+        residual = numpy.where(observed, y - intercept[:, None] - slope[:, None] * t, 0.0)
+        dof = observed.sum(axis = 1) - 2
+        sigma2 = (w * residual * residual).sum(axis = 1) / dof
+        se = numpy.sqrt(sigma2 * sw / det)
+    slope = numpy.where(n_points >= MIN_TIMEPOINTS, slope, numpy.nan)
+    se = numpy.where((n_points >= 3) & (dof > 0), se, numpy.nan)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        z = slope / se
+    return pandas.DataFrame({'n_timepoints': n_points, 'slope': slope, 'se': se, 'z': z,
+                             'intercept': numpy.where(n_points >= MIN_TIMEPOINTS, intercept, numpy.nan)})
+
+
+def selection_table(stacked: dict, fits: pandas.DataFrame) -> pandas.DataFrame:
+    '''
+    output: variant labels, fit and first/last observed frequency, ranked by z (strongest positive selection first,
+            variants without a standard error after those with one, by slope)
+    '''
+    freq = numpy.where(stacked['depth'] > 0, stacked['counts'] / numpy.where(stacked['depth'] > 0, stacked['depth'], 1.0), numpy.nan)
+    observed = ~numpy.isnan(freq)
+    first = numpy.argmax(observed, axis = 1)
+    last = freq.shape[1] - 1 - numpy.argmax(observed[:, ::-1], axis = 1)
+    rows = numpy.arange(len(freq))
+    table = pandas.concat([stacked['labels'], fits], axis = 1)
+    table['first_freq'] = freq[rows, first] if freq.shape[1] else numpy.nan
+    table['last_freq'] = freq[rows, last] if freq.shape[1] else numpy.nan
+    table = table[table['n_timepoints'] >= MIN_TIMEPOINTS]
+    table = table.sort_values(['z', 'slope'], ascending = False, na_position = 'last', kind = 'stable').reset_index(drop = True)
+    table.insert(0, 'rank', numpy.arange(1, len(table) + 1))
+    return table
+
+
+def plot_trajectories(stacked: dict, table: pandas.DataFrame, top: int, outdir: str) -> None:
+    '''
+    output: timecourse_top_trajectories.png, observed frequencies and fitted trajectories of the top variants with
+            the largest positive and negative z (slope when no variant has three time points)
+    '''
+    import matplotlib.pyplot as plt
+
+    # two-point fits have no standard error and would crowd out better supported variants
+    score = (table['z'] if table['z'].notna().any() else table['slope']).dropna()
+    groups = [('increasing', table.loc[score.sort_values(ascending = False).index[:top]]),
+              ('decreasing', table.loc[score.sort_values(ascending = True).index[:top]])]
+    times = stacked['times']
+    grid = numpy.linspace(times.min(), times.max(), 50) if len(times) else numpy.zeros(0)
+    row_of_key = pandas.Series(numpy.arange(len(stacked['keys'])), index = stacked['keys'])
+    palette = plt.get_cmap('tab10')
+    fig, axes = plt.subplots(1, 2, figsize = (12, 5), sharey = True)
+    for ax, (title, variants) in zip(axes, groups):
+        for index, (_, variant) in enumerate(variants.iterrows()):
+            row = row_of_key[variant['POSITION'] * 64 + CODONS.index(variant['CODON'])]
+            observed = stacked['depth'][row] > 0
+            freq = stacked['counts'][row, observed] / stacked['depth'][row, observed]
+            color = palette(index % 10)
+            label = '{}{}{} ({}) s={:.3f}'.format(variant['REF_AA'], variant['POSITION'], variant['AA'], variant['CODON'], variant['slope'])
+            ax.scatter(times[observed], freq, color = color, s = 14)
+            ax.plot(grid, numpy.exp(variant['intercept'] + variant['slope'] * grid), color = color, linewidth = 1, label = label)
+        ax.set_yscale('log')
+        ax.set_title('top {} {} variants'.format(len(variants), title), fontweight = 'bold')
+        ax.set_xlabel('Passage', fontweight = 'bold', color = 'darkblue', fontsize = 10)
+        ax.legend(fontsize = 6, frameon = False, loc = 'best')
+    axes[0].set_ylabel('Variant frequency', fontweight = 'bold', color = 'darkblue', fontsize = 10)
+    fig.tight_layout()
+    fig.savefig(os.path.join(outdir, 'timecourse_top_trajectories.png'), dpi=600, format = 'png')
+    plt.close(fig)
+
+
+def get_timecourse(df_hash: dict, timepoints: dict, params: dict, outdir: str) -> None:
+    '''
+    input: df_hash of sample -> filtered codon table; timepoints, sample -> passage (from the manifest 'passage'
+           column); params with timecourseTop, the number of variants plotted per direction
+    output: None; writes timecourse_selection_coefficients.tsv (ranked fits), timecourse_frequencies.tsv
+            (variants x samples frequencies) and timecourse_top_trajectories.png
+    '''
+    missing = [sample for sample in df_hash if timepoints.get(sample) is None]
+    if missing:
+        raise ValueError('timecourse needs a passage for every sample (manifest column "passage"), missing for: {}'.format(', '.join(missing)))
+    stacked = variant_time_array(df_hash, timepoints)
+    table = selection_table(stacked, fit_selection(stacked['counts'], stacked['depth'], stacked['times']))
+    table.to_csv(os.path.join(outdir, 'timecourse_selection_coefficients.tsv'), sep = '\t', index = False)
+
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        freq = numpy.where(stacked['depth'] > 0, stacked['counts'] / stacked['depth'], numpy.nan)
+    frequencies = pandas.concat([stacked['labels'], pandas.DataFrame(freq, columns = ['{}_p{:g}'.format(sample, timepoints[sample]) for sample in stacked['samples']])], axis = 1)
+    frequencies.to_csv(os.path.join(outdir, 'timecourse_frequencies.tsv'), sep = '\t', index = False)
+    plot_trajectories(stacked, table, params['timecourseTop'], outdir)
+    print('fitted {} variants over {} samples at {} time points'.format(len(table), len(stacked['samples']), len(numpy.unique(stacked['times']))))
+
+
+if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('Agg')
+    from variant_filters import add_sample_arguments, load_filtered_samples
+
+    parser = argparse.ArgumentParser(description = 'Fits per-variant selection coefficients across serial passages',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    add_sample_arguments(parser, colors = False)
+    parser.add_argument('--passages', required = True, type = str, help = 'comma-separated list of passage numbers (or times), same order as --data')
+    parser.add_argument('--timecourseTop', default = 10, type = int, help = 'number of most increasing and most decreasing variants to plot')
+    args = parser.parse_args()
+
+    passages = [float(passage) for passage in args.passages.split(',')]
+    df_hash, _, _ = load_filtered_samples(args)
+    if len(df_hash) != len(passages):
+        raise SystemExit('--data, --samplename and --passages must list the same number of entries')
+    get_timecourse(df_hash, dict(zip(df_hash, passages)), {'timecourseTop': args.timecourseTop}, args.outdir)
@@ -0,0 +1,261 @@
+import pandas
+import argparse
+import typing
+import math
+import os
+import numpy
+
+from codon_tables import LOAD_COLUMNS, apply_schema, load_codon_table, parse_codon_range
+
+'''
+Vectorized filtering of codon tables with per-filter rejection counts.
+
+Every filter computes one boolean "passes" mask over the whole table (or chunk) and the masks are combined
+once, so the cost is a handful of numpy operations per row regardless of how many filters are enabled:
+
+    quality            mean of FWD_MEAN_MIN_QUAL and REV_MEAN_MIN_QUAL >= minQ
+    min_count          CNT >= minAlt
+    adaptive_count     CNT >= minFreq x local depth, where local depth is the rolling median of DENOM over
+                       depthWindow codons around the position (deep positions need more supporting reads,
+                       single coverage dropouts do not lower the threshold of their neighbours)
+    strand_bias        two-sided binomial test of FWD_CNT out of CNT against the strand fraction of the
+                       coverage, FWD_DENOM / (FWD_DENOM + REV_DENOM); rejected when p < strandBiasP.  Uses
+                       scipy.stats when installed, a continuity corrected normal approximation otherwise
+    strand_odds_ratio  GATK-style symmetric strand odds ratio (SOR) of the alt and ref reads per strand;
+                       rejected when SOR > maxSOR
+    reference          REF_CODON != CODON (unless keepRef)
+    range              POSITION inside codonRange
+
+Rows whose strand columns are missing (e.g. SiNPle conversions without strand counts) pass the strand filters.
+With the defaults (no strandBiasP, maxSOR or minFreq) the result is identical to the original filter().
+
+filter_codon_file() streams a tab-separated table in chunks, so tables larger than memory are filtered with a
+bounded footprint; only POSITION and DENOM are read in a first pass when the adaptive threshold needs depths.
+
+The analysis scripts share their sample and threshold arguments through add_sample_arguments() and
+load_filtered_samples(), so run on their own they filter exactly as run_manifest.py does.
+
+    python3 variant_filters.py --data wtDNA_S16_cleaned.codon --outfile wtDNA.filtered.tsv --qual 24 --counts 100 --strandBiasP 0.001 --maxSOR 3 --minFreq 0.001
+'''
+
+FILTERS = ['quality', 'min_count', 'adaptive_count', 'strand_bias', 'strand_odds_ratio', 'reference', 'range']
+
+
+def _normal_sf(z: numpy.ndarray) -> numpy.ndarray:
+    ''' upper tail of the standard normal (Abramowitz and Stegun 7.1.26 erfc approximation, error < 1.5e-7) '''
+    x = numpy.abs(z) / math.sqrt(2.0)
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    erfc = poly * numpy.exp(-x * x)
+    return numpy.where(z >= 0, erfc / 2.0, 1.0 - erfc / 2.0)
+
+
+def strand_bias_pvalues(fwd_alt: numpy.ndarray, rev_alt: numpy.ndarray, fwd_depth: numpy.ndarray, rev_depth: numpy.ndarray) -> numpy.ndarray:
+    '''
+    input: per row forward and reverse alt counts and forward and reverse depth
+    output: two-sided binomial p-value (twice the smaller tail) that the alt reads split across strands like the
+            coverage does; nan where the strand columns are missing or there is no coverage
+    '''
+    fwd_alt = numpy.asarray(fwd_alt, dtype = numpy.float64)
+    n = fwd_alt + numpy.asarray(rev_alt, dtype = numpy.float64)
+    total_depth = numpy.asarray(fwd_depth, dtype = numpy.float64) + numpy.asarray(rev_depth, dtype = numpy.float64)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        p = numpy.asarray(fwd_depth, dtype = numpy.float64) / total_depth
+    valid = numpy.isfinite(fwd_alt) & numpy.isfinite(n) & numpy.isfinite(p) & (n > 0)
+    pvalues = numpy.full(len(n), numpy.nan)
+    k, n, p = fwd_alt[valid], n[valid], p[valid]
+    try:
+        from scipy.stats import binom
+        tails = numpy.minimum(binom.cdf(k, n, p), binom.sf(k - 1, n, p))
+    except ImportError:
+        sd = numpy.sqrt(n * p * (1.0 - p))
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            z = (numpy.abs(k - n * p) - 0.5) / sd
+        # all reads on a strand without coverage of the other is as biased as it gets
+        tails = numpy.where(sd > 0, _normal_sf(numpy.maximum(z, 0.0)), numpy.where(numpy.abs(k - n * p) < 0.5, 0.5, 0.0))
+    pvalues[valid] = numpy.minimum(1.0, 2.0 * tails)
+    return pvalues
+
+
+def strand_odds_ratio(fwd_alt: numpy.ndarray, rev_alt: numpy.ndarray, fwd_depth: numpy.ndarray, rev_depth: numpy.ndarray) -> numpy.ndarray:
+    '''
+    output: symmetric strand odds ratio per row, ln(R + 1/R) + ln(min(ref)/max(ref)) - ln(min(alt)/max(alt)) with
+            R = (ref_fwd x alt_rev) / (ref_rev x alt_fwd) and a pseudocount of 1 on every cell; nan where strand
+            columns are missing
+    '''
+    fwd_alt = numpy.asarray(fwd_alt, dtype = numpy.float64)
+    rev_alt = numpy.asarray(rev_alt, dtype = numpy.float64)
+    alt_fwd, alt_rev = fwd_alt + 1.0, rev_alt + 1.0
+    ref_fwd = numpy.maximum(numpy.asarray(fwd_depth, dtype = numpy.float64) - fwd_alt, 0.0) + 1.0
+    ref_rev = numpy.maximum(numpy.asarray(rev_depth, dtype = numpy.float64) - rev_alt, 0.0) + 1.0
+    ratio = (ref_fwd * alt_rev) / (ref_rev * alt_fwd)
+    return (numpy.log(ratio + 1.0 / ratio) + numpy.log(numpy.minimum(ref_fwd, ref_rev) / numpy.maximum(ref_fwd, ref_rev))
+            - numpy.log(numpy.minimum(alt_fwd, alt_rev) / numpy.maximum(alt_fwd, alt_rev)))
+
+
+def local_depth(positions: numpy.ndarray, depth: numpy.ndarray, depthWindow: int = 25) -> pandas.Series:
+    '''
+    input: POSITION and DENOM of every row (any order, repeated positions allowed); window in codons
+    output: series indexed by position of the rolling median of the per-position depth over depthWindow positions
+    '''
+    per_position = pandas.Series(numpy.asarray(depth, dtype = numpy.float64)).groupby(numpy.asarray(positions)).max().sort_index()
+    return per_position.rolling(depthWindow, center = True, min_periods = 1).median()
+
+
+def filter_masks(df: pandas.DataFrame, minQ: float, minAlt: int, codonRange: str, keepRef: bool = False,
+                 strandBiasP: typing.Optional[float] = None, maxSOR: typing.Optional[float] = None, minFreq: float = 0.0,
+                 depthWindow: int = 25, depth_profile: typing.Optional[pandas.Series] = None) -> dict:
+    '''
+    input: codon table and thresholds (see module docstring); depth_profile, position -> local depth as from
+           local_depth(), computed from df when not given (pass it when filtering a table in chunks)
+    output: dict of filter name -> boolean array, True where the row passes that filter (only enabled filters)
+    '''
+    masks = {}
+    qualities = df[['FWD_MEAN_MIN_QUAL', 'REV_MEAN_MIN_QUAL']].to_numpy(dtype = numpy.float64)
+    observed = numpy.isfinite(qualities)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean_qual = numpy.where(observed, qualities, 0.0).sum(axis = 1) / observed.sum(axis = 1) # nan when both are missing
+    masks['quality'] = mean_qual >= minQ
+    counts = df['CNT'].to_numpy(dtype = numpy.float64)
+    masks['min_count'] = counts >= minAlt
+
+    if minFreq > 0:
+        if depth_profile is None:
+            depth_profile = local_depth(df['POSITION'].to_numpy(), df['DENOM'].to_numpy(), depthWindow = depthWindow)
+        depth = depth_profile.reindex(df['POSITION'].to_numpy()).to_numpy()
+        masks['adaptive_count'] = ~(counts < numpy.ceil(minFreq * depth))
+
+    if strandBiasP is not None or maxSOR is not None:
+        strand = [df[column].to_numpy(dtype = numpy.float64) if column in df.columns else numpy.full(len(df), numpy.nan)
+                  for column in ['FWD_CNT', 'REV_CNT', 'FWD_DENOM', 'REV_DENOM']]
+        if strandBiasP is not None:
+            masks['strand_bias'] = ~(strand_bias_pvalues(*strand) < strandBiasP)
+        if maxSOR is not None:
+            masks['strand_odds_ratio'] = ~(strand_odds_ratio(*strand) > maxSOR)
+
+    if not keepRef:
+        masks['reference'] = (df['REF_CODON'].astype(str).to_numpy() != df['CODON'].astype(str).to_numpy())
+
+    positions = parse_codon_range(codonRange)
+    if positions is not None:
+        masks['range'] = ((df['POSITION'] >= positions[0]) & (df['POSITION'] <= positions[1])).to_numpy()
+    return masks
+
+
+def rejection_counts(masks: dict, n_rows: int) -> pandas.DataFrame:
+    '''
+    output: dataframe indexed by filter name with rejected (rows failing the filter) and rejected_only
+            (rows failing only this filter), plus 'total' (rejected by any filter) and 'kept' rows
+    '''
+    names = [name for name in FILTERS if name in masks]
+    failing = numpy.stack([~masks[name] for name in names], axis = 1) if names else numpy.zeros((n_rows, 0), dtype = bool)
+    n_failed = failing.sum(axis = 1)
+    report = pandas.DataFrame({'rejected': failing.sum(axis = 0), 'rejected_only': (failing & (n_failed == 1)[:, None]).sum(axis = 0)}, index = names)
+    report.loc['total'] = [int((n_failed > 0).sum()), int((n_failed > 0).sum())]
+    report.loc['kept'] = [int((n_failed == 0).sum()), int((n_failed == 0).sum())]
+    report.index.name = 'filter'
+    return report.astype(numpy.int64)
+
+
+def apply_filters(df: pandas.DataFrame, **thresholds) -> typing.Tuple[pandas.DataFrame, pandas.DataFrame]:
+    '''
+    input: codon table; keyword arguments of filter_masks()
+    output: (filtered table with a fresh index, per-filter rejection counts as from rejection_counts())
+    '''
+    masks = filter_masks(df, **thresholds)
+    keep = numpy.ones(len(df), dtype = bool)
+    for mask in masks.values():
+        keep &= mask
+    filtered = df.loc[keep]
+    filtered.reset_index(inplace = True, drop = True)
+    return filtered, rejection_counts(masks, len(df))
+
+
+def filter_codon_file(path: str, outfile: str, chunksize: int = 500000, **thresholds) -> pandas.DataFrame:
+    '''
+    input: tab-separated codon table (or .parquet from codon_store.py, read in one piece), path of the filtered tsv
+           to write, rows per chunk; keyword arguments of filter_masks()
+    output: per-filter rejection counts summed over the whole table
+    '''
+    positions = parse_codon_range(thresholds.get('codonRange', '0-0'))
+    if path.endswith('.parquet'):
+        chunks = [load_codon_table(path, positions = positions)]
+    else:
+        header = pandas.read_csv(path, sep = '\t', nrows = 0).columns
+        usecols = [column for column in LOAD_COLUMNS if column in header]
+        chunks = pandas.read_csv(path, sep = '\t', usecols = usecols, dtype = {column: str for column in ['REF_CODON', 'CODON', 'REF_AA', 'AA'] if column in usecols},
+                                 chunksize = chunksize)
+        if thresholds.get('minFreq', 0.0) > 0 and thresholds.get('depth_profile') is None:
+            # depths of neighbouring positions may fall into other chunks; read them once up front
+            depths = pandas.read_csv(path, sep = '\t', usecols = ['POSITION', 'DENOM'])
+            thresholds['depth_profile'] = local_depth(depths['POSITION'].to_numpy(), depths['DENOM'].to_numpy(), depthWindow = thresholds.get('depthWindow', 25))
+
+    report = None
+    tmp_outfile = outfile + '.tmp'
+    with open(tmp_outfile, 'w') as handle:
+        for index, chunk in enumerate(chunks):
+            filtered, chunk_report = apply_filters(apply_schema(chunk), **thresholds)
+            filtered.to_csv(handle, sep = '\t', index = False, header = index == 0)
+            report = chunk_report if report is None else report.add(chunk_report, fill_value = 0).astype(numpy.int64)
+    os.replace(tmp_outfile, outfile) # never leave a partial table behind that looks up to date
+    return report.loc[[name for name in FILTERS + ['total', 'kept'] if name in report.index]]
+
+
+def add_sample_arguments(parser: argparse.ArgumentParser, colors: bool = True) -> None:
+    '''
+    adds the --data, --samplename, --colors (unless colors is False), filter threshold and --outdir arguments of
+    the analysis scripts to parser
+    '''
+    parser.add_argument('--data', required = True, type = str, help = 'comma-separated list of codon tables as generated by virVar (or .parquet tables from codon_store.py)')
+    parser.add_argument('--samplename', required = True, type = str, help = 'comma-separated list of sample names, same order as --data')
+    if colors:
+        parser.add_argument('--colors', default = None, type = str, help = 'comma-separated list of hex colors, same order as --samplename')
+    parser.add_argument('--qual', default = 24.0, type = float, help = 'minimum average quality of reads to keep')
+    parser.add_argument('--counts', default = 100, type = int, help = 'minimum number of counts for a codon variant to keep')
+    parser.add_argument('--pos', default = '0-0', type = str, help = 'integer range of codon positions to use, e.g. 9-397; 0-0 uses all positions')
+    parser.add_argument('--strandBiasP', default = None, type = float, help = 'reject variants whose forward/reverse split differs from the coverage with binomial p below this')
+    parser.add_argument('--maxSOR', default = None, type = float, help = 'reject variants with a strand odds ratio above this (GATK uses 3)')
+    parser.add_argument('--minFreq', default = 0.0, type = float, help = 'reject variants with fewer counts than this fraction of the local depth')
+    parser.add_argument('--depthWindow', default = 25, type = int, help = 'number of codons over which the local depth (rolling median) is taken')
+    parser.add_argument('--outdir', default = os.getcwd(), help = 'Path to output directory')
+
+
+def load_filtered_samples(args: argparse.Namespace) -> typing.Tuple[dict, dict, dict]:
+    '''
+    input: arguments parsed with add_sample_arguments()
+    output: (sample -> codon table filtered with apply_filters(), sample -> path, sample -> color, empty without --colors)
+    '''
+    paths = [path.strip() for path in args.data.split(',')]
+    names = [name.strip() for name in args.samplename.split(',')]
+    if len(paths) != len(names):
+        raise SystemExit('--data and --samplename must list the same number of entries')
+    colors = dict(zip(names, [color.strip() for color in args.colors.split(',')])) if getattr(args, 'colors', None) is not None else {}
+    # the local depth of --minFreq is taken over the whole table, as filter_codon_file() does in run_manifest.py
+    positions = parse_codon_range(args.pos) if not args.minFreq else None
+    df_hash = {}
+    for name, path in zip(names, paths):
+        df_hash[name], _ = apply_filters(load_codon_table(path, positions = positions), minQ = args.qual, minAlt = args.counts, codonRange = args.pos,
+                                         strandBiasP = args.strandBiasP, maxSOR = args.maxSOR, minFreq = args.minFreq, depthWindow = args.depthWindow)
+    return df_hash, dict(zip(names, paths)), colors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Filters a codon table by quality, counts, strand bias and depth-adaptive thresholds and reports rejections per filter',
+                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data', required = True, type = str, help = 'codon table as generated by virVar (or .parquet table from codon_store.py)')
+    parser.add_argument('--outfile', required = True, type = str, help = 'filtered tsv to write; the rejection counts are written next to it as <outfile>.filter_report.tsv')
+    parser.add_argument('--qual', default = 24.0, type = float, help = 'minimum average quality of reads to keep')
+    parser.add_argument('--counts', default = 100, type = int, help = 'minimum number of counts for a codon variant to keep')
+    parser.add_argument('--pos', default = '0-0', type = str, help = 'integer range of codon positions to use, e.g. 7-100; 0-0 uses all positions')
+    parser.add_argument('--keepRef', action = 'store_true', help = 'keep rows where REF_CODON equals CODON')
+    parser.add_argument('--strandBiasP', default = None, type = float, help = 'reject variants whose forward/reverse split differs from the coverage with binomial p below this')
+    parser.add_argument('--maxSOR', default = None, type = float, help = 'reject variants with a strand odds ratio above this (GATK uses 3)')
+    parser.add_argument('--minFreq', default = 0.0, type = float, help = 'reject variants with fewer counts than this fraction of the local depth')
+    parser.add_argument('--depthWindow', default = 25, type = int, help = 'number of codons over which the local depth (rolling median) is taken')
+    parser.add_argument('--chunksize', default = 500000, type = int, help = 'rows read and filtered at a time')
+    args = parser.parse_args()
+
+    report = filter_codon_file(args.data, args.outfile, chunksize = args.chunksize, minQ = args.qual, minAlt = args.counts, codonRange = args.pos,
+                               keepRef = args.keepRef, strandBiasP = args.strandBiasP, maxSOR = args.maxSOR, minFreq = args.minFreq, depthWindow = args.depthWindow)
+    report.to_csv(args.outfile + '.filter_report.tsv', sep = '\t')
+    print(report.to_string())